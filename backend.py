@@ -5,17 +5,26 @@ import base64
 import hashlib
 import hmac
 import json
+import math
 import os
+import queue
+import random
 import secrets
+import socket
 import threading
 import time
 import sqlite3
-from datetime import datetime, timezone
+import weakref
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from functools import wraps
-from typing import Any
+from types import MappingProxyType
+from typing import Any, Callable, Mapping, NamedTuple
 from urllib.parse import urlencode
 
 import requests
+from requests.adapters import HTTPAdapter
 from flask import Flask, jsonify, make_response, redirect, request, send_from_directory
 from flask_cors import CORS
 
@@ -23,6 +32,13 @@ app = Flask(__name__, static_folder="static")
 CORS(app, resources={r"/api/*": {"origins": os.getenv("DASHBOARD_ALLOWED_ORIGIN", "*")}})
 
 DATABASE_PATH = os.getenv("DATABASE_PATH", "fulfillment.db")
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "8"))
+SQLITE_POOL_WAIT_TIMEOUT = float(os.getenv("SQLITE_POOL_WAIT_TIMEOUT", "5"))
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").strip().upper()
+if SQLITE_SYNCHRONOUS not in {"OFF", "NORMAL", "FULL", "EXTRA"}:
+    SQLITE_SYNCHRONOUS = "NORMAL"
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-20000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(128 * 1024 * 1024)))
 WORKER_AUTH_TOKEN = os.getenv("WORKER_AUTH_TOKEN", "")
 DASHBOARD_AUTH_TOKEN = os.getenv("DASHBOARD_AUTH_TOKEN", "") or WORKER_AUTH_TOKEN
 SHOPIFY_WEBHOOK_SECRET = os.getenv("SHOPIFY_WEBHOOK_SECRET", "")
@@ -31,14 +47,67 @@ SHOPIFY_ADMIN_ACCESS_TOKEN = os.getenv("SHOPIFY_ADMIN_ACCESS_TOKEN", "")
 SHOPIFY_CLIENT_ID = os.getenv("SHOPIFY_CLIENT_ID", "")
 SHOPIFY_CLIENT_SECRET = os.getenv("SHOPIFY_CLIENT_SECRET", "")
 SHOPIFY_API_VERSION = os.getenv("SHOPIFY_API_VERSION", "2025-10")
+SHOPIFY_ADMIN_BASE_URL = os.getenv("SHOPIFY_ADMIN_BASE_URL", "").rstrip("/")
+SHOPIFY_REQUEST_TIMEOUT = float(os.getenv("SHOPIFY_REQUEST_TIMEOUT", "45"))
+SHOPIFY_MAX_RETRIES = int(os.getenv("SHOPIFY_MAX_RETRIES", "4"))
+SHOPIFY_BACKOFF_BASE = float(os.getenv("SHOPIFY_BACKOFF_BASE", "0.5"))
+SHOPIFY_BACKOFF_CAP = float(os.getenv("SHOPIFY_BACKOFF_CAP", "20"))
+SHOPIFY_BREAKER_THRESHOLD = int(os.getenv("SHOPIFY_BREAKER_THRESHOLD", "5"))
+SHOPIFY_BREAKER_COOLDOWN = float(os.getenv("SHOPIFY_BREAKER_COOLDOWN", "60"))
+SHOPIFY_CREDENTIAL_RECHECK_SECONDS = float(os.getenv("SHOPIFY_CREDENTIAL_RECHECK_SECONDS", "30"))
+SHOPIFY_BULK_POLL_INTERVAL = float(os.getenv("SHOPIFY_BULK_POLL_INTERVAL", "5"))
+SHOPIFY_BULK_BATCH_SIZE = int(os.getenv("SHOPIFY_BULK_BATCH_SIZE", "250"))
 WORKER_OFFLINE_THRESHOLD = int(os.getenv("WORKER_OFFLINE_THRESHOLD", "120"))
 SHOPIFY_SCOPES = os.getenv("SHOPIFY_SCOPES", "read_orders,read_products,read_customers,read_fulfillments,read_inventory,read_locations")
 SHOPIFY_REDIRECT_URI = os.getenv("SHOPIFY_REDIRECT_URI", "https://fulfillmentpro.up.railway.app/shopify/callback")
 SHOPIFY_WEBHOOK_BASE_URL = os.getenv("SHOPIFY_WEBHOOK_BASE_URL", "https://fulfillmentpro.up.railway.app").rstrip("/")
 PRODUCTS_JSON_PATH = os.getenv("PRODUCTS_JSON_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "products.json"))
-QUEUE_SHOPIFY_SYNC_INTERVAL = int(os.getenv("QUEUE_SHOPIFY_SYNC_INTERVAL", "20"))
-_queue_sync_lock = threading.Lock()
-_last_queue_shopify_sync_at = 0.0
+SHOPIFY_SYNC_OVERLAP_SECONDS = int(os.getenv("SHOPIFY_SYNC_OVERLAP_SECONDS", "60"))
+SHOPIFY_SYNC_PREFETCH_PAGES = int(os.getenv("SHOPIFY_SYNC_PREFETCH_PAGES", "2"))
+SYNC_LEASE_TTL = float(os.getenv("SYNC_LEASE_TTL", "60"))
+TASK_LEASE_TTL = float(os.getenv("TASK_LEASE_TTL", "300"))
+# Backoff per failure class: delay = min(base_seconds * 2 ** (attempts - 1), max_seconds) +/- jitter,
+# giving up (state 'failed') once a task has been claimed max_attempts times.
+TASK_RETRY_POLICY: dict[str, dict[str, float]] = {
+    "transient": {"base_seconds": 30, "max_seconds": 1800, "max_attempts": 6, "jitter": 0.1},
+    "payment": {"base_seconds": 900, "max_seconds": 21600, "max_attempts": 3, "jitter": 0.1},
+    "stock": {"base_seconds": 3600, "max_seconds": 86400, "max_attempts": 5, "jitter": 0.1},
+    "verification": {"base_seconds": 300, "max_seconds": 3600, "max_attempts": 3, "jitter": 0.1},
+}
+QUEUE_MAX_BATCH_SIZE = int(os.getenv("QUEUE_MAX_BATCH_SIZE", "25"))
+QUEUE_MAX_WAIT = float(os.getenv("QUEUE_MAX_WAIT", "30"))
+QUEUE_MAX_UPDATES = int(os.getenv("QUEUE_MAX_UPDATES", "200"))
+QUEUE_PRIORITY_REFRESH_SECONDS = float(os.getenv("QUEUE_PRIORITY_REFRESH_SECONDS", "60"))
+DEFAULT_QUEUE_PRIORITY_POLICY: dict[str, Any] = {
+    "value_weight": 1.0,  # points per $10 of current order total
+    "value_cap": 50,
+    "shipping_rules": {"overnight": 150, "next day": 150, "express": 100, "expedited": 100, "2-day": 80, "priority": 60},
+    "age_weight": 2.0,  # points per hour since the order was placed
+    "age_cap": 100,
+    "sla_hours": 24,  # orders older than this jump ahead by sla_boost
+    "sla_boost": 300,
+    "sku_rules": {},  # normalized SKU -> points
+    "shop_fairness_weight": 10.0,  # points per minute since a shop last had a task claimed
+}
+QUEUE_WAIT_POLL_INTERVAL = float(os.getenv("QUEUE_WAIT_POLL_INTERVAL", "1"))
+TASK_BATCH_GROUPS = {"order": "order_id", "asin": "asin"}
+SYNC_JOIN_TIMEOUT = float(os.getenv("SYNC_JOIN_TIMEOUT", "120"))
+SYNC_JOIN_POLL_INTERVAL = float(os.getenv("SYNC_JOIN_POLL_INTERVAL", "0.5"))
+SHOPIFY_SYNC_SHOP_CONCURRENCY = int(os.getenv("SHOPIFY_SYNC_SHOP_CONCURRENCY", "4"))
+SHOPIFY_SYNC_SCHEDULER = os.getenv("SHOPIFY_SYNC_SCHEDULER", "1").strip().lower() not in {"0", "false", "no", "off"}
+SYNC_SCHEDULER_MIN_INTERVAL = float(os.getenv("SYNC_SCHEDULER_MIN_INTERVAL", "15"))
+SYNC_SCHEDULER_MAX_INTERVAL = float(os.getenv("SYNC_SCHEDULER_MAX_INTERVAL", "300"))
+SYNC_SCHEDULER_MAX_PAGES = int(os.getenv("SYNC_SCHEDULER_MAX_PAGES", "5"))
+SYNC_SCHEDULER_LEASE_TTL = float(os.getenv("SYNC_SCHEDULER_LEASE_TTL", "30"))
+WEBHOOK_HEALTHY_WINDOW = int(os.getenv("WEBHOOK_HEALTHY_WINDOW", "1800"))
+WEBHOOK_INBOX_CONSUMER = os.getenv("WEBHOOK_INBOX_CONSUMER", "1").strip().lower() not in {"0", "false", "no", "off"}
+WEBHOOK_INBOX_BATCH_SIZE = int(os.getenv("WEBHOOK_INBOX_BATCH_SIZE", "100"))
+WEBHOOK_INBOX_POLL_INTERVAL = float(os.getenv("WEBHOOK_INBOX_POLL_INTERVAL", "1"))
+WEBHOOK_INBOX_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_INBOX_MAX_ATTEMPTS", "5"))
+WEBHOOK_INBOX_RETRY_BASE = float(os.getenv("WEBHOOK_INBOX_RETRY_BASE", "5"))
+WEBHOOK_INBOX_CLAIM_TIMEOUT = float(os.getenv("WEBHOOK_INBOX_CLAIM_TIMEOUT", "120"))
+WEBHOOK_DEDUP_WINDOW = float(os.getenv("WEBHOOK_DEDUP_WINDOW", "86400"))
+WEBHOOK_INBOX_PRUNE_INTERVAL = float(os.getenv("WEBHOOK_INBOX_PRUNE_INTERVAL", str(WEBHOOK_DEDUP_WINDOW)))
 
 ORDER_COLUMNS = {
     "financial_status": "TEXT", "fulfillment_status": "TEXT", "delivery_status": "TEXT",
@@ -47,10 +116,23 @@ ORDER_COLUMNS = {
     "cancelled_at": "TEXT", "closed_at": "TEXT", "processed_at": "TEXT",
     "shipping_method": "TEXT", "tracking_company": "TEXT", "tracking_number": "TEXT",
     "tracking_url": "TEXT", "tags": "TEXT DEFAULT '[]'", "item_count": "INTEGER DEFAULT 0",
-    "shopify_updated_at": "TEXT", "synced_at": "TEXT"
+    "shopify_updated_at": "TEXT", "synced_at": "TEXT", "content_hash": "TEXT", "shop_domain": "TEXT",
+    "fulfillment_updated_at": "TEXT", "fulfilled_at": "TEXT"
 }
 LINE_ITEM_COLUMNS = {
-    "shopify_product_id": "TEXT", "shopify_variant_id": "TEXT", "image_url": "TEXT", "vendor": "TEXT"
+    "shopify_product_id": "TEXT", "shopify_variant_id": "TEXT", "image_url": "TEXT", "vendor": "TEXT",
+    "sku_norm": "TEXT", "product_updated_at": "TEXT"
+}
+PRODUCT_COLUMNS = {"sku_norm": "TEXT"}
+TASK_COLUMNS = {"shop_domain": "TEXT", "lease_owner": "TEXT", "lease_expires_at": "REAL", "attempts": "INTEGER DEFAULT 0", "batch_id": "TEXT", "priority": "INTEGER",
+                "next_attempt_at": "REAL", "failure_class": "TEXT"}
+BULK_OPERATION_COLUMNS = {"shop_domain": "TEXT"}
+SYNC_LEASE_COLUMNS = {"args": "TEXT"}
+SYNC_RUN_COLUMNS = {
+    "mode": "TEXT", "pages": "INTEGER DEFAULT 0", "high_water_mark": "TEXT", "unchanged": "INTEGER DEFAULT 0",
+    "shopify_requests": "INTEGER DEFAULT 0", "shopify_retries": "INTEGER DEFAULT 0",
+    "shopify_throttled": "INTEGER DEFAULT 0", "shopify_cost": "REAL DEFAULT 0", "result": "TEXT",
+    "max_pages": "INTEGER", "cancel_requested": "INTEGER DEFAULT 0", "shop_domain": "TEXT"
 }
 
 
@@ -58,12 +140,150 @@ def utcnow() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
+def normalize_shop_domain(shop: Any) -> str:
+    return str(shop or "").replace("https://", "").replace("http://", "").strip().rstrip("/").lower()
+
+
+class PooledConnection(sqlite3.Connection):
+    """SQLite connection whose close() hands it back to its pool."""
+
+    def close(self) -> None:
+        pool = getattr(self, "_pool", None)
+        if pool is None:
+            super().close()
+            return
+        pool.release(self)
+
+    def discard(self) -> None:
+        super().close()
+
+
+class ConnectionPool:
+    """
+    Reuse SQLite connections across requests.
+
+    Callers keep the get_db()/close() contract. Released connections are
+    rolled back and parked; a thread preferentially gets back the connection it
+    last used, so a gthread worker settles on one warm connection. PRAGMAs run
+    once, when the connection is opened.
+    """
+
+    def __init__(self, path: str, max_size: int, wait_timeout: float) -> None:
+        self.path = path
+        self.max_size = max(1, max_size)
+        self.wait_timeout = max(0.0, wait_timeout)
+        self._idle: list[PooledConnection] = []
+        self._open = 0
+        self._condition = threading.Condition()
+        self._stats = {"hits": 0, "affinity_hits": 0, "opens": 0, "waits": 0, "wait_timeouts": 0, "overflow": 0, "releases": 0, "discarded": 0}
+
+    def _connect(self, pooled: bool) -> PooledConnection:
+        conn = sqlite3.connect(self.path, timeout=30, factory=PooledConnection, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA cache_size = {SQLITE_CACHE_SIZE}")
+        conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn._pool = self if pooled else None
+        conn._owner_thread = None
+        conn._checked_out = True
+        conn._finalizer = weakref.finalize(conn, self._forget) if pooled else None
+        return conn
+
+    def _forget(self) -> None:
+        # A checked-out connection was garbage collected without close().
+        with self._condition:
+            self._open = max(0, self._open - 1)
+            self._stats["discarded"] += 1
+            self._condition.notify()
+
+    def _take_idle(self) -> PooledConnection | None:
+        if not self._idle:
+            return None
+        ident = threading.get_ident()
+        for index in range(len(self._idle) - 1, -1, -1):
+            if self._idle[index]._owner_thread == ident:
+                self._stats["affinity_hits"] += 1
+                return self._idle.pop(index)
+        return self._idle.pop()
+
+    def acquire(self) -> PooledConnection:
+        deadline = None
+        with self._condition:
+            while True:
+                conn = self._take_idle()
+                if conn is not None:
+                    self._stats["hits"] += 1
+                    conn._checked_out = True
+                    return conn
+                if self._open < self.max_size:
+                    self._open += 1
+                    self._stats["opens"] += 1
+                    break
+                if deadline is None:
+                    deadline = time.monotonic() + self.wait_timeout
+                    self._stats["waits"] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # Nested get_db() calls must never deadlock on a full pool.
+                    self._stats["wait_timeouts"] += 1
+                    self._stats["overflow"] += 1
+                    return self._connect(pooled=False)
+                self._condition.wait(remaining)
+        try:
+            return self._connect(pooled=True)
+        except Exception:
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, conn: PooledConnection) -> None:
+        if not conn._checked_out:
+            return
+        conn._checked_out = False
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Account for the connection here, so its finalizer must not do it again.
+            conn._finalizer.detach()
+            with self._condition:
+                self._open -= 1
+                self._stats["discarded"] += 1
+                self._condition.notify()
+            conn._pool = None
+            conn.discard()
+            return
+        conn._owner_thread = threading.get_ident()
+        with self._condition:
+            self._stats["releases"] += 1
+            self._idle.append(conn)
+            self._condition.notify()
+
+    def stats(self) -> dict[str, Any]:
+        with self._condition:
+            return {
+                **self._stats,
+                "open": self._open,
+                "idle": len(self._idle),
+                "in_use": self._open - len(self._idle),
+                "max_size": self.max_size,
+                "settings": {
+                    "synchronous": SQLITE_SYNCHRONOUS,
+                    "cache_size": SQLITE_CACHE_SIZE,
+                    "mmap_size": SQLITE_MMAP_SIZE,
+                },
+            }
+
+
+DB_POOL = ConnectionPool(DATABASE_PATH, SQLITE_POOL_SIZE, SQLITE_POOL_WAIT_TIMEOUT)
+
+
 def get_db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DATABASE_PATH, timeout=30)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
-    conn.execute("PRAGMA journal_mode = WAL")
-    return conn
+    return DB_POOL.acquire()
 
 
 def add_missing_columns(conn: sqlite3.Connection, table: str, columns: dict[str, str]) -> None:
@@ -79,11 +299,94 @@ def normalize_sku(value: Any) -> str:
     return str(value or "").strip().upper()
 
 
-def load_products_json_payload() -> tuple[list[dict[str, Any]], str | None]:
+def get_app_state(conn: sqlite3.Connection, key: str, default: str | None = None) -> str | None:
+    row = conn.execute("SELECT value FROM app_state WHERE key=?", (key,)).fetchone()
+    return row["value"] if row and row["value"] is not None else default
+
+
+def set_app_state(conn: sqlite3.Connection, key: str, value: Any) -> None:
+    conn.execute(
+        "INSERT INTO app_state(key,value,updated_at) VALUES(?,?,?) "
+        "ON CONFLICT(key) DO UPDATE SET value=excluded.value,updated_at=excluded.updated_at",
+        (key, None if value is None else str(value), utcnow()),
+    )
+
+
+def increment_app_state(conn: sqlite3.Connection, key: str, amount: int = 1) -> None:
+    conn.execute(
+        "INSERT INTO app_state(key,value,updated_at) VALUES(?,?,?) "
+        "ON CONFLICT(key) DO UPDATE SET value=CAST(value AS INTEGER)+excluded.value,updated_at=excluded.updated_at",
+        (key, str(amount), utcnow()),
+    )
+
+
+_queue_changed = threading.Condition()
+_queue_signal = 0
+
+
+def notify_queue_changed() -> None:
+    """Wake this process's long-polling workers; call after committing work that may have queued tasks."""
+    global _queue_signal
+    with _queue_changed:
+        _queue_signal += 1
+        _queue_changed.notify_all()
+
+
+def wait_for_queue_signal(seen: int, timeout: float) -> int:
+    """Block until notify_queue_changed runs after seen, or timeout; returns the current signal."""
+    with _queue_changed:
+        _queue_changed.wait_for(lambda: _queue_signal != seen, timeout)
+        return _queue_signal
+
+
+class CatalogVersionTracker:
+    """
+    Fingerprint products.json by mtime, size and content hash.
+
+    The file is only re-read and re-hashed when its stat fingerprint moves, so
+    an unchanged catalog costs one os.stat per poll.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._fingerprint: tuple[int, int] | None = None
+        self._content_hash: str | None = None
+        self._raw: bytes | None = None
+
+    def probe(self) -> dict[str, Any]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return {"content_hash": None, "raw": None, "error": f"products.json was not found at {self.path}"}
+        except OSError as exc:
+            return {"content_hash": None, "raw": None, "error": str(exc)}
+        fingerprint = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if fingerprint == self._fingerprint and self._content_hash:
+                return {"content_hash": self._content_hash, "raw": self._raw, "error": None, "mtime_ns": fingerprint[0], "size": fingerprint[1]}
+            try:
+                with open(self.path, "rb") as handle:
+                    raw = handle.read()
+            except OSError as exc:
+                return {"content_hash": None, "raw": None, "error": str(exc)}
+            self._fingerprint = fingerprint
+            self._content_hash = hashlib.sha256(raw).hexdigest()
+            self._raw = raw
+            return {"content_hash": self._content_hash, "raw": raw, "error": None, "mtime_ns": fingerprint[0], "size": fingerprint[1]}
+
+
+CATALOG_TRACKER = CatalogVersionTracker(PRODUCTS_JSON_PATH)
+
+
+def load_products_json_payload(raw: bytes | None = None) -> tuple[list[dict[str, Any]], str | None]:
     """Load the repository-root products.json without exposing secrets."""
     try:
-        with open(PRODUCTS_JSON_PATH, "r", encoding="utf-8") as handle:
-            payload = json.load(handle)
+        if raw is None:
+            with open(PRODUCTS_JSON_PATH, "r", encoding="utf-8") as handle:
+                payload = json.load(handle)
+        else:
+            payload = json.loads(raw.decode("utf-8"))
     except FileNotFoundError:
         return [], f"products.json was not found at {PRODUCTS_JSON_PATH}"
     except (OSError, ValueError, TypeError) as exc:
@@ -100,13 +403,13 @@ def load_products_json_payload() -> tuple[list[dict[str, Any]], str | None]:
     ], None
 
 
-def import_products_json_into_database(conn: sqlite3.Connection) -> dict[str, Any]:
+def import_products_json_into_database(conn: sqlite3.Connection, raw: bytes | None = None) -> dict[str, Any]:
     """
     Make the SQLite products table mirror the repository products.json catalog.
 
     This is idempotent and runs during application startup and queue repair.
     """
-    products, error = load_products_json_payload()
+    products, error = load_products_json_payload(raw)
     if error:
         return {"imported": 0, "error": error}
 
@@ -126,6 +429,7 @@ def import_products_json_into_database(conn: sqlite3.Connection) -> dict[str, An
             """
             INSERT INTO products(
               sku,
+              sku_norm,
               asin,
               amazon_url,
               product_name,
@@ -136,8 +440,9 @@ def import_products_json_into_database(conn: sqlite3.Connection) -> dict[str, An
               stock_status,
               notes
             )
-            VALUES(?,?,?,?,?,?,?,?,?,?)
+            VALUES(?,?,?,?,?,?,?,?,?,?,?)
             ON CONFLICT(sku) DO UPDATE SET
+              sku_norm=excluded.sku_norm,
               asin=excluded.asin,
               amazon_url=excluded.amazon_url,
               product_name=excluded.product_name,
@@ -149,6 +454,7 @@ def import_products_json_into_database(conn: sqlite3.Connection) -> dict[str, An
               notes=excluded.notes
             """,
             (
+                sku,
                 sku,
                 asin,
                 amazon_url,
@@ -170,81 +476,165 @@ def import_products_json_into_database(conn: sqlite3.Connection) -> dict[str, An
     }
 
 
+def backfill_normalized_skus(conn: sqlite3.Connection) -> int:
+    """Fill sku_norm for rows written before the column existed or by other tools."""
+    filled = 0
+    for table in ("products", "line_items"):
+        rows = conn.execute(f"SELECT id, sku FROM {table} WHERE sku_norm IS NULL").fetchall()
+        conn.executemany(
+            f"UPDATE {table} SET sku_norm=? WHERE id=?",
+            [(normalize_sku(row["sku"]), row["id"]) for row in rows],
+        )
+        filled += len(rows)
+    return filled
+
+
 def reconcile_task_mappings(conn: sqlite3.Connection) -> dict[str, int]:
     """
     Repair tasks after the products catalog changes.
 
     Existing queued/processing/purchased tasks are not reset. Only tasks that
     are currently blocked in needs_mapping are promoted when their SKU now has
-    an active catalog match.
+    an active catalog match. The repair is a single UPDATE joined on the
+    indexed sku_norm columns.
     """
-    repaired = 0
-    still_unmapped = 0
-
-    rows = conn.execute(
+    backfill_normalized_skus(conn)
+    repaired = conn.execute(
         """
-        SELECT
-          t.id,
-          li.sku
+        UPDATE tasks
+        SET
+          asin = p.asin,
+          amazon_url = p.amazon_url,
+          state = 'queued',
+          error_message = NULL,
+          last_action = 'Catalog mapping repaired',
+          updated_at = ?
+        FROM line_items li
+        JOIN products p ON p.sku_norm = li.sku_norm AND p.is_active = 1
+        WHERE tasks.state = 'needs_mapping'
+          AND li.id = tasks.line_item_id
+          AND li.sku_norm != ''
+        """,
+        (utcnow(),),
+    ).rowcount
+    still_unmapped = conn.execute(
+        """
+        SELECT COUNT(*)
         FROM tasks t
         JOIN line_items li ON li.id = t.line_item_id
         WHERE t.state = 'needs_mapping'
-        ORDER BY t.id
         """
-    ).fetchall()
+    ).fetchone()[0]
 
-    for row in rows:
-        sku = normalize_sku(row["sku"])
-        mapped = None
+    return {
+        "repaired": int(repaired or 0),
+        "still_unmapped": int(still_unmapped or 0),
+    }
 
-        if sku:
-            mapped = conn.execute(
-                """
-                SELECT asin, amazon_url
-                FROM products
-                WHERE UPPER(TRIM(sku)) = ?
-                  AND is_active = 1
-                LIMIT 1
-                """,
-                (sku,),
-            ).fetchone()
 
-        if mapped:
-            conn.execute(
-                """
-                UPDATE tasks
-                SET
-                  asin = ?,
-                  amazon_url = ?,
-                  state = 'queued',
-                  error_message = NULL,
-                  last_action = 'Catalog mapping repaired',
-                  updated_at = ?
-                WHERE id = ?
-                  AND state = 'needs_mapping'
-                """,
-                (
-                    mapped["asin"],
-                    mapped["amazon_url"],
-                    utcnow(),
-                    row["id"],
-                ),
-            )
-            repaired += 1
-        else:
-            still_unmapped += 1
+class CatalogSnapshot(NamedTuple):
+    """Immutable view of the active products table shared by every thread."""
 
-    return {
-        "repaired": repaired,
-        "still_unmapped": still_unmapped,
+    version: str | None
+    generation: str | None
+    by_sku: Mapping[str, Mapping[str, Any]]
+    by_asin: Mapping[str, Mapping[str, Any]]
+    built_at: str
+
+    def lookup(self, sku: Any = None, asin: Any = None) -> Mapping[str, Any] | None:
+        return self.by_sku.get(normalize_sku(sku)) or self.by_asin.get(normalize_sku(asin))
+
+
+_catalog_snapshot: CatalogSnapshot | None = None
+_catalog_snapshot_lock = threading.Lock()
+
+
+def _catalog_generation(conn: sqlite3.Connection) -> tuple[str | None, str | None]:
+    values = {
+        row["key"]: row["value"]
+        for row in conn.execute("SELECT key, value FROM app_state WHERE key IN ('catalog_version','catalog_generation')")
     }
+    return values.get("catalog_version"), values.get("catalog_generation")
+
+
+def get_catalog_snapshot(conn: sqlite3.Connection) -> CatalogSnapshot:
+    """
+    Return the process-wide catalog snapshot, rebuilding it only when the
+    catalog version or the trigger-maintained products generation moved.
+
+    Inside an open transaction the snapshot is built but not shared: it may
+    reflect uncommitted product writes whose generation a rollback would
+    hand to a different later write.
+    """
+    global _catalog_snapshot
+
+    version, generation = _catalog_generation(conn)
+    current = _catalog_snapshot
+    if current is not None and (current.version, current.generation) == (version, generation):
+        return current
+    if conn.in_transaction:
+        return _build_catalog_snapshot(conn, version, generation)
+
+    with _catalog_snapshot_lock:
+        current = _catalog_snapshot
+        if current is not None and (current.version, current.generation) == (version, generation):
+            return current
+        _catalog_snapshot = _build_catalog_snapshot(conn, version, generation)
+        return _catalog_snapshot
+
+
+def _build_catalog_snapshot(conn: sqlite3.Connection, version: str | None, generation: str | None) -> CatalogSnapshot:
+    by_sku: dict[str, Mapping[str, Any]] = {}
+    by_asin: dict[str, Mapping[str, Any]] = {}
+    for row in conn.execute("SELECT * FROM products WHERE is_active=1 ORDER BY id"):
+        product = MappingProxyType(dict(row))
+        sku = normalize_sku(row["sku"])
+        if sku:
+            by_sku.setdefault(sku, product)
+        asin = normalize_sku(row["asin"])
+        if asin:
+            by_asin.setdefault(asin, product)
+    return CatalogSnapshot(version, generation, MappingProxyType(by_sku), MappingProxyType(by_asin), utcnow())
+
+
+def bump_catalog_version(conn: sqlite3.Connection, content_hash: str) -> str:
+    """Record a new catalog version after any write to the products table."""
+    version = content_hash[:16]
+    set_app_state(conn, "catalog_version", version)
+    return version
+
 
+def refresh_catalog_and_task_mappings(conn: sqlite3.Connection, force: bool = False) -> dict[str, Any]:
+    """
+    Import products.json and repair needs_mapping tasks, but only when the
+    file content differs from the version already imported into this
+    database. Other processes sharing the database see the stored hash and
+    skip the import too.
+    """
+    probe = CATALOG_TRACKER.probe()
+    content_hash = probe["content_hash"]
+    imported_hash = get_app_state(conn, "catalog_source_hash")
+
+    unchanged = {"imported": 0, "skipped": 0, "error": probe["error"]}
+    if not force and (probe["error"] or content_hash == imported_hash):
+        return {
+            "changed": False,
+            "catalog_version": get_app_state(conn, "catalog_version"),
+            "catalog": unchanged,
+            "reconciliation": None,
+        }
 
-def refresh_catalog_and_task_mappings(conn: sqlite3.Connection) -> dict[str, Any]:
-    catalog = import_products_json_into_database(conn)
+    catalog = unchanged if probe["error"] else import_products_json_into_database(conn, probe["raw"])
     reconciliation = reconcile_task_mappings(conn)
+    version = get_app_state(conn, "catalog_version")
+    if not catalog.get("error"):
+        set_app_state(conn, "catalog_source_hash", content_hash)
+        version = bump_catalog_version(conn, content_hash)
     conn.commit()
+    notify_queue_changed()
     return {
+        "changed": True,
+        "catalog_version": version,
         "catalog": catalog,
         "reconciliation": reconciliation,
     }
@@ -315,6 +705,23 @@ def init_db() -> None:
       id INTEGER PRIMARY KEY CHECK(id=1), is_online INTEGER DEFAULT 0,
       last_heartbeat_at TEXT, last_error TEXT, last_action TEXT, last_offline_notification_at TEXT
     );
+    CREATE TABLE IF NOT EXISTS workers (
+      worker_id TEXT PRIMARY KEY,
+      first_seen_at TEXT NOT NULL,
+      last_heartbeat_at TEXT,
+      last_action TEXT,
+      last_error TEXT,
+      current_task_id INTEGER,
+      current_order_number TEXT,
+      current_customer_name TEXT,
+      current_product_name TEXT,
+      current_task_state TEXT,
+      current_task_started_at TEXT,
+      tasks_claimed INTEGER NOT NULL DEFAULT 0,
+      tasks_purchased INTEGER NOT NULL DEFAULT 0,
+      tasks_failed INTEGER NOT NULL DEFAULT 0,
+      last_offline_notification_at TEXT
+    );
     CREATE TABLE IF NOT EXISTS push_tokens (
       id INTEGER PRIMARY KEY AUTOINCREMENT, token TEXT UNIQUE NOT NULL, device_label TEXT, created_at TEXT
     );
@@ -328,6 +735,74 @@ def init_db() -> None:
       completed_at TEXT, status TEXT NOT NULL, imported INTEGER DEFAULT 0, updated INTEGER DEFAULT 0,
       error_message TEXT
     );
+    CREATE TABLE IF NOT EXISTS sync_leases (
+      name TEXT PRIMARY KEY,
+      owner TEXT NOT NULL,
+      run_id INTEGER,
+      acquired_at TEXT NOT NULL,
+      heartbeat_at REAL NOT NULL,
+      expires_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS webhook_inbox (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      webhook_id TEXT,
+      topic TEXT NOT NULL,
+      shop_domain TEXT,
+      payload TEXT NOT NULL,
+      status TEXT NOT NULL DEFAULT 'pending',
+      attempts INTEGER NOT NULL DEFAULT 0,
+      next_attempt_at REAL NOT NULL DEFAULT 0,
+      claimed_by TEXT,
+      claimed_at REAL,
+      last_error TEXT,
+      received_at TEXT NOT NULL,
+      received_epoch REAL NOT NULL,
+      processed_at TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_webhook_inbox_status ON webhook_inbox(status, next_attempt_at, id);
+    CREATE INDEX IF NOT EXISTS idx_webhook_inbox_webhook_id ON webhook_inbox(webhook_id);
+    CREATE TABLE IF NOT EXISTS order_refunds (
+      shopify_refund_id TEXT PRIMARY KEY,
+      order_id INTEGER NOT NULL REFERENCES orders(id) ON DELETE CASCADE,
+      amount REAL NOT NULL DEFAULT 0,
+      created_at TEXT,
+      received_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_order_refunds_order ON order_refunds(order_id);
+    CREATE TABLE IF NOT EXISTS task_transitions (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      task_id INTEGER NOT NULL,
+      from_state TEXT,
+      to_state TEXT NOT NULL,
+      worker_id TEXT,
+      at TEXT NOT NULL,
+      at_epoch REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_task_transitions_task ON task_transitions(task_id, id);
+    CREATE INDEX IF NOT EXISTS idx_task_transitions_at ON task_transitions(at_epoch);
+    CREATE INDEX IF NOT EXISTS idx_task_transitions_state_at ON task_transitions(to_state, at_epoch);
+    CREATE TABLE IF NOT EXISTS app_state (
+      key TEXT PRIMARY KEY,
+      value TEXT,
+      updated_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS shopify_bulk_operations (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      operation_id TEXT,
+      status TEXT NOT NULL,
+      url TEXT,
+      object_count INTEGER DEFAULT 0,
+      orders_ingested INTEGER DEFAULT 0,
+      orders_created INTEGER DEFAULT 0,
+      orders_updated INTEGER DEFAULT 0,
+      orders_unchanged INTEGER DEFAULT 0,
+      high_water_mark TEXT,
+      sync_run_id INTEGER,
+      error_message TEXT,
+      created_at TEXT NOT NULL,
+      updated_at TEXT NOT NULL,
+      completed_at TEXT
+    );
     CREATE TABLE IF NOT EXISTS shopify_connections (
       id INTEGER PRIMARY KEY AUTOINCREMENT,
       shop_domain TEXT UNIQUE NOT NULL,
@@ -359,7 +834,115 @@ def init_db() -> None:
     """)
     add_missing_columns(conn, "orders", ORDER_COLUMNS)
     add_missing_columns(conn, "line_items", LINE_ITEM_COLUMNS)
+    add_missing_columns(conn, "products", PRODUCT_COLUMNS)
+    add_missing_columns(conn, "sync_runs", SYNC_RUN_COLUMNS)
+    add_missing_columns(conn, "tasks", TASK_COLUMNS)
+    add_missing_columns(conn, "shopify_bulk_operations", BULK_OPERATION_COLUMNS)
+    add_missing_columns(conn, "sync_leases", SYNC_LEASE_COLUMNS)
+    # Tasks left in processing before leases existed get one lease term to report
+    # back, after which the reaper requeues them like any other expired lease.
+    conn.execute(
+        "UPDATE tasks SET lease_expires_at=? WHERE state LIKE 'processing%' AND lease_expires_at IS NULL",
+        (time.time() + TASK_LEASE_TTL,),
+    )
+    conn.executescript("""
+    CREATE INDEX IF NOT EXISTS idx_products_sku_norm ON products(sku_norm, is_active);
+    CREATE INDEX IF NOT EXISTS idx_line_items_sku_norm ON line_items(sku_norm);
+    CREATE INDEX IF NOT EXISTS idx_line_items_product ON line_items(shopify_product_id);
+    CREATE INDEX IF NOT EXISTS idx_line_items_variant ON line_items(shopify_variant_id);
+    CREATE INDEX IF NOT EXISTS idx_orders_shop_created ON orders(shop_domain, created_at DESC);
+    CREATE INDEX IF NOT EXISTS idx_tasks_shop_state ON tasks(shop_domain, state, created_at);
+    CREATE INDEX IF NOT EXISTS idx_tasks_lease ON tasks(lease_expires_at) WHERE lease_expires_at IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS idx_tasks_retry_due ON tasks(next_attempt_at) WHERE state = 'retry_scheduled';
+    CREATE INDEX IF NOT EXISTS idx_tasks_failure_class ON tasks(state, failure_class);
+    CREATE INDEX IF NOT EXISTS idx_tasks_batch ON tasks(batch_id) WHERE batch_id IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS idx_tasks_asin_state ON tasks(asin, state, created_at);
+    CREATE INDEX IF NOT EXISTS idx_tasks_claim_order ON tasks(state, priority DESC, created_at, id);
+    CREATE INDEX IF NOT EXISTS idx_tasks_shop_claim_order ON tasks(shop_domain, state, priority DESC, created_at, id);
+    CREATE INDEX IF NOT EXISTS idx_sync_runs_shop ON sync_runs(shop_domain, status, id);
+    """)
+    default_shop = normalize_shop_domain(SHOPIFY_STORE_DOMAIN)
+    if default_shop:
+        for table in ("orders", "sync_runs", "shopify_bulk_operations"):
+            conn.execute(f"UPDATE {table} SET shop_domain=? WHERE shop_domain IS NULL", (default_shop,))
+    conn.execute("UPDATE tasks SET shop_domain=(SELECT o.shop_domain FROM orders o WHERE o.id=tasks.order_id) WHERE shop_domain IS NULL")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_shopify_connections_version_{event.lower()}
+        AFTER {event} ON shopify_connections
+        BEGIN
+          INSERT INTO app_state(key, value, updated_at)
+          VALUES('shopify_credentials_version', '1', strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+          ON CONFLICT(key) DO UPDATE SET
+            value = CAST(value AS INTEGER) + 1,
+            updated_at = excluded.updated_at;
+        END
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_products_generation_{event.lower()}
+        AFTER {event} ON products
+        BEGIN
+          INSERT INTO app_state(key, value, updated_at)
+          VALUES('catalog_generation', '1', strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+          ON CONFLICT(key) DO UPDATE SET
+            value = CAST(value AS INTEGER) + 1,
+            updated_at = excluded.updated_at;
+        END
+        """)
+    # queue_generation changes whenever a task becomes claimable, so long-polling
+    # workers in any process can notice new work with one primary-key read.
+    conn.executescript("""
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_queue_generation_insert
+    AFTER INSERT ON tasks WHEN NEW.state = 'queued'
+    BEGIN
+      INSERT INTO app_state(key, value, updated_at)
+      VALUES('queue_generation', '1', strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+      ON CONFLICT(key) DO UPDATE SET
+        value = CAST(value AS INTEGER) + 1,
+        updated_at = excluded.updated_at;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_queue_generation_update
+    AFTER UPDATE OF state ON tasks WHEN NEW.state = 'queued' AND OLD.state IS NOT 'queued'
+    BEGIN
+      INSERT INTO app_state(key, value, updated_at)
+      VALUES('queue_generation', '1', strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+      ON CONFLICT(key) DO UPDATE SET
+        value = CAST(value AS INTEGER) + 1,
+        updated_at = excluded.updated_at;
+    END;
+    """)
+    # Every task state change is appended to task_transitions, whichever code path
+    # wrote it; the worker is the lease holder on either side of the change.
+    conn.executescript("""
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_transition_insert
+    AFTER INSERT ON tasks
+    BEGIN
+      INSERT INTO task_transitions(task_id, from_state, to_state, worker_id, at, at_epoch)
+      VALUES(NEW.id, NULL, NEW.state, NEW.lease_owner, strftime('%Y-%m-%dT%H:%M:%fZ', 'now'), (julianday('now') - 2440587.5) * 86400.0);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_transition_update
+    AFTER UPDATE OF state ON tasks WHEN NEW.state IS NOT OLD.state
+    BEGIN
+      INSERT INTO task_transitions(task_id, from_state, to_state, worker_id, at, at_epoch)
+      VALUES(NEW.id, OLD.state, NEW.state, COALESCE(NEW.lease_owner, OLD.lease_owner),
+        strftime('%Y-%m-%dT%H:%M:%fZ', 'now'), (julianday('now') - 2440587.5) * 86400.0);
+    END;
+    """)
+    backfill_normalized_skus(conn)
     ensure_worker_runtime_columns(conn)
+    # Carry the single-bot worker_status row over as the default worker id.
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO workers(worker_id,first_seen_at,last_heartbeat_at,last_action,last_error,current_task_id,
+          current_order_number,current_customer_name,current_product_name,current_task_state,current_task_started_at,
+          last_offline_notification_at)
+        SELECT 'worker',COALESCE(last_heartbeat_at,?),last_heartbeat_at,last_action,last_error,current_task_id,
+          current_order_number,current_customer_name,current_product_name,current_task_state,current_task_started_at,
+          last_offline_notification_at
+        FROM worker_status WHERE id=1 AND last_heartbeat_at IS NOT NULL AND NOT EXISTS(SELECT 1 FROM workers)
+        """,
+        (utcnow(),),
+    )
     refresh_catalog_and_task_mappings(conn)
     conn.commit()
     conn.close()
@@ -430,22 +1013,116 @@ def save_shopify_connection(shop: str, access_token: str, granted_scopes: str =
       (shop.lower(), access_token, granted_scopes, now, now))
     conn.commit()
     conn.close()
+    SHOPIFY_CREDENTIALS.invalidate()
+
+
+class ShopifyCredentialCache:
+    """
+    Process-local copy of shopify_connections.
+
+    All connections are loaded in one query and served from memory.
+    save_shopify_connection drops the copy in this process; other processes
+    see the shopify_credentials_version counter, bumped by triggers on the
+    table, move when they recheck it, at most every
+    SHOPIFY_CREDENTIAL_RECHECK_SECONDS.
+    """
+
+    def __init__(self, recheck_seconds: float) -> None:
+        self.recheck_seconds = max(0.0, recheck_seconds)
+        self._lock = threading.Lock()
+        self._connections: dict[str, dict[str, Any]] | None = None
+        self._version: str | None = None
+        self._checked_at = 0.0
+        self._stats = {"hits": 0, "loads": 0, "version_checks": 0, "invalidations": 0}
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._connections = None
+            self._stats["invalidations"] += 1
+
+    def _current(self) -> dict[str, dict[str, Any]]:
+        with self._lock:
+            now = time.monotonic()
+            if self._connections is not None and now - self._checked_at < self.recheck_seconds:
+                self._stats["hits"] += 1
+                return self._connections
+            conn = get_db()
+            try:
+                version = get_app_state(conn, "shopify_credentials_version", "0")
+                self._stats["version_checks"] += 1
+                if self._connections is None or version != self._version:
+                    self._connections = {
+                        row["shop_domain"]: dict(row)
+                        for row in conn.execute("SELECT shop_domain,access_token,granted_scopes,installed_at,updated_at FROM shopify_connections")
+                    }
+                    self._version = version
+                    self._stats["loads"] += 1
+            finally:
+                conn.close()
+            self._checked_at = now
+            return self._connections
+
+    def get(self, shop: str) -> dict[str, Any] | None:
+        connection = self._current().get(shop)
+        return dict(connection) if connection else None
+
+    def shops(self) -> list[str]:
+        return sorted(self._current())
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {**self._stats, "version": self._version, "cached_shops": len(self._connections or {})}
+
+
+SHOPIFY_CREDENTIALS = ShopifyCredentialCache(SHOPIFY_CREDENTIAL_RECHECK_SECONDS)
+
+
+_shopify_call_context = threading.local()
+
+
+def current_shop() -> str:
+    """Shop this thread is working for: the shopify_shop() context, else SHOPIFY_STORE_DOMAIN."""
+    return getattr(_shopify_call_context, "shop", None) or normalize_shop_domain(SHOPIFY_STORE_DOMAIN)
+
+
+@contextmanager
+def shopify_shop(shop: str | None):
+    """Route Shopify calls and order writes on this thread to one shop."""
+    previous = getattr(_shopify_call_context, "shop", None)
+    _shopify_call_context.shop = normalize_shop_domain(shop) or None
+    try:
+        yield current_shop()
+    finally:
+        _shopify_call_context.shop = previous
+
+
+def configured_shops() -> list[str]:
+    """Every shop with an OAuth connection, plus SHOPIFY_STORE_DOMAIN."""
+    shops = SHOPIFY_CREDENTIALS.shops()
+    default = normalize_shop_domain(SHOPIFY_STORE_DOMAIN)
+    if default and default not in shops:
+        shops.insert(0, default)
+    return shops
+
+
+def request_shop() -> str | None:
+    """The ?shop= filter of the current request; None means every shop."""
+    return normalize_shop_domain(request.args.get("shop")) or None
 
 
 def get_shopify_connection(shop: str | None = None) -> dict[str, Any] | None:
-    target = str(shop or SHOPIFY_STORE_DOMAIN or "").strip().lower()
+    target = normalize_shop_domain(shop) or current_shop()
     if not target:
         return None
-    conn = get_db()
-    row = conn.execute("SELECT shop_domain,access_token,granted_scopes,installed_at,updated_at FROM shopify_connections WHERE shop_domain=? LIMIT 1", (target,)).fetchone()
-    conn.close()
-    return dict(row) if row else None
+    return SHOPIFY_CREDENTIALS.get(target)
 
 
 def get_shopify_access_token(shop: str | None = None) -> str:
     connection = get_shopify_connection(shop)
     if connection and connection.get("access_token"):
         return str(connection["access_token"])
+    if (normalize_shop_domain(shop) or current_shop()) != normalize_shop_domain(SHOPIFY_STORE_DOMAIN):
+        return ""
     return SHOPIFY_ADMIN_ACCESS_TOKEN
 
 
@@ -469,6 +1146,15 @@ def shipping_name(address: dict[str, Any]) -> str:
     return " ".join(filter(None, [address.get("firstName") or address.get("first_name"), address.get("lastName") or address.get("last_name")])).strip()
 
 
+def refund_amount(refund: dict[str, Any]) -> float:
+    """Money actually returned by a REST refund: its successful refund transactions."""
+    return round(sum(
+        float(txn.get("amount") or 0)
+        for txn in refund.get("transactions") or []
+        if txn.get("kind") == "refund" and txn.get("status") in (None, "success")
+    ), 2)
+
+
 def normalize_rest_order(order: dict[str, Any]) -> dict[str, Any]:
     address = order.get("shipping_address") or {}
     fulfillments = order.get("fulfillments") or []
@@ -480,7 +1166,7 @@ def normalize_rest_order(order: dict[str, Any]) -> dict[str, Any]:
       "total_price": float(order.get("current_total_price") or order.get("total_price") or 0),
       "subtotal_price": float(order.get("current_subtotal_price") or order.get("subtotal_price") or 0),
       "current_total_price": float(order.get("current_total_price") or order.get("total_price") or 0),
-      "refunds_total": 0.0, "currency": order.get("currency") or "USD", "created_at": order.get("created_at") or utcnow(),
+      "refunds_total": sum(refund_amount(refund) for refund in order.get("refunds") or []), "currency": order.get("currency") or "USD", "created_at": order.get("created_at") or utcnow(),
       "updated_at": utcnow(), "shopify_updated_at": order.get("updated_at"), "processed_at": order.get("processed_at"),
       "cancelled_at": order.get("cancelled_at"), "closed_at": order.get("closed_at"),
       "financial_status": str(order.get("financial_status") or "UNKNOWN").upper(),
@@ -516,38 +1202,157 @@ def normalize_graphql_order(node: dict[str, Any]) -> dict[str, Any]:
     }
 
 
-def upsert_order(conn: sqlite3.Connection, order: dict[str, Any], create_tasks: bool = True) -> tuple[int, bool]:
-    existing = conn.execute("SELECT id FROM orders WHERE shopify_order_id=?", (order["shopify_order_id"],)).fetchone()
-    fields = [k for k in order if k != "line_items"]
-    if existing:
-        order_id = int(existing["id"])
-        editable = [f for f in fields if f != "shopify_order_id"]
-        conn.execute("UPDATE orders SET " + ",".join(f"{f}=?" for f in editable) + " WHERE id=?", [order[f] for f in editable] + [order_id])
-        created = False
-    else:
-        conn.execute(f"INSERT INTO orders({','.join(fields)}) VALUES({','.join('?' for _ in fields)})", [order[f] for f in fields])
-        order_id = int(conn.execute("SELECT last_insert_rowid()").fetchone()[0])
-        created = True
-    products = {
-        normalize_sku(row["sku"]): dict(row)
+ORDER_HASH_EXCLUDED_FIELDS = {"updated_at", "synced_at", "content_hash", "shop_domain"}
+LINE_ITEM_UPSERT_SQL = """INSERT INTO line_items(order_id,shopify_line_item_id,title,variant_title,sku,sku_norm,quantity,price,shopify_product_id,shopify_variant_id,image_url,vendor)
+  VALUES(?,?,?,?,?,?,?,?,?,?,?,?) ON CONFLICT(order_id,shopify_line_item_id) DO UPDATE SET title=excluded.title,variant_title=excluded.variant_title,sku=excluded.sku,sku_norm=excluded.sku_norm,quantity=excluded.quantity,price=excluded.price,shopify_product_id=excluded.shopify_product_id,shopify_variant_id=excluded.shopify_variant_id,
+    image_url=CASE WHEN product_updated_at IS NULL THEN COALESCE(excluded.image_url,image_url) ELSE COALESCE(image_url,excluded.image_url) END,
+    vendor=CASE WHEN product_updated_at IS NULL THEN COALESCE(excluded.vendor,vendor) ELSE COALESCE(vendor,excluded.vendor) END"""
+
+
+def parse_shopify_time(value: Any) -> datetime | None:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def order_content_hash(order: dict[str, Any]) -> str:
+    """Hash everything Shopify sent for an order except our own bookkeeping timestamps."""
+    payload = {key: value for key, value in order.items() if key not in ORDER_HASH_EXCLUDED_FIELDS}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _order_is_unchanged(stored: sqlite3.Row, order: dict[str, Any]) -> bool:
+    if stored["content_hash"] and stored["content_hash"] == order["content_hash"]:
+        return True
+    stored_at = parse_shopify_time(stored["shopify_updated_at"])
+    incoming_at = parse_shopify_time(order.get("shopify_updated_at"))
+    return bool(stored_at and incoming_at and stored_at == incoming_at and stored["content_hash"])
+
+
+def _order_is_stale(stored: sqlite3.Row, order: dict[str, Any]) -> bool:
+    stored_at = parse_shopify_time(stored["shopify_updated_at"])
+    incoming_at = parse_shopify_time(order.get("shopify_updated_at"))
+    return bool(stored_at and incoming_at and incoming_at < stored_at)
+
+
+def _line_item_values(order_id: int, idx: int, item: dict[str, Any]) -> tuple:
+    item_id = str(item.get("legacyResourceId") or item.get("id") or idx)
+    price = item.get("price")
+    if price is None:
+        price, _ = money(item, "originalUnitPriceSet")
+    product = item.get("product") or {}
+    variant = item.get("variant") or {}
+    image = item.get("image") or {}
+    return (order_id, item_id, item.get("title"), item.get("variant_title") or item.get("variantTitle"), item.get("sku"), normalize_sku(item.get("sku")), int(item.get("quantity") or 1), float(price or 0), str(product.get("id") or item.get("product_id") or ""), str(variant.get("id") or item.get("variant_id") or ""), image.get("url"), product.get("vendor") or item.get("vendor"))
+
+
+def _write_orders(conn: sqlite3.Connection, orders: list[dict[str, Any]], create_tasks: bool = True) -> list[dict[str, Any]]:
+    """
+    Upsert a page of normalized orders with a handful of statements.
+
+    Orders whose content hash (or Shopify updated_at) matches the stored row
+    are skipped entirely, so re-reading an unchanged page writes nothing.
+    The first write that sees an order as FULFILLED stamps fulfilled_at
+    with its Shopify updated_at; later writes leave it alone.
+    Orders older than the stored Shopify updated_at are reported as "stale"
+    and dropped, so a late webhook or a lagging sync page cannot roll an
+    order back. Returns one {"order_id", "status"} entry per input order.
+    """
+    if not orders:
+        return []
+    prepared: dict[str, dict[str, Any]] = {}
+    stale_count = 0
+    for order in orders:
+        row = dict(order)
+        row["shopify_order_id"] = str(row["shopify_order_id"])
+        row["content_hash"] = order_content_hash(row)
+        row["shop_domain"] = normalize_shop_domain(row.get("shop_domain")) or current_shop() or None
+        previous = prepared.get(row["shopify_order_id"])
+        if previous is not None:
+            stale_count += 1
+            previous_at = parse_shopify_time(previous.get("shopify_updated_at"))
+            incoming_at = parse_shopify_time(row.get("shopify_updated_at"))
+            if previous_at and incoming_at and incoming_at < previous_at:
+                continue
+        prepared[row["shopify_order_id"]] = row
+
+    placeholders = ",".join("?" for _ in prepared)
+    stored = {
+        row["shopify_order_id"]: row
         for row in conn.execute(
-            "SELECT * FROM products WHERE is_active=1"
+            f"SELECT id, shopify_order_id, shopify_updated_at, content_hash FROM orders WHERE shopify_order_id IN ({placeholders})",
+            list(prepared),
         )
     }
-    for idx, item in enumerate(order.get("line_items") or []):
-        item_id = str(item.get("legacyResourceId") or item.get("id") or idx)
-        price = item.get("price")
-        if price is None:
-            price, _ = money(item, "originalUnitPriceSet")
-        product = item.get("product") or {}
-        variant = item.get("variant") or {}
-        image = item.get("image") or {}
-        values = (order_id, item_id, item.get("title"), item.get("variant_title") or item.get("variantTitle"), item.get("sku"), int(item.get("quantity") or 1), float(price or 0), str(product.get("id") or ""), str(variant.get("id") or ""), image.get("url"), product.get("vendor"))
-        conn.execute("""INSERT INTO line_items(order_id,shopify_line_item_id,title,variant_title,sku,quantity,price,shopify_product_id,shopify_variant_id,image_url,vendor)
-          VALUES(?,?,?,?,?,?,?,?,?,?,?) ON CONFLICT(order_id,shopify_line_item_id) DO UPDATE SET title=excluded.title,variant_title=excluded.variant_title,sku=excluded.sku,quantity=excluded.quantity,price=excluded.price,shopify_product_id=excluded.shopify_product_id,shopify_variant_id=excluded.shopify_variant_id,image_url=excluded.image_url,vendor=excluded.vendor""", values)
-        line_id = conn.execute("SELECT id FROM line_items WHERE order_id=? AND shopify_line_item_id=?", (order_id, item_id)).fetchone()[0]
-        if create_tasks:
-            sku = normalize_sku(item.get("sku"))
+
+    outcome: dict[str, dict[str, Any]] = {}
+    updates: dict[tuple[str, ...], list[list[Any]]] = {}
+    changed: list[tuple[int, dict[str, Any]]] = []
+    for shopify_order_id, order in prepared.items():
+        existing = stored.get(shopify_order_id)
+        fields = tuple(k for k in order if k != "line_items")
+        if existing is not None:
+            order_id = int(existing["id"])
+            if _order_is_unchanged(existing, order):
+                outcome[shopify_order_id] = {"order_id": order_id, "status": "unchanged"}
+                continue
+            if _order_is_stale(existing, order):
+                outcome[shopify_order_id] = {"order_id": order_id, "status": "stale"}
+                stale_count += 1
+                continue
+            editable = tuple(f for f in fields if f != "shopify_order_id")
+            updates.setdefault(editable, []).append([order[f] for f in editable] + [order_id])
+            outcome[shopify_order_id] = {"order_id": order_id, "status": "updated"}
+        else:
+            order_id = int(conn.execute(
+                f"INSERT INTO orders({','.join(fields)}) VALUES({','.join('?' for _ in fields)}) RETURNING id",
+                [order[f] for f in fields],
+            ).fetchone()[0])
+            outcome[shopify_order_id] = {"order_id": order_id, "status": "created"}
+        changed.append((order_id, order))
+
+    if stale_count:
+        increment_app_state(conn, "orders_stale_dropped", stale_count)
+    for editable, rows in updates.items():
+        conn.executemany("UPDATE orders SET " + ",".join(f"{f}=?" for f in editable) + " WHERE id=?", rows)
+    fulfilled = [
+        (_utc_timestamp(order.get("shopify_updated_at")) or utcnow(), order_id)
+        for order_id, order in changed
+        if str(order.get("fulfillment_status") or "").upper() == "FULFILLED"
+    ]
+    if fulfilled:
+        conn.executemany("UPDATE orders SET fulfilled_at=? WHERE id=? AND fulfilled_at IS NULL", fulfilled)
+
+    line_rows = [
+        _line_item_values(order_id, idx, item)
+        for order_id, order in changed
+        for idx, item in enumerate(order.get("line_items") or [])
+    ]
+    if line_rows:
+        conn.executemany(LINE_ITEM_UPSERT_SQL, line_rows)
+
+    if create_tasks and line_rows:
+        order_ids = sorted({order_id for order_id, _ in changed})
+        line_ids = {
+            (row["order_id"], row["shopify_line_item_id"]): row["id"]
+            for row in conn.execute(
+                f"SELECT id, order_id, shopify_line_item_id FROM line_items WHERE order_id IN ({','.join('?' for _ in order_ids)})",
+                order_ids,
+            )
+        }
+        products = get_catalog_snapshot(conn).by_sku
+        policy = queue_priority_policy(conn)
+        orders_by_id = dict(changed)
+        shopify_ids = {order_id: order["shopify_order_id"] for order_id, order in changed}
+        shops = {order_id: order["shop_domain"] for order_id, order in changed}
+        task_rows = []
+        now = utcnow()
+        for values in line_rows:
+            order_id, item_id, sku, quantity = values[0], values[1], values[5], values[6]
             mapped = products.get(sku)
             state = "queued" if mapped else "needs_mapping"
             error = (
@@ -559,217 +1364,2010 @@ def upsert_order(conn: sqlite3.Connection, order: dict[str, Any], create_tasks:
                     else f"SKU {sku} not in products.json catalog"
                 )
             )
-            conn.execute("""INSERT OR IGNORE INTO tasks(unique_key,order_id,line_item_id,asin,amazon_url,quantity,state,error_message,created_at,updated_at)
-              VALUES(?,?,?,?,?,?,?,?,?,?)""", (f'{order["shopify_order_id"]}:{item_id}', order_id, line_id, sku or None, mapped.get("amazon_url") if mapped else None, int(item.get("quantity") or 1), state, error, utcnow(), utcnow()))
-    return order_id, created
+            order = orders_by_id[order_id]
+            priority = task_priority(policy, order.get("current_total_price"), order.get("shipping_method"), order.get("created_at"), sku)
+            task_rows.append((f"{shopify_ids[order_id]}:{item_id}", order_id, line_ids[(order_id, item_id)], sku or None, mapped.get("amazon_url") if mapped else None, quantity, state, error, now, now, shops[order_id], priority))
+        conn.executemany("""INSERT OR IGNORE INTO tasks(unique_key,order_id,line_item_id,asin,amazon_url,quantity,state,error_message,created_at,updated_at,shop_domain,priority)
+          VALUES(?,?,?,?,?,?,?,?,?,?,?,?)""", task_rows)
+
+    return [outcome[str(order["shopify_order_id"])] for order in orders]
+
+
+def upsert_orders(conn: sqlite3.Connection, orders: list[dict[str, Any]], create_tasks: bool = True) -> dict[str, Any]:
+    """Batch upsert; returns per-order results plus created/updated/unchanged/stale counts."""
+    results = _write_orders(conn, orders, create_tasks=create_tasks)
+    counts = {status: sum(1 for result in results if result["status"] == status) for status in ("created", "updated", "unchanged", "stale")}
+    return {**counts, "results": results}
+
+
+def upsert_order(conn: sqlite3.Connection, order: dict[str, Any], create_tasks: bool = True) -> tuple[int, bool]:
+    result = _write_orders(conn, [order], create_tasks=create_tasks)[0]
+    return result["order_id"], result["status"] == "created"
+
+
+SHOPIFY_ORDER_FIELDS = "id legacyResourceId name createdAt updatedAt processedAt cancelledAt closedAt email displayFinancialStatus displayFulfillmentStatus sourceName tags currentTotalPriceSet{shopMoney{amount currencyCode}} currentSubtotalPriceSet{shopMoney{amount currencyCode}} totalRefundedSet{shopMoney{amount currencyCode}} customer{displayName} shippingAddress{firstName lastName address1 address2 city province provinceCode zip country countryCodeV2 phone} shippingLine{title} fulfillments{status trackingInfo{company number url}}"
+SHOPIFY_LINE_ITEM_FIELDS = "id title variantTitle sku quantity originalUnitPriceSet{shopMoney{amount currencyCode}} image{url altText} product{id title vendor} variant{id title}"
+SHOPIFY_QUERY = "query Orders($cursor:String,$query:String,$sortKey:OrderSortKeys=CREATED_AT,$reverse:Boolean=true){orders(first:100,after:$cursor,reverse:$reverse,sortKey:$sortKey,query:$query){pageInfo{hasNextPage endCursor}nodes{" + SHOPIFY_ORDER_FIELDS + " lineItems(first:50){nodes{" + SHOPIFY_LINE_ITEM_FIELDS + "}}}}}"
+SHOPIFY_BULK_ORDERS_QUERY = "{orders(sortKey:CREATED_AT){edges{node{" + SHOPIFY_ORDER_FIELDS + " lineItems{edges{node{" + SHOPIFY_LINE_ITEM_FIELDS + "}}}}}}}"
+
+
+def shopify_admin_url(shop: str, path: str) -> str:
+    base = SHOPIFY_ADMIN_BASE_URL or f"https://{shop}"
+    return f"{base}/admin/api/{SHOPIFY_API_VERSION}/{path}"
+
+
+class ShopifyAPIError(RuntimeError):
+    def __init__(self, message: str, status: int | None = None, retryable: bool = False) -> None:
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+
+
+class ShopifyCircuitOpenError(ShopifyAPIError):
+    pass
+
+
+def new_cost_meter() -> dict[str, float]:
+    return {"requests": 0, "retries": 0, "throttled": 0, "requested_cost": 0.0, "actual_cost": 0.0}
+
+
+@contextmanager
+def shopify_metering(meter: dict[str, float]):
+    """Attribute Shopify calls made on this thread to one sync run's meter."""
+    previous = getattr(_shopify_call_context, "meter", None)
+    _shopify_call_context.meter = meter
+    try:
+        yield meter
+    finally:
+        _shopify_call_context.meter = previous
+
+
+class ShopifyClient:
+    """
+    Admin GraphQL client for one shop.
+
+    Keeps a pooled keep-alive requests.Session, tracks the leaky-bucket
+    throttleStatus Shopify returns in extensions.cost and waits for enough
+    budget before sending a query whose last cost would overdraw it. 429s,
+    5xx, network errors and THROTTLED responses are retried with jittered
+    exponential backoff; repeated exhausted calls open a circuit breaker that
+    fails fast until SHOPIFY_BREAKER_COOLDOWN has passed.
+    """
+
+    def __init__(self, shop: str) -> None:
+        self.shop = shop
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.sleep = time.sleep
+        self._lock = threading.Lock()
+        self._available: float | None = None
+        self._maximum: float | None = None
+        self._restore_rate: float | None = None
+        self._observed_at = 0.0
+        self._query_costs: dict[str, float] = {}
+        self._consecutive_failures = 0
+        self._opened_until = 0.0
+        self.metrics = {**new_cost_meter(), "circuit_rejections": 0, "paced_seconds": 0.0, "failures": 0}
+
+    def _count(self, key: str, amount: float = 1) -> None:
+        self.metrics[key] = self.metrics.get(key, 0) + amount
+        meter = getattr(_shopify_call_context, "meter", None)
+        if meter is not None and key in meter:
+            meter[key] += amount
+
+    def _observe(self, cost: dict[str, Any] | None) -> None:
+        status = (cost or {}).get("throttleStatus") or {}
+        if not status:
+            return
+        with self._lock:
+            self._available = float(status.get("currentlyAvailable") or 0)
+            self._maximum = float(status.get("maximumAvailable") or 0) or None
+            self._restore_rate = float(status.get("restoreRate") or 0) or None
+            self._observed_at = time.monotonic()
+
+    def _budget_wait(self, needed: float) -> float:
+        with self._lock:
+            if self._available is None or not self._restore_rate:
+                return 0.0
+            estimated = self._available + self._restore_rate * (time.monotonic() - self._observed_at)
+            if self._maximum:
+                estimated = min(estimated, self._maximum)
+            return max(0.0, (needed - estimated) / self._restore_rate)
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(SHOPIFY_BACKOFF_CAP, SHOPIFY_BACKOFF_BASE * (2 ** attempt)))
+
+    def _record_outcome(self, ok: bool) -> None:
+        with self._lock:
+            if ok:
+                self._consecutive_failures = 0
+                self._opened_until = 0.0
+                return
+            self._consecutive_failures += 1
+            if self._consecutive_failures >= SHOPIFY_BREAKER_THRESHOLD:
+                self._opened_until = time.monotonic() + SHOPIFY_BREAKER_COOLDOWN
+        self.metrics["failures"] += 1
+
+    def state(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "shop": self.shop,
+                "circuit_open": time.monotonic() < self._opened_until,
+                "consecutive_failures": self._consecutive_failures,
+                "currently_available": self._available,
+                "maximum_available": self._maximum,
+                "restore_rate": self._restore_rate,
+                "metrics": dict(self.metrics),
+            }
+
+    def execute(self, query: str, variables: dict[str, Any]) -> dict[str, Any]:
+        if time.monotonic() < self._opened_until:
+            self._count("circuit_rejections")
+            raise ShopifyCircuitOpenError(f"Shopify circuit breaker is open for {self.shop}; retrying after cooldown.")
+        access_token = get_shopify_access_token(self.shop)
+        if not self.shop or not access_token:
+            raise RuntimeError("Shopify is not connected. Complete OAuth installation or configure SHOPIFY_ADMIN_ACCESS_TOKEN.")
+        url = shopify_admin_url(self.shop, "graphql.json")
+        query_key = hashlib.sha1(query.encode()).hexdigest()
+        last_error: ShopifyAPIError | None = None
+
+        for attempt in range(SHOPIFY_MAX_RETRIES + 1):
+            if attempt:
+                self._count("retries")
+            wait = self._budget_wait(self._query_costs.get(query_key, 0.0))
+            if wait:
+                self._count("paced_seconds", wait)
+                self.sleep(wait)
+            self._count("requests")
+            delay = None
+            try:
+                response = self.session.post(url, headers={"X-Shopify-Access-Token": access_token, "Content-Type": "application/json"}, json={"query": query, "variables": variables}, timeout=SHOPIFY_REQUEST_TIMEOUT)
+            except requests.RequestException as exc:
+                last_error = ShopifyAPIError(f"Shopify request failed: {exc}", retryable=True)
+            else:
+                if response.status_code == 429 or response.status_code >= 500:
+                    last_error = ShopifyAPIError(f"Shopify returned HTTP {response.status_code}", status=response.status_code, retryable=True)
+                    if response.status_code == 429:
+                        self._count("throttled")
+                        try:
+                            delay = float(response.headers.get("Retry-After") or 0) or None
+                        except ValueError:
+                            delay = None
+                elif response.status_code >= 400:
+                    self._record_outcome(True)
+                    raise ShopifyAPIError(f"Shopify returned HTTP {response.status_code}", status=response.status_code)
+                else:
+                    payload = response.json()
+                    cost = (payload.get("extensions") or {}).get("cost") or {}
+                    self._observe(cost)
+                    if cost.get("requestedQueryCost") is not None:
+                        self._query_costs[query_key] = float(cost["requestedQueryCost"])
+                        self._count("requested_cost", float(cost["requestedQueryCost"]))
+                    if cost.get("actualQueryCost") is not None:
+                        self._count("actual_cost", float(cost["actualQueryCost"]))
+                    errors = payload.get("errors") or []
+                    if any(((error.get("extensions") or {}).get("code") == "THROTTLED") for error in errors):
+                        self._count("throttled")
+                        last_error = ShopifyAPIError("Shopify GraphQL request was throttled", status=200, retryable=True)
+                        delay = self._budget_wait(float(cost.get("requestedQueryCost") or 0)) or None
+                    elif errors:
+                        self._record_outcome(True)
+                        raise ShopifyAPIError(errors[0].get("message", "Shopify GraphQL error"))
+                    else:
+                        self._record_outcome(True)
+                        return payload["data"]
+            if attempt < SHOPIFY_MAX_RETRIES:
+                self.sleep(delay if delay is not None else self._backoff(attempt))
+
+        self._record_outcome(False)
+        raise ShopifyAPIError(f"{last_error} after {SHOPIFY_MAX_RETRIES + 1} attempts", status=last_error.status if last_error else None)
+
+
+_shopify_clients: dict[str, ShopifyClient] = {}
+_shopify_clients_lock = threading.Lock()
+
+
+def get_shopify_client(shop: str | None = None) -> ShopifyClient:
+    """One client, and so one GraphQL cost budget, per shop."""
+    target = normalize_shop_domain(shop) or current_shop()
+    with _shopify_clients_lock:
+        client = _shopify_clients.get(target)
+        if client is None:
+            client = _shopify_clients[target] = ShopifyClient(target)
+        return client
+
+
+def shopify_graphql(query: str, variables: dict[str, Any]) -> dict[str, Any]:
+    return get_shopify_client(current_shop()).execute(query, variables)
+
+
+class ShopifyPageFetcher(threading.Thread):
+    """
+    Producer half of the sync pipeline.
+
+    Follows endCursor on its own thread and hands pages to the writer through
+    a bounded queue, so the next GraphQL request overlaps the current page's
+    upsert. A full queue blocks the fetcher (backpressure); cancel() releases
+    it, and a fetch error is delivered to the writer in page order.
+    """
+
+    _DONE = object()
+
+    def __init__(self, variables: dict[str, Any], max_pages: int, depth: int = SHOPIFY_SYNC_PREFETCH_PAGES, meter: dict[str, float] | None = None) -> None:
+        super().__init__(name="shopify-page-fetcher", daemon=True)
+        self.meter = meter if meter is not None else new_cost_meter()
+        self.shop = current_shop()
+        self.variables = dict(variables)
+        self.max_pages = max_pages
+        self.pages: queue.Queue = queue.Queue(maxsize=max(1, depth))
+        self.cancelled = threading.Event()
+
+    def run(self) -> None:
+        try:
+            with shopify_shop(self.shop), shopify_metering(self.meter):
+                fetched = 0
+                while fetched < self.max_pages and not self.cancelled.is_set():
+                    connection = shopify_graphql(SHOPIFY_QUERY, dict(self.variables))["orders"]
+                    fetched += 1
+                    if not self._put(connection):
+                        return
+                    if not connection["pageInfo"]["hasNextPage"]:
+                        break
+                    self.variables["cursor"] = connection["pageInfo"]["endCursor"]
+            self._put(self._DONE)
+        except BaseException as exc:  # noqa: BLE001
+            self._put(exc)
+
+    def _put(self, item: Any) -> bool:
+        while not self.cancelled.is_set():
+            try:
+                self.pages.put(item, timeout=0.25)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def __iter__(self):
+        while True:
+            item = self.pages.get()
+            if item is self._DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+
+def last_sync_high_water_mark(conn: sqlite3.Connection, shop: str | None = None) -> str | None:
+    row = conn.execute(
+        """
+        SELECT high_water_mark
+        FROM sync_runs
+        WHERE shop_domain IS ? AND status IN ('success','cancelled') AND high_water_mark IS NOT NULL
+        ORDER BY id DESC
+        LIMIT 1
+        """,
+        (normalize_shop_domain(shop) or current_shop() or None,),
+    ).fetchone()
+    return row["high_water_mark"] if row else None
+
+
+def incremental_search_query(high_water_mark: str) -> str:
+    """Shopify search for orders updated since the mark, minus a small overlap."""
+    try:
+        mark = datetime.fromisoformat(high_water_mark.replace("Z", "+00:00"))
+        since = (mark - timedelta(seconds=SHOPIFY_SYNC_OVERLAP_SECONDS)).astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    except (ValueError, TypeError):
+        since = high_water_mark
+    return f"updated_at:>='{since}'"
+
+
+def sync_shopify_orders(search_query: str | None = None, max_pages: int = 25, mode: str = "incremental", on_run_started: Callable[[int], None] | None = None, run_id: int | None = None, shop: str | None = None) -> dict[str, Any]:
+    """
+    Pull orders from Shopify into SQLite.
+
+    mode="incremental" fetches only orders updated since the high-water mark
+    of the last successful run, oldest change first, so a page cap never
+    skips changes. mode="full" (or no previous mark) re-reads from the newest
+    order backwards. An explicit search_query is a one-off pull that does not
+    move the mark. on_run_started receives the sync_runs id once it exists.
+
+    Progress is written to the sync_runs row with every page, in the page's
+    transaction. Setting cancel_requested on the row stops the run after the
+    current page; a cancelled incremental run keeps the mark it reached. Pass
+    run_id to run a job row created by start_shopify_sync_job. shop defaults
+    to the current shop; its runs, orders and tasks are tagged with it.
+    """
+    with shopify_shop(shop or current_shop()) as shop:
+        conn = get_db()
+        previous_mark = last_sync_high_water_mark(conn, shop)
+        if search_query:
+            mode = "query"
+        elif mode != "full" and not previous_mark:
+            mode = "full"
+        elif mode != "full":
+            mode = "incremental"
+        variables: dict[str, Any] = {"cursor": None, "query": search_query, "sortKey": "CREATED_AT", "reverse": True}
+        if mode == "incremental":
+            variables.update({"query": incremental_search_query(previous_mark), "sortKey": "UPDATED_AT", "reverse": False})
+
+        if run_id is None:
+            run_id = conn.execute("INSERT INTO sync_runs(source,started_at,status,mode,max_pages,shop_domain) VALUES('shopify',?,'running',?,?,?)", (utcnow(), mode, max_pages, shop or None)).lastrowid
+        else:
+            conn.execute("UPDATE sync_runs SET started_at=?,status='running',mode=?,max_pages=?,shop_domain=? WHERE id=?", (utcnow(), mode, max_pages, shop or None, run_id))
+        conn.commit()
+        if on_run_started:
+            on_run_started(run_id)
+        imported = updated = unchanged = pages = 0
+        high_water_mark = previous_mark
+        cancelled = bool(conn.execute("SELECT cancel_requested FROM sync_runs WHERE id=?", (run_id,)).fetchone()[0])
+        fetcher = ShopifyPageFetcher(variables, 0 if cancelled else max_pages)
+        fetcher.start()
+        try:
+            for connection in fetcher:
+                nodes = connection["nodes"]
+                counts = upsert_orders(conn, [normalize_graphql_order(node) for node in nodes], create_tasks=True)
+                imported += counts["created"]
+                updated += counts["updated"]
+                unchanged += counts["unchanged"] + counts["stale"]
+                for node in nodes:
+                    seen = node.get("updatedAt")
+                    if seen and (high_water_mark is None or str(seen) > high_water_mark):
+                        high_water_mark = str(seen)
+                pages += 1
+                meter = fetcher.meter
+                cancelled = bool(conn.execute(
+                    "UPDATE sync_runs SET pages=?,imported=?,updated=?,unchanged=?,shopify_requests=?,shopify_retries=?,shopify_throttled=?,shopify_cost=? WHERE id=? RETURNING cancel_requested",
+                    (pages, imported, updated, unchanged, meter["requests"], meter["retries"], meter["throttled"], meter["actual_cost"], run_id),
+                ).fetchone()[0])
+                conn.commit()
+                notify_queue_changed()
+                if cancelled:
+                    break
+            status = "cancelled" if cancelled else "success"
+            recorded_mark = high_water_mark if mode == "incremental" or (mode == "full" and not cancelled) else previous_mark
+            meter = fetcher.meter
+            result = {"status": status, "imported": imported, "updated": updated, "unchanged": unchanged, "pages": pages, "mode": mode, "high_water_mark": recorded_mark, "run_id": run_id, "shop": shop, "shopify_cost": dict(meter)}
+            conn.execute("UPDATE sync_runs SET completed_at=?,status=?,imported=?,updated=?,unchanged=?,pages=?,high_water_mark=?,shopify_requests=?,shopify_retries=?,shopify_throttled=?,shopify_cost=?,result=? WHERE id=?", (utcnow(), status, imported, updated, unchanged, pages, recorded_mark, meter["requests"], meter["retries"], meter["throttled"], meter["actual_cost"], json.dumps(result), run_id))
+            conn.commit()
+            return result
+        except Exception as exc:
+            conn.rollback()
+            meter = fetcher.meter
+            conn.execute("UPDATE sync_runs SET completed_at=?,status='failed',error_message=?,pages=?,shopify_requests=?,shopify_retries=?,shopify_throttled=?,shopify_cost=? WHERE id=?", (utcnow(), str(exc)[:1000], pages, meter["requests"], meter["retries"], meter["throttled"], meter["actual_cost"], run_id))
+            conn.commit()
+            raise
+        finally:
+            fetcher.cancel()
+            conn.close()
+
+
+SHOPIFY_SYNC_LEASE = "shopify-sync"
+SYNC_JOB_ACTIVE_STATUSES = ("queued", "running")
+SHOPIFY_BACKFILL_LEASE = "shopify-backfill"
+
+
+def sync_lease_name(shop: str | None = None) -> str:
+    """Each shop syncs under its own lease, so different shops sync in parallel."""
+    return f"{SHOPIFY_SYNC_LEASE}:{normalize_shop_domain(shop) or current_shop()}"
+
+
+def lease_owner_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}:{secrets.token_hex(4)}"
+
+
+def acquire_lease(name: str, owner: str, ttl: float = SYNC_LEASE_TTL) -> bool:
+    """Take the named lease if it is free, expired or already ours."""
+    now = time.time()
+    conn = get_db()
+    try:
+        cursor = conn.execute(
+            """INSERT INTO sync_leases(name,owner,run_id,acquired_at,heartbeat_at,expires_at) VALUES(?,?,NULL,?,?,?)
+               ON CONFLICT(name) DO UPDATE SET owner=excluded.owner,run_id=NULL,args=NULL,acquired_at=excluded.acquired_at,
+                 heartbeat_at=excluded.heartbeat_at,expires_at=excluded.expires_at
+               WHERE sync_leases.expires_at<? OR sync_leases.owner=excluded.owner""",
+            (name, owner, utcnow(), now, now + ttl, now),
+        )
+        conn.commit()
+        return cursor.rowcount == 1
+    finally:
+        conn.close()
 
 
-SHOPIFY_QUERY = """query Orders($cursor:String,$query:String){orders(first:100,after:$cursor,reverse:true,sortKey:CREATED_AT,query:$query){pageInfo{hasNextPage endCursor}nodes{id legacyResourceId name createdAt updatedAt processedAt cancelledAt closedAt email displayFinancialStatus displayFulfillmentStatus sourceName tags currentTotalPriceSet{shopMoney{amount currencyCode}} currentSubtotalPriceSet{shopMoney{amount currencyCode}} totalRefundedSet{shopMoney{amount currencyCode}} customer{displayName} shippingAddress{firstName lastName address1 address2 city province provinceCode zip country countryCodeV2 phone} shippingLine{title} lineItems(first:50){nodes{id title variantTitle sku quantity originalUnitPriceSet{shopMoney{amount currencyCode}} image{url altText} product{id title vendor} variant{id title}}} fulfillments{status trackingInfo{company number url}}}}}"""
+def renew_lease(name: str, owner: str, ttl: float = SYNC_LEASE_TTL, run_id: int | None = None, args: str | None = None) -> bool:
+    now = time.time()
+    conn = get_db()
+    try:
+        cursor = conn.execute(
+            "UPDATE sync_leases SET heartbeat_at=?,expires_at=?,run_id=COALESCE(?,run_id),args=COALESCE(?,args) WHERE name=? AND owner=?",
+            (now, now + ttl, run_id, args, name, owner),
+        )
+        conn.commit()
+        return cursor.rowcount == 1
+    finally:
+        conn.close()
+
 
+def release_lease(name: str, owner: str) -> None:
+    conn = get_db()
+    try:
+        conn.execute("DELETE FROM sync_leases WHERE name=? AND owner=?", (name, owner))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def current_lease(name: str) -> dict[str, Any] | None:
+    conn = get_db()
+    try:
+        row = conn.execute("SELECT * FROM sync_leases WHERE name=? AND expires_at>=?", (name, time.time())).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+class LeaseHeartbeat(threading.Thread):
+    """
+    Keep a lease alive while its holder works; the holder stops it when done.
+    If the lease is taken over, `lost` is set and on_lost runs so the holder
+    can stop work that another owner may now be doing.
+    """
+
+    def __init__(self, name: str, owner: str, ttl: float = SYNC_LEASE_TTL, on_lost: Callable[[], None] | None = None) -> None:
+        super().__init__(name=f"lease-heartbeat-{name}", daemon=True)
+        self.lease_name = name
+        self.owner = owner
+        self.ttl = ttl
+        self.on_lost = on_lost
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(max(self.ttl / 3, 0.05)):
+            try:
+                if not renew_lease(self.lease_name, self.owner, self.ttl):
+                    app.logger.warning("Lost lease %s", self.lease_name)
+                    self.lost.set()
+                    if self.on_lost:
+                        self.on_lost()
+                    return
+            except sqlite3.Error:
+                app.logger.exception("Lease heartbeat for %s failed", self.lease_name)
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+def _sync_run_outcome(run_id: int) -> dict[str, Any] | None:
+    """Result of a finished sync run; None while it is still running."""
+    conn = get_db()
+    try:
+        row = conn.execute("SELECT status,error_message,result FROM sync_runs WHERE id=?", (run_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None or row["status"] in SYNC_JOB_ACTIVE_STATUSES:
+        return None
+    if row["status"] == "failed":
+        raise RuntimeError(row["error_message"] or "Shopify sync failed")
+    return json.loads(row["result"]) if row["result"] else {"status": row["status"], "run_id": run_id}
+
+
+def sync_args_key(search_query: str | None = None, max_pages: int = 25, mode: str = "incremental", **_: Any) -> str:
+    """Identity of a requested sync; a caller only joins a run in flight with the same key."""
+    return json.dumps({"search_query": search_query or None, "max_pages": int(max_pages), "mode": "query" if search_query else mode}, sort_keys=True)
+
+
+def coordinated_shopify_sync(shop: str | None = None, **sync_args: Any) -> dict[str, Any]:
+    """
+    Run sync_shopify_orders for one shop under its cluster-wide sync lease.
+
+    Every gunicorn worker shares one lease row per shop in SQLite. The caller that wins
+    it runs the sync and heartbeats the lease; everyone else asking for the same
+    sync (sync_args_key) joins the run in flight and gets its result
+    (joined=True), while a caller asking for a different sync waits for the
+    lease and then runs its own. If the holder dies the lease expires and the
+    next waiter takes over; a holder that loses its lease cancels its run.
+    """
+    shop = normalize_shop_domain(shop) or current_shop()
+    lease_name = sync_lease_name(shop)
+    owner = lease_owner_id()
+    args_key = sync_args_key(**sync_args)
+    deadline = time.monotonic() + SYNC_JOIN_TIMEOUT
+    while True:
+        if acquire_lease(lease_name, owner):
+            run_ids: list[int] = []
+
+            def cancel_runs() -> None:
+                conn = get_db()
+                try:
+                    for run_id in run_ids:
+                        cancel_sync_job(conn, run_id)
+                finally:
+                    conn.close()
+
+            def run_started(run_id: int) -> None:
+                run_ids.append(run_id)
+                renew_lease(lease_name, owner, run_id=run_id, args=args_key)
+                if heartbeat.lost.is_set():
+                    cancel_runs()
+
+            heartbeat = LeaseHeartbeat(lease_name, owner, SYNC_LEASE_TTL, on_lost=cancel_runs)
+            heartbeat.start()
+            try:
+                result = sync_shopify_orders(**sync_args, shop=shop, on_run_started=run_started)
+                return {**result, "joined": False, "lease_lost": heartbeat.lost.is_set()}
+            finally:
+                heartbeat.stop()
+                release_lease(lease_name, owner)
+
+        lease = current_lease(lease_name)
+        if lease and lease["args"] is not None and lease["args"] != args_key:
+            # A different sync holds the lease: wait for it without counting toward the join timeout.
+            deadline = time.monotonic() + SYNC_JOIN_TIMEOUT
+            time.sleep(SYNC_JOIN_POLL_INTERVAL)
+            continue
+        run_id = lease["run_id"] if lease else None
+        while run_id is not None:
+            # Read the lease before the outcome: the holder records its result before
+            # releasing, so a released lease with no outcome means the holder died.
+            released = current_lease(lease_name) is None
+            outcome = _sync_run_outcome(run_id)
+            if outcome is not None:
+                return {**outcome, "joined": True}
+            if time.monotonic() >= deadline or released:
+                break
+            time.sleep(SYNC_JOIN_POLL_INTERVAL)
+        if time.monotonic() >= deadline:
+            raise TimeoutError("Timed out waiting for the Shopify sync in progress")
+        time.sleep(SYNC_JOIN_POLL_INTERVAL)
+
+
+def get_sync_job(conn: sqlite3.Connection, job_id: int) -> dict[str, Any] | None:
+    """A Shopify sync run as a job record, with a progress estimate from pages over max_pages."""
+    row = conn.execute("SELECT * FROM sync_runs WHERE id=? AND source='shopify'", (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job["job_id"] = job["id"]
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    job["cancel_requested"] = bool(job["cancel_requested"])
+    job["done"] = job["status"] not in SYNC_JOB_ACTIVE_STATUSES
+    pages, max_pages = int(job["pages"] or 0), max(1, int(job["max_pages"] or 1))
+    job["progress"] = 100 if job["done"] else min(95, 5 + int(90 * pages / max_pages))
+    return job
+
+
+def _run_sync_job(job_id: int, sync_args: dict[str, Any]) -> None:
+    try:
+        result = coordinated_shopify_sync(**sync_args, run_id=job_id)
+    except Exception as exc:
+        app.logger.warning("Shopify sync job %s failed: %s", job_id, exc)
+        result, error = None, str(exc)[:1000]
+    else:
+        error = None
+    conn = get_db()
+    try:
+        if result is not None and result["joined"]:
+            conn.execute(
+                "UPDATE sync_runs SET status='joined',completed_at=?,result=? WHERE id=? AND status='queued'",
+                (utcnow(), json.dumps(result), job_id),
+            )
+        elif error is not None:
+            conn.execute(
+                "UPDATE sync_runs SET status='failed',completed_at=?,error_message=? WHERE id=? AND status IN ('queued','running')",
+                (utcnow(), error, job_id),
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def start_shopify_sync_job(search_query: str | None = None, max_pages: int = 25, mode: str = "incremental", shop: str | None = None) -> tuple[dict[str, Any], bool]:
+    """
+    Queue a sync of one shop on a background thread and return (job, joined).
+
+    When the same sync (sync_args_key) of that shop already holds its lease,
+    its job is returned instead of queueing another one; a different sync is
+    queued and runs once the lease is free.
+    """
+    shop = normalize_shop_domain(shop) or current_shop()
+    lease = current_lease(sync_lease_name(shop))
+    conn = get_db()
+    try:
+        if lease and lease["run_id"] and lease["args"] == sync_args_key(search_query, max_pages, mode):
+            job = get_sync_job(conn, lease["run_id"])
+            if job and not job["done"]:
+                return job, True
+        job_id = conn.execute(
+            "INSERT INTO sync_runs(source,started_at,status,mode,max_pages,shop_domain) VALUES('shopify',?,'queued',?,?,?)",
+            (utcnow(), mode, max_pages, shop or None),
+        ).lastrowid
+        conn.commit()
+        job = get_sync_job(conn, job_id)
+    finally:
+        conn.close()
+    sync_args = {"search_query": search_query, "max_pages": max_pages, "mode": mode, "shop": shop}
+    threading.Thread(target=_run_sync_job, args=(job_id, sync_args), name="shopify-sync-job", daemon=True).start()
+    return job, False
+
+
+def sync_all_shops(max_pages: int = 25, mode: str = "incremental") -> dict[str, Any]:
+    """
+    Sync every configured shop, SHOPIFY_SYNC_SHOP_CONCURRENCY at a time.
+
+    Each shop runs under its own lease and its own client, so a shop that is
+    throttled or failing only slows itself down. Returns the per-shop results
+    and errors with summed counts.
+    """
+    shops = configured_shops()
+    results: dict[str, dict[str, Any]] = {}
+    errors: dict[str, str] = {}
+    if shops:
+        with ThreadPoolExecutor(max_workers=max(1, min(SHOPIFY_SYNC_SHOP_CONCURRENCY, len(shops))), thread_name_prefix="shopify-shop-sync") as pool:
+            futures = {pool.submit(coordinated_shopify_sync, shop=shop, max_pages=max_pages, mode=mode): shop for shop in shops}
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as exc:
+                    errors[futures[future]] = str(exc)[:1000]
+    totals = {key: sum(int(result.get(key) or 0) for result in results.values()) for key in ("imported", "updated", "unchanged", "pages")}
+    return {**totals, "shops": results, "errors": errors}
+
+
+def cancel_sync_job(conn: sqlite3.Connection, job_id: int) -> bool:
+    cursor = conn.execute(
+        "UPDATE sync_runs SET cancel_requested=1 WHERE id=? AND source='shopify' AND status IN ('queued','running')",
+        (job_id,),
+    )
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+SHOPIFY_BULK_RUN_MUTATION = """mutation RunBulk($query:String!){bulkOperationRunQuery(query:$query){bulkOperation{id status} userErrors{field message}}}"""
+SHOPIFY_BULK_STATUS_QUERY = """query BulkStatus($id:ID!){node(id:$id){... on BulkOperation{id status errorCode objectCount url partialDataUrl}}}"""
+BULK_TERMINAL_FAILURES = {"FAILED", "CANCELED", "CANCELLED", "EXPIRED"}
+
+
+def iter_bulk_orders(lines) -> Any:
+    """
+    Reassemble a bulk-operation JSONL stream into GraphQL-shaped order nodes.
+
+    Shopify writes each order followed by its line items, which carry a
+    __parentId. Only the order being assembled is held in memory.
+    """
+    current: dict[str, Any] | None = None
+    for raw in lines:
+        if not raw:
+            continue
+        record = json.loads(raw)
+        parent_id = record.pop("__parentId", None)
+        if parent_id is None:
+            if current is not None:
+                yield current
+            record["lineItems"] = {"nodes": []}
+            current = record
+        elif current is not None and parent_id == current.get("id"):
+            current["lineItems"]["nodes"].append(record)
+    if current is not None:
+        yield current
+
+
+def _bulk_row(conn: sqlite3.Connection, backfill_id: int) -> dict[str, Any]:
+    return dict(conn.execute("SELECT * FROM shopify_bulk_operations WHERE id=?", (backfill_id,)).fetchone())
+
+
+def _update_bulk_row(conn: sqlite3.Connection, backfill_id: int, **fields: Any) -> None:
+    fields["updated_at"] = utcnow()
+    conn.execute(
+        "UPDATE shopify_bulk_operations SET " + ",".join(f"{name}=?" for name in fields) + " WHERE id=?",
+        [*fields.values(), backfill_id],
+    )
+    conn.commit()
+
+
+def latest_bulk_backfill(conn: sqlite3.Connection, shop: str | None = None) -> dict[str, Any] | None:
+    row = conn.execute(
+        "SELECT * FROM shopify_bulk_operations WHERE shop_domain IS ? ORDER BY id DESC LIMIT 1",
+        (normalize_shop_domain(shop) or current_shop() or None,),
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def run_shopify_bulk_backfill(batch_size: int | None = None, poll_interval: float | None = None, shop: str | None = None) -> dict[str, Any]:
+    """
+    Import the full order history through a Shopify bulk operation.
+
+    An unfinished backfill is resumed instead of submitting a new operation;
+    ingestion skips the orders already committed, because the progress
+    counter is written in the same transaction as each batch. Each shop has
+    its own backfill; shop defaults to the current shop. Shopify cost metrics
+    accumulate on the backfill's sync_runs row across resumes.
+    """
+    with shopify_shop(shop or current_shop()) as shop, shopify_metering(new_cost_meter()) as meter:
+        batch_size = max(1, batch_size or SHOPIFY_BULK_BATCH_SIZE)
+        poll_interval = SHOPIFY_BULK_POLL_INTERVAL if poll_interval is None else poll_interval
+        conn = get_db()
+        try:
+            row = conn.execute(
+                "SELECT * FROM shopify_bulk_operations WHERE shop_domain IS ? AND status NOT IN ('ingested','failed') ORDER BY id DESC LIMIT 1",
+                (shop or None,),
+            ).fetchone()
+            if row:
+                backfill = dict(row)
+            else:
+                result = shopify_graphql(SHOPIFY_BULK_RUN_MUTATION, {"query": SHOPIFY_BULK_ORDERS_QUERY}).get("bulkOperationRunQuery") or {}
+                if result.get("userErrors"):
+                    raise RuntimeError(result["userErrors"][0].get("message", "Shopify rejected the bulk operation"))
+                operation = result.get("bulkOperation") or {}
+                now = utcnow()
+                backfill_id = conn.execute(
+                    "INSERT INTO shopify_bulk_operations(operation_id,status,created_at,updated_at,shop_domain) VALUES(?,?,?,?,?)",
+                    (operation.get("id"), "submitted", now, now, shop or None),
+                ).lastrowid
+                conn.commit()
+                backfill = _bulk_row(conn, backfill_id)
+            backfill_id = int(backfill["id"])
+
+            while backfill["status"] in {"submitted", "running"}:
+                node = shopify_graphql(SHOPIFY_BULK_STATUS_QUERY, {"id": backfill["operation_id"]}).get("node") or {}
+                status = str(node.get("status") or "").upper()
+                if status == "COMPLETED":
+                    _update_bulk_row(conn, backfill_id, status="completed", url=node.get("url"), object_count=int(node.get("objectCount") or 0))
+                elif status in BULK_TERMINAL_FAILURES:
+                    _update_bulk_row(conn, backfill_id, status="failed", completed_at=utcnow(), error_message=f"Bulk operation {status.lower()}: {node.get('errorCode') or ''}".strip())
+                else:
+                    _update_bulk_row(conn, backfill_id, status="running", object_count=int(node.get("objectCount") or 0))
+                    time.sleep(poll_interval)
+                backfill = _bulk_row(conn, backfill_id)
+
+            if backfill["status"] == "failed":
+                return backfill
+
+            if not backfill.get("sync_run_id"):
+                run_id = conn.execute("INSERT INTO sync_runs(source,started_at,status,mode,shop_domain) VALUES('shopify_bulk',?,'running','bulk',?)", (utcnow(), shop or None)).lastrowid
+                _update_bulk_row(conn, backfill_id, sync_run_id=run_id)
+                backfill = _bulk_row(conn, backfill_id)
+            run_id = int(backfill["sync_run_id"])
+            stored = conn.execute("SELECT shopify_requests,shopify_retries,shopify_throttled,shopify_cost FROM sync_runs WHERE id=?", (run_id,)).fetchone()
+            for key, value in zip(("requests", "retries", "throttled", "actual_cost"), stored):
+                meter[key] += value or 0
+            _update_bulk_row(conn, backfill_id, status="ingesting", error_message=None)
+
+            ingested = int(backfill.get("orders_ingested") or 0)
+            imported = int(backfill.get("orders_created") or 0)
+            updated = int(backfill.get("orders_updated") or 0)
+            unchanged = int(backfill.get("orders_unchanged") or 0)
+            high_water_mark = backfill.get("high_water_mark")
+            pending: list[dict[str, Any]] = []
+
+            def flush() -> None:
+                nonlocal ingested, imported, updated, unchanged, high_water_mark
+                counts = upsert_orders(conn, [normalize_graphql_order(node) for node in pending], create_tasks=True)
+                imported += counts["created"]
+                updated += counts["updated"]
+                unchanged += counts["unchanged"] + counts["stale"]
+                for node in pending:
+                    seen = node.get("updatedAt")
+                    if seen and (high_water_mark is None or str(seen) > high_water_mark):
+                        high_water_mark = str(seen)
+                ingested += len(pending)
+                conn.execute(
+                    "UPDATE shopify_bulk_operations SET orders_ingested=?,orders_created=?,orders_updated=?,orders_unchanged=?,high_water_mark=?,updated_at=? WHERE id=?",
+                    (ingested, imported, updated, unchanged, high_water_mark, utcnow(), backfill_id),
+                )
+                conn.execute(
+                    "UPDATE sync_runs SET imported=?,updated=?,unchanged=?,shopify_requests=?,shopify_retries=?,shopify_throttled=?,shopify_cost=? WHERE id=?",
+                    (imported, updated, unchanged, meter["requests"], meter["retries"], meter["throttled"], meter["actual_cost"], run_id),
+                )
+                conn.commit()
+                notify_queue_changed()
+                pending.clear()
+
+            try:
+                if backfill.get("url"):
+                    skip = ingested
+                    with requests.get(backfill["url"], stream=True, timeout=120) as response:
+                        response.raise_for_status()
+                        for node in iter_bulk_orders(response.iter_lines()):
+                            if skip:
+                                skip -= 1
+                                continue
+                            pending.append(node)
+                            if len(pending) >= batch_size:
+                                flush()
+                    if pending:
+                        flush()
+            except Exception as exc:
+                conn.rollback()
+                _update_bulk_row(conn, backfill_id, error_message=str(exc)[:1000])
+                conn.execute(
+                    "UPDATE sync_runs SET completed_at=?,status='failed',error_message=?,shopify_requests=?,shopify_retries=?,shopify_throttled=?,shopify_cost=? WHERE id=?",
+                    (utcnow(), str(exc)[:1000], meter["requests"], meter["retries"], meter["throttled"], meter["actual_cost"], run_id),
+                )
+                conn.commit()
+                raise
+
+            conn.execute(
+                "UPDATE sync_runs SET completed_at=?,status='success',imported=?,updated=?,unchanged=?,high_water_mark=?,"
+                "shopify_requests=?,shopify_retries=?,shopify_throttled=?,shopify_cost=? WHERE id=?",
+                (utcnow(), imported, updated, unchanged, high_water_mark, meter["requests"], meter["retries"], meter["throttled"], meter["actual_cost"], run_id),
+            )
+            _update_bulk_row(conn, backfill_id, status="ingested", completed_at=utcnow())
+            return _bulk_row(conn, backfill_id)
+        finally:
+            conn.close()
+
+
+def start_shopify_bulk_backfill(shop: str | None = None) -> bool:
+    """Run a shop's backfill on a daemon thread; False when it is already running in the cluster."""
+    shop = normalize_shop_domain(shop) or current_shop()
+    lease_name = f"{SHOPIFY_BACKFILL_LEASE}:{shop}"
+    owner = lease_owner_id()
+    if not acquire_lease(lease_name, owner):
+        return False
+
+    def runner() -> None:
+        heartbeat = LeaseHeartbeat(lease_name, owner)
+        heartbeat.start()
+        try:
+            run_shopify_bulk_backfill(shop=shop)
+        except Exception:
+            app.logger.exception("Shopify bulk backfill failed for %s", shop)
+        finally:
+            heartbeat.stop()
+            release_lease(lease_name, owner)
+
+    threading.Thread(target=runner, name="shopify-bulk-backfill", daemon=True).start()
+    return True
+
+
+def maybe_sync_shopify_for_worker() -> dict[str, Any]:
+    """
+    Report the scheduler's latest sync when the worker queue is empty.
+
+    Polling Shopify belongs to ShopifySyncScheduler; the worker only reads
+    what it last did, so an idle worker adds no Shopify traffic.
+    """
+    conn = get_db()
+    state = sync_scheduler_state(conn)
+    conn.close()
+    return {"attempted": False, "reason": "scheduled", "scheduler": state}
+
+
+SHOPIFY_SCHEDULER_LEASE = "shopify-scheduler"
+SYNC_SCHEDULER_STATE_KEY = "shopify_sync_scheduler"
+
+
+def record_webhook_outcome(conn: sqlite3.Connection, ok: bool) -> None:
+    set_app_state(conn, "webhook_last_ok_at" if ok else "webhook_last_error_at", utcnow())
+
+
+def webhook_health(conn: sqlite3.Connection) -> str:
+    """healthy, failing or unknown, from the last successful and failed webhook."""
+    last_ok = get_app_state(conn, "webhook_last_ok_at")
+    last_error = get_app_state(conn, "webhook_last_error_at")
+    if last_error and (not last_ok or last_error > last_ok):
+        return "failing"
+    if last_ok:
+        age = (datetime.now(timezone.utc) - datetime.fromisoformat(last_ok)).total_seconds()
+        if age <= WEBHOOK_HEALTHY_WINDOW:
+            return "healthy"
+    return "unknown"
+
+
+def compute_sync_interval(orders_last_hour: int, health: str, missed_changes: int, failures: int = 0) -> float:
+    """
+    Seconds until the next scheduled sync.
+
+    Failing webhooks, or a sync that found changes the webhooks never
+    delivered, poll at the minimum interval. Healthy webhooks poll at the
+    maximum. Otherwise poll about four times per expected order gap. Failed
+    syncs back off exponentially.
+    """
+    low, high = SYNC_SCHEDULER_MIN_INTERVAL, max(SYNC_SCHEDULER_MIN_INTERVAL, SYNC_SCHEDULER_MAX_INTERVAL)
+    if failures:
+        return min(high, low * 2 ** min(failures, 10))
+    if health == "failing" or missed_changes:
+        return low
+    if health == "healthy":
+        return high
+    return min(high, max(low, 3600 / (orders_last_hour + 1) / 4))
+
+
+def sync_scheduler_state(conn: sqlite3.Connection) -> dict[str, Any]:
+    raw = get_app_state(conn, SYNC_SCHEDULER_STATE_KEY)
+    state = json.loads(raw) if raw else {}
+    lease = conn.execute("SELECT owner,expires_at FROM sync_leases WHERE name=? AND expires_at>=?", (SHOPIFY_SCHEDULER_LEASE, time.time())).fetchone()
+    return {**state, "enabled": SHOPIFY_SYNC_SCHEDULER, "active_owner": lease["owner"] if lease else None}
+
+
+class ShopifySyncScheduler(threading.Thread):
+    """
+    Own periodic incremental Shopify syncs of every shop for the whole deployment.
+
+    Every gunicorn worker runs one of these, but only the holder of the
+    scheduler lease syncs; the others stand by and take over when it lapses.
+    The lease is short (SYNC_SCHEDULER_LEASE_TTL): the holder renews it while
+    it waits between ticks and heartbeats it during a tick, and standbys retry
+    about once per TTL, so a dead holder is replaced within roughly two TTLs.
+    Each tick records its result and the next interval in app_state, where
+    the API and the old polling entry points read it.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(name="shopify-sync-scheduler", daemon=True)
+        self.owner = lease_owner_id()
+        self.stopped = threading.Event()
+        self.failures = 0
+
+    def run(self) -> None:
+        ttl = SYNC_SCHEDULER_LEASE_TTL
+        delay, next_run = 0.0, None
+        while not self.stopped.wait(delay):
+            try:
+                if not acquire_lease(SHOPIFY_SCHEDULER_LEASE, self.owner, ttl=ttl):
+                    delay, next_run = ttl, None
+                    continue
+                if next_run is None:
+                    next_run = self._inherited_next_run()
+                if time.monotonic() >= next_run:
+                    heartbeat = LeaseHeartbeat(SHOPIFY_SCHEDULER_LEASE, self.owner, ttl)
+                    heartbeat.start()
+                    try:
+                        next_run = time.monotonic() + self.tick()
+                    finally:
+                        heartbeat.stop()
+            except Exception:
+                app.logger.exception("Shopify sync scheduler tick failed")
+                next_run = time.monotonic() + SYNC_SCHEDULER_MAX_INTERVAL
+            delay = max(0.0, min(next_run - time.monotonic(), ttl / 3))
+        release_lease(SHOPIFY_SCHEDULER_LEASE, self.owner)
+
+    def _inherited_next_run(self) -> float:
+        """Monotonic time of the next_run_at a previous holder scheduled; now if there is none."""
+        conn = get_db()
+        try:
+            planned = parse_shopify_time(sync_scheduler_state(conn).get("next_run_at"))
+        finally:
+            conn.close()
+        wait = (planned - datetime.now(timezone.utc)).total_seconds() if planned else 0.0
+        return time.monotonic() + min(max(wait, 0.0), SYNC_SCHEDULER_MAX_INTERVAL)
+
+    def tick(self) -> float:
+        started_at = utcnow()
+        result = sync_all_shops(max_pages=SYNC_SCHEDULER_MAX_PAGES)
+        error = result["errors"] or None
+        if error and not result["shops"]:
+            app.logger.warning("Scheduled Shopify sync failed: %s", error)
+            self.failures += 1
+        else:
+            self.failures = 0
+
+        since = (datetime.now(timezone.utc) - timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        conn = get_db()
+        try:
+            orders_last_hour = int(conn.execute("SELECT COUNT(*) FROM orders WHERE created_at>=?", (since,)).fetchone()[0])
+            health = webhook_health(conn)
+            missed = sum(
+                int(shop_result.get("imported") or 0) + int(shop_result.get("updated") or 0)
+                for shop_result in result["shops"].values()
+                if shop_result.get("mode") == "incremental"
+            )
+            interval = compute_sync_interval(orders_last_hour, health, missed, self.failures)
+            state = {
+                "owner": self.owner,
+                "last_run_at": started_at,
+                "last_result": result,
+                "last_error": error,
+                "consecutive_failures": self.failures,
+                "orders_last_hour": orders_last_hour,
+                "webhook_health": health,
+                "missed_changes": missed,
+                "interval_seconds": interval,
+                "next_run_at": (datetime.now(timezone.utc) + timedelta(seconds=interval)).isoformat(),
+            }
+            set_app_state(conn, SYNC_SCHEDULER_STATE_KEY, json.dumps(state))
+            conn.commit()
+        finally:
+            conn.close()
+        return interval
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+_sync_scheduler: ShopifySyncScheduler | None = None
+_sync_scheduler_lock = threading.Lock()
+
+
+def start_sync_scheduler() -> ShopifySyncScheduler | None:
+    """Start this process's scheduler once; None when disabled by SHOPIFY_SYNC_SCHEDULER."""
+    global _sync_scheduler
+    if not SHOPIFY_SYNC_SCHEDULER:
+        return None
+    with _sync_scheduler_lock:
+        if _sync_scheduler is None or not _sync_scheduler.is_alive():
+            _sync_scheduler = ShopifySyncScheduler()
+            _sync_scheduler.start()
+        return _sync_scheduler
+
+
+_webhook_inbox_wakeup = threading.Event()
+
+
+def enqueue_webhook(conn: sqlite3.Connection, topic: str, payload: bytes, shop: str | None = None, webhook_id: str | None = None) -> int | None:
+    """
+    Store a verified webhook body for the consumer; the caller commits.
+
+    Returns None, without storing anything, when the same X-Shopify-Webhook-Id
+    arrived within WEBHOOK_DEDUP_WINDOW. The check and insert are one
+    statement, so concurrent redeliveries cannot both get through.
+    """
+    now = time.time()
+    row = conn.execute(
+        """
+        INSERT INTO webhook_inbox(webhook_id,topic,shop_domain,payload,received_at,received_epoch,next_attempt_at)
+        SELECT ?,?,?,?,?,?,?
+        WHERE ? IS NULL OR NOT EXISTS (SELECT 1 FROM webhook_inbox WHERE webhook_id=? AND received_epoch>=?)
+        RETURNING id
+        """,
+        (webhook_id, topic, shop, payload.decode("utf-8"), utcnow(), now, now, webhook_id, webhook_id, now - WEBHOOK_DEDUP_WINDOW),
+    ).fetchone()
+    if row is None:
+        increment_app_state(conn, "webhook_duplicates_dropped")
+        return None
+    return int(row[0])
+
+
+def _claim_webhook_batch(conn: sqlite3.Connection, owner: str, limit: int) -> list[dict[str, Any]]:
+    """
+    Atomically claim due pending rows, and rows whose consumer died mid-batch.
+    A read-only probe runs first so an idle consumer never takes the write lock.
+    """
+    now = time.time()
+    due = conn.execute(
+        "SELECT 1 FROM webhook_inbox WHERE (status='pending' AND next_attempt_at<=?) OR (status='processing' AND claimed_at<?) LIMIT 1",
+        (now, now - WEBHOOK_INBOX_CLAIM_TIMEOUT),
+    ).fetchone()
+    if due is None:
+        return []
+    rows = conn.execute(
+        """
+        UPDATE webhook_inbox SET status='processing', claimed_by=?, claimed_at=?, attempts=attempts+1
+        WHERE id IN (
+          SELECT id FROM webhook_inbox
+          WHERE (status='pending' AND next_attempt_at<=?) OR (status='processing' AND claimed_at<?)
+          ORDER BY id
+          LIMIT ?
+        )
+        RETURNING *
+        """,
+        (owner, now, now, now - WEBHOOK_INBOX_CLAIM_TIMEOUT, limit),
+    ).fetchall()
+    conn.commit()
+    return sorted((dict(row) for row in rows), key=lambda row: row["id"])
+
+
+def _fail_webhook(conn: sqlite3.Connection, item: dict[str, Any], error: str) -> str:
+    if int(item["attempts"]) >= WEBHOOK_INBOX_MAX_ATTEMPTS:
+        status, next_attempt_at = "dead", time.time()
+    else:
+        status, next_attempt_at = "pending", time.time() + WEBHOOK_INBOX_RETRY_BASE * 2 ** (int(item["attempts"]) - 1)
+    conn.execute(
+        "UPDATE webhook_inbox SET status=?,next_attempt_at=?,last_error=?,claimed_by=NULL,claimed_at=NULL WHERE id=?",
+        (status, next_attempt_at, error[:1000], item["id"]),
+    )
+    return status
+
+
+def _utc_timestamp(value: Any) -> str | None:
+    """Shopify timestamps carry shop-local offsets; store UTC so SQL can compare them as text."""
+    parsed = parse_shopify_time(value)
+    return parsed.astimezone(timezone.utc).isoformat() if parsed else None
+
+
+def _webhook_order_id(conn: sqlite3.Connection, payload: dict[str, Any]) -> int:
+    row = conn.execute("SELECT id FROM orders WHERE shopify_order_id=?", (str(payload.get("order_id")),)).fetchone()
+    if row is None:
+        # Raising leaves the delivery in the inbox to retry once the order itself has arrived.
+        raise LookupError(f"Order {payload.get('order_id')} has not been ingested yet")
+    return int(row["id"])
+
+
+def apply_fulfillment_webhook(conn: sqlite3.Connection, payload: dict[str, Any]) -> str:
+    """Copy tracking from fulfillments/create and fulfillments/update onto the order."""
+    order_id = _webhook_order_id(conn, payload)
+    seen_at = _utc_timestamp(payload.get("updated_at") or payload.get("created_at"))
+    cursor = conn.execute(
+        """
+        UPDATE orders SET tracking_company=?, tracking_number=?, tracking_url=?,
+          delivery_status=CASE WHEN ?='delivered' THEN 'DELIVERED' ELSE delivery_status END,
+          fulfillment_updated_at=?, updated_at=?
+        WHERE id=? AND (fulfillment_updated_at IS NULL OR ? IS NULL OR fulfillment_updated_at<=?)
+        """,
+        (
+            payload.get("tracking_company"), payload.get("tracking_number") or next(iter(payload.get("tracking_numbers") or []), None),
+            payload.get("tracking_url") or next(iter(payload.get("tracking_urls") or []), None),
+            str(payload.get("shipment_status") or "").lower(), seen_at, utcnow(), order_id, seen_at, seen_at,
+        ),
+    )
+    if not cursor.rowcount:
+        increment_app_state(conn, "orders_stale_dropped")
+        return "stale"
+    return "updated"
+
+
+def apply_refund_webhook(conn: sqlite3.Connection, payload: dict[str, Any]) -> str:
+    """Record a refunds/create delivery once and raise the order's refunds_total to match."""
+    order_id = _webhook_order_id(conn, payload)
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO order_refunds(shopify_refund_id,order_id,amount,created_at,received_at) VALUES(?,?,?,?,?)",
+        (str(payload.get("id")), order_id, refund_amount(payload), payload.get("created_at"), utcnow()),
+    )
+    if not cursor.rowcount:
+        return "unchanged"
+    # MAX keeps a newer full-order total (which also counts refunds issued before we started listening).
+    conn.execute(
+        "UPDATE orders SET refunds_total=MAX(COALESCE(refunds_total,0),(SELECT SUM(amount) FROM order_refunds WHERE order_id=?)),updated_at=? WHERE id=?",
+        (order_id, utcnow(), order_id),
+    )
+    return "updated"
+
+
+def apply_product_webhook(conn: sqlite3.Connection, payload: dict[str, Any]) -> str:
+    """Refresh vendor and image on line items of a products/update product; variant images win."""
+    product_id = str(payload.get("id"))
+    seen_at = _utc_timestamp(payload.get("updated_at"))
+    images = {image.get("id"): image.get("src") for image in payload.get("images") or []}
+    product_image = (payload.get("image") or {}).get("src")
+    rows = [
+        (payload.get("vendor"), images.get(variant.get("image_id")) or product_image, seen_at,
+         str(variant.get("id")), f"gid://shopify/ProductVariant/{variant.get('id')}", seen_at, seen_at)
+        for variant in payload.get("variants") or []
+    ]
+    conn.executemany(
+        """
+        UPDATE line_items SET vendor=COALESCE(?,vendor), image_url=COALESCE(?,image_url), product_updated_at=?
+        WHERE shopify_variant_id IN (?,?) AND (product_updated_at IS NULL OR ? IS NULL OR product_updated_at<=?)
+        """,
+        rows,
+    )
+    # Line items whose variant has since been deleted still belong to the product.
+    variant_ids = [value for row in rows for value in row[3:5]]
+    skip_variants = f"AND COALESCE(shopify_variant_id,'') NOT IN ({','.join('?' for _ in variant_ids)})" if variant_ids else ""
+    conn.execute(
+        f"""
+        UPDATE line_items SET vendor=COALESCE(?,vendor), image_url=COALESCE(?,image_url), product_updated_at=?
+        WHERE shopify_product_id IN (?,?) {skip_variants}
+          AND (product_updated_at IS NULL OR ? IS NULL OR product_updated_at<=?)
+        """,
+        (payload.get("vendor"), product_image, seen_at, product_id, f"gid://shopify/Product/{product_id}", *variant_ids, seen_at, seen_at),
+    )
+    return "updated"
+
+
+ORDER_WEBHOOK_TOPICS = {"orders/create", "orders/updated", "orders/cancelled"}
+WEBHOOK_TOPIC_HANDLERS = {
+    "fulfillments/create": apply_fulfillment_webhook,
+    "fulfillments/update": apply_fulfillment_webhook,
+    "refunds/create": apply_refund_webhook,
+    "products/update": apply_product_webhook,
+}
+
+
+def _ingest_webhooks(conn: sqlite3.Connection, items: list[dict[str, Any]]) -> None:
+    """Upsert order deliveries per shop first, then apply the partial updates that depend on them."""
+    by_shop: dict[str | None, list[dict[str, Any]]] = {}
+    partial = []
+    for item in items:
+        if item["topic"] in ORDER_WEBHOOK_TOPICS:
+            by_shop.setdefault(item["shop_domain"], []).append(normalize_rest_order(json.loads(item["payload"])))
+        elif item["topic"] in WEBHOOK_TOPIC_HANDLERS:
+            partial.append(item)
+        else:
+            raise ValueError(f"Unsupported webhook topic {item['topic']}")
+    for shop, orders in by_shop.items():
+        with shopify_shop(shop):
+            upsert_orders(conn, orders, create_tasks=True)
+    for item in partial:
+        with shopify_shop(item["shop_domain"]):
+            WEBHOOK_TOPIC_HANDLERS[item["topic"]](conn, json.loads(item["payload"]))
+
+
+def prune_webhook_inbox(conn: sqlite3.Connection) -> int | None:
+    """
+    Forget processed deliveries past the dedup window, at most once per
+    WEBHOOK_INBOX_PRUNE_INTERVAL across all processes; None when not due.
+    Commits when it prunes.
+    """
+    if time.time() - float(get_app_state(conn, "webhook_inbox_pruned_at", "0")) < WEBHOOK_INBOX_PRUNE_INTERVAL:
+        return None
+    set_app_state(conn, "webhook_inbox_pruned_at", time.time())
+    pruned = conn.execute("DELETE FROM webhook_inbox WHERE status='processed' AND received_epoch<?", (time.time() - WEBHOOK_DEDUP_WINDOW,)).rowcount
+    conn.commit()
+    return pruned
+
+
+def drain_webhook_inbox(limit: int | None = None, owner: str | None = None) -> dict[str, int]:
+    """
+    Process one batch of queued webhooks through the order upsert path.
+
+    The batch is written in one transaction. If it fails, each webhook is
+    retried on its own so one poison payload cannot hold back the rest;
+    failures back off exponentially and become dead letters after
+    WEBHOOK_INBOX_MAX_ATTEMPTS.
+    """
+    owner = owner or lease_owner_id()
+    conn = get_db()
+    try:
+        items = _claim_webhook_batch(conn, owner, max(1, limit or WEBHOOK_INBOX_BATCH_SIZE))
+        summary = {"claimed": len(items), "processed": 0, "retrying": 0, "dead": 0}
+        if not items:
+            prune_webhook_inbox(conn)
+            return summary
+        done: list[dict[str, Any]] = []
+        try:
+            _ingest_webhooks(conn, items)
+            done = items
+        except Exception:
+            conn.rollback()
+            for item in items:
+                try:
+                    _ingest_webhooks(conn, [item])
+                    conn.commit()
+                    done.append(item)
+                except Exception as exc:
+                    conn.rollback()
+                    status = _fail_webhook(conn, item, str(exc))
+                    summary["retrying" if status == "pending" else "dead"] += 1
+                    record_webhook_outcome(conn, ok=False)
+                    conn.commit()
+        if done:
+            processed_at = utcnow()
+            conn.executemany(
+                "UPDATE webhook_inbox SET status='processed',processed_at=?,last_error=NULL,claimed_by=NULL,claimed_at=NULL WHERE id=?",
+                [(processed_at, item["id"]) for item in done],
+            )
+            set_app_state(conn, "webhook_inbox_last_lag_seconds", round(time.time() - min(item["received_epoch"] for item in done), 3))
+            record_webhook_outcome(conn, ok=True)
+        conn.commit()
+        summary["processed"] = len(done)
+        if done:
+            notify_queue_changed()
+        return summary
+    finally:
+        conn.close()
+
+
+def webhook_inbox_stats(conn: sqlite3.Connection) -> dict[str, Any]:
+    counts = {row["status"]: int(row["count"]) for row in conn.execute("SELECT status, COUNT(*) AS count FROM webhook_inbox GROUP BY status")}
+    oldest = conn.execute("SELECT MIN(received_epoch) FROM webhook_inbox WHERE status IN ('pending','processing')").fetchone()[0]
+    last_lag = get_app_state(conn, "webhook_inbox_last_lag_seconds")
+    return {
+        "counts": counts,
+        "lag_seconds": round(time.time() - oldest, 3) if oldest else 0.0,
+        "last_batch_lag_seconds": float(last_lag) if last_lag else None,
+        "dropped": {
+            "duplicates": int(get_app_state(conn, "webhook_duplicates_dropped", "0")),
+            "stale": int(get_app_state(conn, "orders_stale_dropped", "0")),
+        },
+    }
+
+
+class WebhookInboxConsumer(threading.Thread):
+    """Drain the webhook inbox in batches; enqueue_webhook's wake-up skips the poll wait."""
+
+    def __init__(self) -> None:
+        super().__init__(name="webhook-inbox-consumer", daemon=True)
+        self.owner = lease_owner_id()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                summary = drain_webhook_inbox(owner=self.owner)
+            except Exception:
+                app.logger.exception("Webhook inbox batch failed")
+                summary = {"claimed": 0}
+            if summary["claimed"] < WEBHOOK_INBOX_BATCH_SIZE:
+                _webhook_inbox_wakeup.wait(WEBHOOK_INBOX_POLL_INTERVAL)
+                _webhook_inbox_wakeup.clear()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        _webhook_inbox_wakeup.set()
+
+
+_webhook_consumer: WebhookInboxConsumer | None = None
+
+
+def start_webhook_consumer() -> WebhookInboxConsumer | None:
+    """Start this process's inbox consumer once; None when disabled by WEBHOOK_INBOX_CONSUMER."""
+    global _webhook_consumer
+    if not WEBHOOK_INBOX_CONSUMER:
+        return None
+    with _sync_scheduler_lock:
+        if _webhook_consumer is None or not _webhook_consumer.is_alive():
+            _webhook_consumer = WebhookInboxConsumer()
+            _webhook_consumer.start()
+        return _webhook_consumer
+
+
+TASK_WITH_ORDER_SQL = """
+    SELECT
+      t.*,
+      o.shopify_order_id,
+      o.shopify_order_number,
+      o.customer_name,
+      o.shipping_address,
+      li.sku_norm
+    FROM tasks t
+    JOIN orders o ON o.id = t.order_id
+    LEFT JOIN line_items li ON li.id = t.line_item_id
+"""
+
+
+def request_worker_id() -> str:
+    """The calling bot's lease identity; bots sharing one token should each send X-Worker-Id."""
+    body = request.get_json(silent=True) if request.is_json else None
+    return str(request.headers.get("X-Worker-Id") or request.args.get("worker_id") or (body or {}).get("worker_id") or "worker").strip()[:200]
+
+
+def queue_generation(conn: sqlite3.Connection) -> str | None:
+    return get_app_state(conn, "queue_generation")
+
+
+def validate_queue_priority_policy(overrides: Mapping[str, Any]) -> dict[str, Any]:
+    """
+    Check a policy overlay against the shape of DEFAULT_QUEUE_PRIORITY_POLICY:
+    numbers stay finite numbers and rule tables map keys to numbers. Returns a
+    copy with shipping_rules keys lower-cased and sku_rules keys normalized;
+    raises ValueError.
+    """
+    def is_number(value: Any) -> bool:
+        return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+    unknown = sorted(set(overrides) - set(DEFAULT_QUEUE_PRIORITY_POLICY))
+    if unknown:
+        raise ValueError(f"Unknown policy keys: {', '.join(unknown)}")
+    cleaned: dict[str, Any] = {}
+    for key, value in overrides.items():
+        if isinstance(DEFAULT_QUEUE_PRIORITY_POLICY[key], dict):
+            if not isinstance(value, dict) or not all(is_number(points) for points in value.values()):
+                raise ValueError(f"{key} must be an object of numbers")
+            normalize = normalize_sku if key == "sku_rules" else (lambda rule: str(rule).lower())
+            value = {normalize(rule): points for rule, points in value.items()}
+        elif not is_number(value):
+            raise ValueError(f"{key} must be a number")
+        cleaned[key] = value
+    return cleaned
+
+
+DEFAULT_QUEUE_PRIORITY_POLICY.update(validate_queue_priority_policy(json.loads(os.getenv("QUEUE_PRIORITY_POLICY") or "{}")))
+
+
+def _saved_queue_priority_policy(conn: sqlite3.Connection) -> dict[str, Any]:
+    try:
+        return validate_queue_priority_policy(json.loads(get_app_state(conn, "queue_priority_policy") or "{}"))
+    except ValueError as exc:
+        app.logger.warning("Ignoring invalid saved queue priority policy: %s", exc)
+        return {}
+
+
+def queue_priority_policy(conn: sqlite3.Connection) -> dict[str, Any]:
+    """DEFAULT_QUEUE_PRIORITY_POLICY (env QUEUE_PRIORITY_POLICY) overlaid with the dashboard's saved policy."""
+    return {**DEFAULT_QUEUE_PRIORITY_POLICY, **_saved_queue_priority_policy(conn)}
+
+
+def task_priority(policy: Mapping[str, Any], total: Any, shipping_method: Any, order_created_at: Any, sku_norm: Any) -> int:
+    """Score one task; higher is claimed first."""
+    score = min(float(total or 0) / 10 * float(policy["value_weight"]), float(policy["value_cap"]))
+    method = str(shipping_method or "").lower()
+    score += max((float(points) for keyword, points in policy["shipping_rules"].items() if keyword in method), default=0.0)
+    placed = parse_shopify_time(order_created_at)
+    age_hours = (datetime.now(timezone.utc) - placed).total_seconds() / 3600 if placed else 0.0
+    score += min(max(age_hours, 0.0) * float(policy["age_weight"]), float(policy["age_cap"]))
+    if age_hours >= float(policy["sla_hours"]):
+        score += float(policy["sla_boost"])
+    score += float(policy["sku_rules"].get(normalize_sku(sku_norm), 0))
+    return int(round(score))
+
+
+def recompute_task_priorities(conn: sqlite3.Connection, only_missing: bool = False) -> int:
+    """Rescore queued tasks (only unscored ones with only_missing); returns rows changed. The caller commits."""
+    policy = queue_priority_policy(conn)
+    rows = conn.execute(
+        f"""
+        SELECT t.id, t.priority, o.current_total_price, o.shipping_method, o.created_at, li.sku_norm
+        FROM tasks t
+        JOIN orders o ON o.id = t.order_id
+        LEFT JOIN line_items li ON li.id = t.line_item_id
+        WHERE t.state = 'queued' {"AND t.priority IS NULL" if only_missing else ""}
+        """
+    ).fetchall()
+    changes = []
+    for row in rows:
+        priority = task_priority(policy, row["current_total_price"], row["shipping_method"], row["created_at"], row["sku_norm"])
+        if priority != row["priority"]:
+            changes.append((priority, row["id"]))
+    conn.executemany("UPDATE tasks SET priority=? WHERE id=?", changes)
+    return len(changes)
+
+
+def maybe_refresh_task_priorities(conn: sqlite3.Connection) -> int | None:
+    """
+    Rescore the queue at most every QUEUE_PRIORITY_REFRESH_SECONDS across all
+    processes, so order age and SLA boosts stay current; in between only tasks
+    without a score (pre-existing rows) are scored. Commits when it writes.
+    """
+    last = float(get_app_state(conn, "queue_priority_refreshed_at", "0"))
+    if time.time() - last >= QUEUE_PRIORITY_REFRESH_SECONDS:
+        set_app_state(conn, "queue_priority_refreshed_at", time.time())
+        changed = recompute_task_priorities(conn)
+    elif conn.execute("SELECT 1 FROM tasks WHERE state='queued' AND priority IS NULL LIMIT 1").fetchone():
+        changed = recompute_task_priorities(conn, only_missing=True)
+    else:
+        return None
+    conn.commit()
+    return changed
+
+
+def fair_claim_shop(conn: sqlite3.Connection, policy: Mapping[str, Any] | None = None) -> str | None:
+    """
+    With several stores sharing the queue, pick the shop whose best queued
+    task scores highest after a boost for how long the shop has gone without
+    a claim, so one busy store cannot starve the others. One indexed lookup
+    per configured shop; None (no filter) for a single store.
+    """
+    shops = configured_shops()
+    if len(shops) < 2:
+        return None
+    policy = policy or queue_priority_policy(conn)
+    now = time.time()
+    best, best_score = None, None
+    for shop in shops:
+        top = conn.execute(
+            "SELECT priority FROM tasks WHERE shop_domain=? AND state='queued' ORDER BY priority DESC, created_at, id LIMIT 1",
+            (shop,),
+        ).fetchone()
+        if top is None:
+            continue
+        waited_minutes = (now - float(get_app_state(conn, f"queue_last_claim:{shop}", "0"))) / 60
+        score = (top["priority"] or 0) + float(policy["shop_fairness_weight"]) * min(waited_minutes, 24 * 60)
+        if best_score is None or score > best_score:
+            best, best_score = shop, score
+    return best
+
+
+def claim_next_task(conn: sqlite3.Connection, owner: str, shop: str | None = None, ttl: float | None = None):
+    """
+    Lease the highest-priority queued task (oldest first within a priority)
+    to owner in a single UPDATE ... RETURNING, served by idx_tasks_claim_order,
+    or idx_tasks_shop_claim_order for one shop. The shop filter is spliced in
+    rather than written as "? IS NULL OR", which would stop SQLite from
+    using the shop index.
+
+    SQLite serializes writers, so two bots polling at once can never both
+    move the same row out of 'queued'. The caller commits.
+    """
+    row = conn.execute(
+        f"""
+        UPDATE tasks
+        SET
+          state = 'processing_opened_url',
+          updated_at = ?,
+          last_action = 'Worker pulled task',
+          lease_owner = ?,
+          lease_expires_at = ?,
+          attempts = COALESCE(attempts, 0) + 1
+        WHERE id = (
+          SELECT id FROM tasks
+          WHERE {"shop_domain = ? AND" if shop else ""} state = 'queued'
+          ORDER BY priority DESC, created_at, id
+          LIMIT 1
+        )
+        RETURNING id, shop_domain
+        """,
+        (utcnow(), owner, time.time() + (ttl or TASK_LEASE_TTL), *([shop] if shop else [])),
+    ).fetchone()
+    if row is None:
+        return None
+    if row["shop_domain"]:
+        set_app_state(conn, f"queue_last_claim:{row['shop_domain']}", time.time())
+    return conn.execute(TASK_WITH_ORDER_SQL + " WHERE t.id = ?", (row["id"],)).fetchone()
+
+
+def claim_task_batch(conn: sqlite3.Connection, owner: str, group: str, limit: int, shop: str | None = None) -> list[sqlite3.Row]:
+    """
+    Lease up to limit queued tasks that share the oldest queued task's order
+    (group="order") or ASIN (group="asin"), under one new batch_id.
+
+    Like claim_next_task this is a single UPDATE ... RETURNING, so a batch
+    can never overlap another worker's claim. The caller commits.
+    """
+    column = TASK_BATCH_GROUPS[group]
+    batch_id = secrets.token_hex(8)
+    shop_filter, shop_args = ("shop_domain = ? AND", [shop]) if shop else ("", [])
+    rows = conn.execute(
+        f"""
+        UPDATE tasks
+        SET
+          state = 'processing_opened_url',
+          updated_at = ?,
+          last_action = 'Worker pulled batch',
+          lease_owner = ?,
+          lease_expires_at = ?,
+          attempts = COALESCE(attempts, 0) + 1,
+          batch_id = ?
+        WHERE id IN (
+          SELECT id FROM tasks
+          WHERE {shop_filter} state = 'queued'
+            AND {column} IS (
+              SELECT {column} FROM tasks
+              WHERE {shop_filter} state = 'queued'
+              ORDER BY priority DESC, created_at, id
+              LIMIT 1
+            )
+          ORDER BY priority DESC, created_at, id
+          LIMIT ?
+        )
+        RETURNING id, shop_domain
+        """,
+        (utcnow(), owner, time.time() + TASK_LEASE_TTL, batch_id, *shop_args, *shop_args, max(1, limit)),
+    ).fetchall()
+    if not rows:
+        return []
+    for claimed_shop in {row["shop_domain"] for row in rows if row["shop_domain"]}:
+        set_app_state(conn, f"queue_last_claim:{claimed_shop}", time.time())
+    ids = [row["id"] for row in rows]
+    return conn.execute(
+        TASK_WITH_ORDER_SQL + f" WHERE t.id IN ({','.join('?' for _ in ids)}) ORDER BY t.priority DESC, t.created_at, t.id", ids
+    ).fetchall()
+
+
+def describe_task_batch(tasks: list[sqlite3.Row], group: str) -> dict[str, Any]:
+    """Shape a claimed batch for checkout: quantities per ASIN and one shipping address per order."""
+    asins: dict[str, dict[str, Any]] = {}
+    orders: dict[int, dict[str, Any]] = {}
+    for task in tasks:
+        asin = asins.setdefault(task["asin"], {"asin": task["asin"], "amazon_url": task["amazon_url"], "quantity": 0, "task_ids": []})
+        asin["quantity"] += int(task["quantity"] or 1)
+        asin["task_ids"].append(task["id"])
+        order = orders.setdefault(task["order_id"], {
+            "order_id": task["order_id"],
+            "shopify_order_number": task["shopify_order_number"],
+            "customer_name": task["customer_name"],
+            "shipping_address": json.loads(task["shipping_address"] or "{}"),
+            "items": [],
+        })
+        order["items"].append({"task_id": task["id"], "asin": task["asin"], "quantity": task["quantity"]})
+    return {
+        "batch_id": tasks[0]["batch_id"],
+        "group": group,
+        "group_key": tasks[0][TASK_BATCH_GROUPS[group]],
+        "tasks": [dict(task) for task in tasks],
+        "total_quantity": sum(asin["quantity"] for asin in asins.values()),
+        "asins": list(asins.values()),
+        "orders": list(orders.values()),
+    }
+
+
+def renew_task_lease(conn: sqlite3.Connection, task_id: int, owner: str, ttl: float | None = None) -> float | None:
+    """Extend owner's lease on a task still in processing; returns the new expiry, or None if the lease was lost."""
+    row = conn.execute(
+        "UPDATE tasks SET lease_expires_at=? WHERE id=? AND lease_owner=? AND state LIKE 'processing%' RETURNING lease_expires_at",
+        (time.time() + (ttl or TASK_LEASE_TTL), task_id, owner),
+    ).fetchone()
+    return float(row[0]) if row else None
+
+
+def renew_batch_lease(conn: sqlite3.Connection, batch_id: str, owner: str, ttl: float | None = None) -> float | None:
+    """renew_task_lease for every still-processing task of a batch."""
+    expires_at = time.time() + (ttl or TASK_LEASE_TTL)
+    renewed = conn.execute(
+        "UPDATE tasks SET lease_expires_at=? WHERE batch_id=? AND lease_owner=? AND state LIKE 'processing%'",
+        (expires_at, batch_id, owner),
+    ).rowcount
+    return expires_at if renewed else None
+
+
+def validate_task_retry_policy(overrides: Any) -> dict[str, dict[str, float]]:
+    """
+    Check a TASK_RETRY_POLICY overlay: an object of failure classes, each an
+    object of base_seconds/max_seconds/max_attempts/jitter set to finite,
+    non-negative numbers. Returns the merged rules per class (new classes start
+    from "transient"), keyed by lower-cased class name; raises ValueError.
+    """
+    if not isinstance(overrides, dict):
+        raise ValueError("TASK_RETRY_POLICY must be an object of failure classes")
+    merged: dict[str, dict[str, float]] = {}
+    for failure_class, rule in overrides.items():
+        name = str(failure_class).strip().lower()
+        if not name or not isinstance(rule, dict):
+            raise ValueError(f"{failure_class!r} must name an object of retry settings")
+        unknown = sorted(set(rule) - set(TASK_RETRY_POLICY["transient"]))
+        if unknown:
+            raise ValueError(f"Unknown retry settings for {name}: {', '.join(unknown)}")
+        for key, value in rule.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value < 0:
+                raise ValueError(f"{name}.{key} must be a non-negative number")
+        merged[name] = {**TASK_RETRY_POLICY.get(name, TASK_RETRY_POLICY["transient"]), **rule}
+    return merged
+
+
+TASK_RETRY_POLICY.update(validate_task_retry_policy(json.loads(os.getenv("TASK_RETRY_POLICY") or "{}")))
+TASK_RETRY_STATES = {"retry", "retry_scheduled"}
+TASK_FAILURE_KEYWORDS = {
+    "payment": ("payment", "card", "declined", "billing"),
+    "stock": ("stock", "unavailable", "sold out", "quantity limit"),
+    "verification": ("verification", "captcha", "otp", "2fa", "sign in", "sign-in"),
+}
+
+
+def classify_task_failure(body: Mapping[str, Any]) -> str:
+    """The worker's explicit failure_class, else a keyword match on its error text, else "transient"."""
+    explicit = str(body.get("failure_class") or "").strip().lower()
+    if explicit in TASK_RETRY_POLICY:
+        return explicit
+    text = f"{body.get('error_message') or ''} {body.get('last_action') or ''}".lower()
+    for failure_class, keywords in TASK_FAILURE_KEYWORDS.items():
+        if any(keyword in text for keyword in keywords):
+            return failure_class
+    return "transient"
+
+
+def task_retry_delay(failure_class: str, attempts: int) -> float:
+    rule = TASK_RETRY_POLICY[failure_class]
+    delay = min(float(rule["base_seconds"]) * 2 ** max(attempts - 1, 0), float(rule["max_seconds"]))
+    return delay * random.uniform(1 - float(rule["jitter"]), 1 + float(rule["jitter"]))
+
+
+def promote_due_retries(conn: sqlite3.Connection) -> int:
+    """
+    Move retry_scheduled tasks whose next_attempt_at has passed back to
+    'queued' (bumping queue_generation through the queue trigger). The probe
+    reads idx_tasks_retry_due so idle polls take no write lock. The caller commits.
+    """
+    now = time.time()
+    if not conn.execute("SELECT 1 FROM tasks WHERE state='retry_scheduled' AND next_attempt_at <= ? LIMIT 1", (now,)).fetchone():
+        return 0
+    return conn.execute(
+        "UPDATE tasks SET state='queued', updated_at=?, last_action='Retry due' WHERE state='retry_scheduled' AND next_attempt_at <= ?",
+        (utcnow(), now),
+    ).rowcount
+
+
+# Called as hook(conn, task_id, update) after each applied worker transition, inside
+# the same transaction; notification_extension registers its event writer here.
+TASK_TRANSITION_HOOKS: list[Callable[[sqlite3.Connection, int, Mapping[str, Any]], None]] = []
+
+
+def apply_task_update(conn: sqlite3.Connection, task_id: int, owner: str, body: Mapping[str, Any]) -> str:
+    """
+    Record a worker's state report for one task.
+
+    Returns "updated", "not_found", or "conflict" when another worker holds
+    its lease. Leaving processing releases the lease and staying in it
+    renews it. A "retry"/"retry_scheduled" report, or a requeue with an
+    error_message, is parked as retry_scheduled until its class's backoff
+    has elapsed, or failed once the class's max_attempts is used up; hooks
+    see the state actually applied. The caller commits.
+    """
+    state = str(body.get("state") or "").strip()
+    previous = conn.execute("SELECT state,attempts FROM tasks WHERE id=?", (task_id,)).fetchone()
+    if previous is None:
+        return "not_found"
+    failure_class = next_attempt_at = None
+    error_message = body.get("error_message")
+    if state in TASK_RETRY_STATES or (state == "queued" and error_message):
+        failure_class = classify_task_failure(body)
+        attempts = int(previous["attempts"] or 0)
+        if attempts >= TASK_RETRY_POLICY[failure_class]["max_attempts"]:
+            state = "failed"
+            error_message = f"{error_message or failure_class + ' failure'} (gave up after {attempts} attempts)"
+        else:
+            state = "retry_scheduled"
+            next_attempt_at = time.time() + task_retry_delay(failure_class, attempts)
+    elif state == "failed":
+        failure_class = classify_task_failure(body)
+    processing = state.startswith("processing")
+    cursor = conn.execute(
+        """
+        UPDATE tasks SET state=?,error_message=?,amazon_order_id=?,last_action=?,updated_at=?,failure_class=?,next_attempt_at=?,
+          lease_owner=CASE WHEN ? THEN lease_owner ELSE NULL END,
+          lease_expires_at=CASE WHEN ? AND lease_owner IS NOT NULL THEN ? WHEN ? THEN lease_expires_at ELSE NULL END
+        WHERE id=? AND (lease_owner IS NULL OR lease_owner=?)
+        """,
+        (state, error_message, body.get("amazon_order_id"), body.get("last_action"), utcnow(), failure_class, next_attempt_at,
+         processing, processing, time.time() + TASK_LEASE_TTL, processing, task_id, owner),
+    )
+    if not cursor.rowcount:
+        return "conflict"
+    if state in {"purchased", "failed"} and previous["state"] != state:
+        conn.execute(f"UPDATE workers SET tasks_{state}=tasks_{state}+1 WHERE worker_id=?", (owner,))
+    applied = {**body, "state": state, "error_message": error_message}
+    if next_attempt_at is not None:
+        applied.update(failure_class=failure_class, next_attempt_at=next_attempt_at)
+    for hook in TASK_TRANSITION_HOOKS:
+        hook(conn, task_id, applied)
+    return "updated"
+
+
+def reap_expired_task_leases(conn: sqlite3.Connection) -> dict[str, int]:
+    """
+    Hand processing tasks whose bot stopped renewing its lease to the retry
+    machinery as "transient" failures: retry_scheduled after that class's
+    backoff, or failed once its max_attempts claims are used up, so a task
+    that keeps crashing bots backs off instead of looping. The caller commits.
+    """
+    now = time.time()
+    expired = conn.execute(
+        "SELECT id, attempts, lease_owner FROM tasks WHERE lease_expires_at < ? AND state LIKE 'processing%'", (now,)
+    ).fetchall()
+    give_up = TASK_RETRY_POLICY["transient"]["max_attempts"]
+    stamp = utcnow()
+    failed = [row for row in expired if int(row["attempts"] or 0) >= give_up]
+    retrying = [
+        (now + task_retry_delay("transient", int(row["attempts"] or 0)), stamp, row["id"], now)
+        for row in expired
+        if int(row["attempts"] or 0) < give_up
+    ]
+    for row in failed:
+        cursor = conn.execute(
+            """
+            UPDATE tasks SET state='failed', failure_class='transient', next_attempt_at=NULL, lease_owner=NULL, lease_expires_at=NULL,
+              updated_at=?, error_message='Worker lease expired after ' || attempts || ' attempts', last_action='Lease expired'
+            WHERE id=? AND lease_expires_at < ?
+            """,
+            (stamp, row["id"], now),
+        )
+        if cursor.rowcount and row["lease_owner"]:
+            conn.execute("UPDATE workers SET tasks_failed=tasks_failed+1 WHERE worker_id=?", (row["lease_owner"],))
+    conn.executemany(
+        """
+        UPDATE tasks SET state='retry_scheduled', failure_class='transient', next_attempt_at=?, lease_owner=NULL, lease_expires_at=NULL,
+          updated_at=?, last_action='Lease expired; retry scheduled'
+        WHERE id=? AND lease_expires_at < ?
+        """,
+        retrying,
+    )
+    # Rows that left processing without going through update_task keep a stale expiry; drop it.
+    conn.execute("UPDATE tasks SET lease_owner=NULL, lease_expires_at=NULL WHERE lease_expires_at < ? AND state NOT LIKE 'processing%'", (now,))
+    return {"retrying": len(retrying), "failed": len(failed)}
 
-def shopify_graphql(query: str, variables: dict[str, Any]) -> dict[str, Any]:
-    access_token = get_shopify_access_token(SHOPIFY_STORE_DOMAIN)
-    if not SHOPIFY_STORE_DOMAIN or not access_token:
-        raise RuntimeError("Shopify is not connected. Complete OAuth installation or configure SHOPIFY_ADMIN_ACCESS_TOKEN.")
-    url = f"https://{SHOPIFY_STORE_DOMAIN}/admin/api/{SHOPIFY_API_VERSION}/graphql.json"
-    response = requests.post(url, headers={"X-Shopify-Access-Token": access_token, "Content-Type": "application/json"}, json={"query": query, "variables": variables}, timeout=45)
-    response.raise_for_status()
-    payload = response.json()
-    if payload.get("errors"):
-        raise RuntimeError(payload["errors"][0].get("message", "Shopify GraphQL error"))
-    return payload["data"]
-
-
-def sync_shopify_orders(search_query: str | None = None, max_pages: int = 25) -> dict[str, Any]:
-    conn = get_db()
-    run_id = conn.execute("INSERT INTO sync_runs(source,started_at,status) VALUES('shopify',?,'running')", (utcnow(),)).lastrowid
-    conn.commit()
-    imported = updated = pages = 0
-    cursor = None
-    try:
-        while pages < max_pages:
-            connection = shopify_graphql(SHOPIFY_QUERY, {"cursor": cursor, "query": search_query})["orders"]
-            for node in connection["nodes"]:
-                _, created = upsert_order(conn, normalize_graphql_order(node), create_tasks=True)
-                imported += int(created)
-                updated += int(not created)
-            conn.commit()
-            pages += 1
-            if not connection["pageInfo"]["hasNextPage"]:
-                break
-            cursor = connection["pageInfo"]["endCursor"]
-        conn.execute("UPDATE sync_runs SET completed_at=?,status='success',imported=?,updated=? WHERE id=?", (utcnow(), imported, updated, run_id))
-        conn.commit()
-        return {"status": "success", "imported": imported, "updated": updated, "pages": pages}
-    except Exception as exc:
-        conn.rollback()
-        conn.execute("UPDATE sync_runs SET completed_at=?,status='failed',error_message=? WHERE id=?", (utcnow(), str(exc)[:1000], run_id))
-        conn.commit()
-        raise
-    finally:
-        conn.close()
 
+def latency_percentiles(values: list[float]) -> dict[str, Any]:
+    """Nearest-rank p50/p95/p99 in seconds."""
+    ordered = sorted(values)
+    if not ordered:
+        return {"count": 0, "p50": None, "p95": None, "p99": None}
+    rank = lambda q: round(ordered[max(math.ceil(q * len(ordered)), 1) - 1], 3)
+    return {"count": len(ordered), "p50": rank(0.5), "p95": rank(0.95), "p99": rank(0.99)}
 
 
-def maybe_sync_shopify_for_worker() -> dict[str, Any]:
+def task_latency_report(conn: sqlite3.Connection, since: float, worker: str | None = None, shop: str | None = None) -> dict[str, Any]:
     """
-    Check Shopify when the worker queue is empty.
-
-    The worker still consumes only queued tasks. This fallback merely ensures
-    a new Shopify order is imported and converted into a task without requiring
-    the dashboard to be open or a manual Sync Shopify click.
+    Summarize task_transitions since the epoch `since`, overall, per UTC day,
+    and per worker:
+
+    - stages: seconds spent in each state, for stages that began and ended
+      inside the window;
+    - end_to_end: order created -> first queued -> purchased -> fulfilled,
+      for tasks purchased inside the window;
+    - purchased count and tasks_per_hour over the covered hours.
     """
-    global _last_queue_shopify_sync_at
+    now = time.time()
+    scopes: dict[str, dict[str, dict[str, Any]]] = {"all": {}, "day": {}, "worker": {}}
 
-    now = time.monotonic()
-    if now - _last_queue_shopify_sync_at < QUEUE_SHOPIFY_SYNC_INTERVAL:
-        return {"attempted": False, "reason": "throttled"}
+    def buckets(day: str, worker_id: str | None) -> list[dict[str, Any]]:
+        keys = (("all", "all"), ("day", day), ("worker", worker_id or "unassigned"))
+        return [scopes[scope].setdefault(key, {"stages": {}, "end_to_end": {}, "purchased": 0}) for scope, key in keys]
 
-    if not _queue_sync_lock.acquire(blocking=False):
-        return {"attempted": False, "reason": "already_running"}
+    stage_rows = conn.execute(
+        """
+        SELECT to_state, worker_id, day, duration FROM (
+          SELECT tr.to_state, COALESCE(tr.worker_id, LEAD(tr.worker_id) OVER w) AS worker_id, substr(tr.at, 1, 10) AS day,
+            LEAD(tr.at_epoch) OVER w - tr.at_epoch AS duration
+          FROM task_transitions tr
+          JOIN tasks t ON t.id = tr.task_id
+          WHERE tr.at_epoch >= ? AND (? IS NULL OR t.shop_domain = ?)
+          WINDOW w AS (PARTITION BY tr.task_id ORDER BY tr.id)
+        )
+        WHERE duration IS NOT NULL AND (? IS NULL OR worker_id = ?)
+        """,
+        (since, shop, shop, worker, worker),
+    )
+    for row in stage_rows:
+        for bucket in buckets(row["day"], row["worker_id"]):
+            bucket["stages"].setdefault(row["to_state"], []).append(row["duration"])
 
-    try:
-        now = time.monotonic()
-        if now - _last_queue_shopify_sync_at < QUEUE_SHOPIFY_SYNC_INTERVAL:
-            return {"attempted": False, "reason": "throttled"}
+    purchase_rows = conn.execute(
+        """
+        SELECT p.worker_id, substr(p.at, 1, 10) AS day, p.at_epoch AS purchased_epoch,
+          (SELECT MIN(q.at_epoch) FROM task_transitions q WHERE q.task_id = p.task_id AND q.to_state = 'queued') AS queued_epoch,
+          o.created_at AS order_created_at, o.fulfillment_status, COALESCE(o.fulfilled_at, o.fulfillment_updated_at) AS fulfilled_at
+        FROM task_transitions p
+        JOIN tasks t ON t.id = p.task_id
+        JOIN orders o ON o.id = t.order_id
+        WHERE p.to_state = 'purchased' AND p.at_epoch >= ?
+          AND (? IS NULL OR t.shop_domain = ?) AND (? IS NULL OR p.worker_id = ?)
+        """,
+        (since, shop, shop, worker, worker),
+    )
+    for row in purchase_rows:
+        created = parse_shopify_time(row["order_created_at"])
+        fulfilled = parse_shopify_time(row["fulfilled_at"]) if str(row["fulfillment_status"] or "").upper() == "FULFILLED" else None
+        marks = {
+            "order": created.timestamp() if created else None,
+            "queued": row["queued_epoch"],
+            "purchased": row["purchased_epoch"],
+            "fulfilled": fulfilled.timestamp() if fulfilled else None,
+        }
+        segments = {
+            "order_to_queued": ("order", "queued"),
+            "queued_to_purchased": ("queued", "purchased"),
+            "purchased_to_fulfilled": ("purchased", "fulfilled"),
+            "order_to_purchased": ("order", "purchased"),
+            "order_to_fulfilled": ("order", "fulfilled"),
+        }
+        for bucket in buckets(row["day"], row["worker_id"]):
+            bucket["purchased"] += 1
+            for name, (start, end) in segments.items():
+                if marks[start] is not None and marks[end] is not None and marks[end] >= marks[start]:
+                    bucket["end_to_end"].setdefault(name, []).append(marks[end] - marks[start])
+
+    def summarize(bucket: dict[str, Any], hours: float) -> dict[str, Any]:
+        return {
+            "stages": {state: latency_percentiles(values) for state, values in sorted(bucket["stages"].items())},
+            "end_to_end": {name: latency_percentiles(values) for name, values in bucket["end_to_end"].items()},
+            "purchased": bucket["purchased"],
+            "tasks_per_hour": round(bucket["purchased"] / hours, 3) if hours > 0 else None,
+        }
 
-        _last_queue_shopify_sync_at = now
+    def day_hours(day: str) -> float:
+        start = datetime.fromisoformat(day).replace(tzinfo=timezone.utc).timestamp()
+        return max(min(start + 86400, now) - max(start, since), 0.0) / 3600
 
-        try:
-            result = sync_shopify_orders(max_pages=1)
-            return {
-                "attempted": True,
-                "ok": True,
-                "result": result,
-            }
-        except Exception as exc:
-            app.logger.exception(
-                "Worker-triggered Shopify sync failed"
-            )
-            return {
-                "attempted": True,
-                "ok": False,
-                "error": str(exc),
-            }
-    finally:
-        _queue_sync_lock.release()
+    window_hours = (now - since) / 3600
+    empty = {"stages": {}, "end_to_end": {}, "purchased": 0}
+    return {
+        **summarize(scopes["all"].get("all", empty), window_hours),
+        "by_day": {day: summarize(bucket, day_hours(day)) for day, bucket in sorted(scopes["day"].items())},
+        "by_worker": {worker_id: summarize(bucket, window_hours) for worker_id, bucket in sorted(scopes["worker"].items())},
+    }
 
+CURRENT_TASK_SQL = """
+    SELECT
+      t.id AS task_id,
+      t.state AS task_state,
+      t.updated_at,
+      t.last_action,
+      t.quantity,
+      t.lease_owner AS worker_id,
+      o.id AS order_id,
+      o.shopify_order_number,
+      o.customer_name,
+      li.title AS product_name,
+      li.sku
+    FROM tasks t
+    JOIN orders o ON o.id=t.order_id
+    LEFT JOIN line_items li ON li.id=t.line_item_id
+"""
+
+
+def _heartbeat_age_seconds(value: Any) -> int | None:
+    heartbeat_time = parse_shopify_time(value)
+    if heartbeat_time is None:
+        return None
+    return max(0, int((datetime.now(timezone.utc) - heartbeat_time).total_seconds()))
 
-def get_next_queued_task(conn: sqlite3.Connection):
-    return conn.execute(
-        """
-        SELECT
-          t.*,
-          o.shopify_order_id,
-          o.shopify_order_number,
-          o.customer_name,
-          o.shipping_address
-        FROM tasks t
-        JOIN orders o ON o.id = t.order_id
-        WHERE t.state = 'queued'
-        ORDER BY t.created_at, t.id
-        LIMIT 1
-        """
-    ).fetchone()
 
-def worker_snapshot(conn: sqlite3.Connection) -> dict[str, Any]:
-    raw = conn.execute(
-        "SELECT * FROM worker_status WHERE id=1"
+def _visible_task(conn: sqlite3.Connection, where: str, params: tuple) -> dict[str, Any] | None:
+    task_row = conn.execute(CURRENT_TASK_SQL + where + " LIMIT 1", params).fetchone()
+    if not task_row:
+        return None
+    hidden = conn.execute(
+        "SELECT 1 FROM dashboard_hidden_tasks "
+        "WHERE category='processing' AND task_id=?",
+        (task_row["task_id"],),
     ).fetchone()
-    row = dict(raw) if raw else {}
-
-    online = False
-    heartbeat_age_seconds = None
+    return None if hidden else dict(task_row)
 
-    if row.get("last_heartbeat_at"):
-        try:
-            heartbeat_time = datetime.fromisoformat(
-                str(row["last_heartbeat_at"]).replace("Z", "+00:00")
-            )
-            heartbeat_age_seconds = max(
-                0,
-                int(
-                    (
-                        datetime.now(timezone.utc) - heartbeat_time
-                    ).total_seconds()
-                ),
-            )
-            online = heartbeat_age_seconds < WORKER_OFFLINE_THRESHOLD
-        except (ValueError, TypeError):
-            online = False
 
+def _worker_view(conn: sqlite3.Connection, row: sqlite3.Row) -> dict[str, Any]:
+    worker = dict(row)
+    age = _heartbeat_age_seconds(worker.get("last_heartbeat_at"))
     current_task = None
-    current_task_id = row.get("current_task_id")
+    if worker.get("current_task_id"):
+        current_task = _visible_task(conn, "WHERE t.id=?", (worker["current_task_id"],))
+    if current_task is None:
+        current_task = _visible_task(
+            conn,
+            "WHERE t.lease_owner=? AND lower(t.state) LIKE 'processing%' ORDER BY t.updated_at DESC, t.id DESC",
+            (worker["worker_id"],),
+        )
+    return {
+        **worker,
+        "worker_online": age is not None and age < WORKER_OFFLINE_THRESHOLD,
+        "heartbeat_age_seconds": age,
+        "current_task": current_task,
+    }
 
-    if current_task_id:
-        task_row = conn.execute(
-            """
-            SELECT
-              t.id AS task_id,
-              t.state AS task_state,
-              t.updated_at,
-              t.last_action,
-              t.quantity,
-              o.id AS order_id,
-              o.shopify_order_number,
-              o.customer_name,
-              li.title AS product_name,
-              li.sku
-            FROM tasks t
-            JOIN orders o ON o.id=t.order_id
-            LEFT JOIN line_items li ON li.id=t.line_item_id
-            WHERE t.id=?
-            LIMIT 1
-            """,
-            (current_task_id,),
-        ).fetchone()
 
-        if task_row:
-            hidden = conn.execute(
-                "SELECT 1 FROM dashboard_hidden_tasks "
-                "WHERE category='processing' AND task_id=?",
-                (current_task_id,),
-            ).fetchone()
-            if not hidden:
-                current_task = dict(task_row)
+def on_worker_offline(conn: sqlite3.Connection, worker: dict[str, Any]) -> None:
+    """Called once each time a worker's heartbeat goes stale; notification_extension replaces this."""
+    app.logger.warning("Worker %s went offline (last heartbeat %s)", worker["worker_id"], worker.get("last_heartbeat_at"))
 
-    if current_task is None:
-        task_row = conn.execute(
-            """
-            SELECT
-              t.id AS task_id,
-              t.state AS task_state,
-              t.updated_at,
-              t.last_action,
-              t.quantity,
-              o.id AS order_id,
-              o.shopify_order_number,
-              o.customer_name,
-              li.title AS product_name,
-              li.sku
-            FROM tasks t
-            JOIN orders o ON o.id=t.order_id
-            LEFT JOIN line_items li ON li.id=t.line_item_id
-            WHERE lower(t.state) LIKE 'processing%'
-            ORDER BY t.updated_at DESC, t.id DESC
-            LIMIT 1
-            """
-        ).fetchone()
 
-        if task_row:
-            hidden = conn.execute(
-                "SELECT 1 FROM dashboard_hidden_tasks "
-                "WHERE category='processing' AND task_id=?",
-                (task_row["task_id"],),
-            ).fetchone()
-            if not hidden:
-                current_task = dict(task_row)
+def fleet_snapshot(conn: sqlite3.Connection) -> dict[str, Any]:
+    """
+    Every registered worker plus fleet totals.
 
+    Workers found offline since their last heartbeat are stamped with
+    last_offline_notification_at and passed to on_worker_offline, so each
+    outage is reported once per worker no matter how often this is read.
+    The stamp is conditional, so of two processes reading at once only the
+    one whose UPDATE lands reports the outage.
+    """
+    workers = [_worker_view(conn, row) for row in conn.execute("SELECT * FROM workers ORDER BY last_heartbeat_at DESC, worker_id")]
+    newly_offline = [
+        worker for worker in workers
+        if not worker["worker_online"] and worker.get("last_heartbeat_at")
+        and str(worker.get("last_offline_notification_at") or "") < str(worker["last_heartbeat_at"])
+    ]
+    if newly_offline:
+        now = utcnow()
+        for worker in newly_offline:
+            cursor = conn.execute(
+                "UPDATE workers SET last_offline_notification_at=? "
+                "WHERE worker_id=? AND COALESCE(last_offline_notification_at,'') < last_heartbeat_at",
+                (now, worker["worker_id"]),
+            )
+            worker["last_offline_notification_at"] = now
+            if cursor.rowcount == 1:
+                on_worker_offline(conn, worker)
+        conn.commit()
+    online = [worker for worker in workers if worker["worker_online"]]
+    return {
+        "workers": workers,
+        "fleet": {
+            "total": len(workers),
+            "online": len(online),
+            "offline": len(workers) - len(online),
+            "busy": sum(1 for worker in online if str((worker["current_task"] or {}).get("task_state") or "").startswith("processing")),
+            "tasks_claimed": sum(int(worker["tasks_claimed"]) for worker in workers),
+            "tasks_purchased": sum(int(worker["tasks_purchased"]) for worker in workers),
+            "tasks_failed": sum(int(worker["tasks_failed"]) for worker in workers),
+        },
+    }
+
+
+def worker_snapshot(conn: sqlite3.Connection, worker_id: str | None = None) -> dict[str, Any]:
+    """
+    One worker's status, or without worker_id the fleet summarised in the
+    single-bot shape the dashboards read: the most recently seen worker's
+    fields, worker_online when any worker is online, plus workers and fleet.
+    """
+    if worker_id is not None:
+        row = conn.execute("SELECT * FROM workers WHERE worker_id=?", (worker_id,)).fetchone()
+        return _worker_view(conn, row) if row else {"worker_id": worker_id, "worker_online": False, "heartbeat_age_seconds": None, "current_task": None}
+
+    fleet = fleet_snapshot(conn)
+    workers = fleet["workers"]
+    primary = next((worker for worker in workers if worker["worker_online"]), workers[0] if workers else {})
+    current_task = primary.get("current_task") or _visible_task(
+        conn, "WHERE lower(t.state) LIKE 'processing%' ORDER BY t.updated_at DESC, t.id DESC", ()
+    )
     return {
-        **row,
-        "worker_online": online,
-        "heartbeat_age_seconds": heartbeat_age_seconds,
+        **primary,
+        "worker_online": bool(fleet["fleet"]["online"]),
+        "heartbeat_age_seconds": primary.get("heartbeat_age_seconds"),
         "current_task": current_task,
+        **fleet,
     }
 
 
@@ -778,6 +3376,30 @@ def health():
     return jsonify({"status": "healthy", "shopify_configured": bool(SHOPIFY_STORE_DOMAIN and get_shopify_access_token(SHOPIFY_STORE_DOMAIN)), "timestamp": utcnow()})
 
 
+@app.get("/api/metrics")
+@require_dashboard_auth
+def metrics():
+    """Process-local runtime counters for scraping, plus the cluster-wide sync lease."""
+    with _shopify_clients_lock:
+        clients = list(_shopify_clients.values())
+    conn = get_db()
+    inbox = webhook_inbox_stats(conn)
+    conn.close()
+    return jsonify({"pid": os.getpid(), "db_pool": DB_POOL.stats(), "shopify_credentials": SHOPIFY_CREDENTIALS.stats(), "shopify_clients": [client.state() for client in clients], "sync_leases": {shop: current_lease(sync_lease_name(shop)) for shop in configured_shops()}, "webhook_inbox": inbox, "timestamp": utcnow()})
+
+
+@app.get("/api/analytics/tasks")
+@require_dashboard_auth
+def task_analytics():
+    """Stage and end-to-end latency percentiles plus throughput over ?days= (default 7), optionally for one ?worker=."""
+    days = min(max(request.args.get("days", default=7, type=float), 1 / 24), 90)
+    since = time.time() - days * 86400
+    conn = get_db()
+    report = task_latency_report(conn, since, request.args.get("worker") or None, request_shop())
+    conn.close()
+    return jsonify({"since": datetime.fromtimestamp(since, timezone.utc).isoformat(), "days": days, **report})
+
+
 @app.post("/api/auth/check")
 @require_dashboard_auth
 def auth_check():
@@ -790,10 +3412,12 @@ def dashboard():
     """
     Return Home dashboard metrics from the same orders database used by
     /api/orders. Optional worker and sync metadata can never prevent the
-    primary Shopify order metrics from loading.
+    primary Shopify order metrics from loading. ?shop= narrows every figure
+    to one store.
     """
     conn = get_db()
     today = datetime.now(timezone.utc).date().isoformat()
+    shop = request_shop()
 
     counts = {
         row["state"]: int(row["count"] or 0)
@@ -817,8 +3441,10 @@ def dashboard():
                   AND hidden.order_id=t.order_id
               )
             )
+            AND (? IS NULL OR t.shop_domain=?)
             GROUP BY t.state
-            """
+            """,
+            (shop, shop),
         )
     }
 
@@ -870,8 +3496,9 @@ def dashboard():
             THEN COALESCE(item_count, 0) ELSE 0 END
           ), 0) AS items_today
         FROM orders
+        WHERE ? IS NULL OR shop_domain = ?
         """,
-        (today, today),
+        (today, today, shop, shop),
     ).fetchone()
 
     recent = [
@@ -895,10 +3522,12 @@ def dashboard():
               ), 0) AS verification_tasks
             FROM orders o
             LEFT JOIN tasks t ON t.order_id = o.id
+            WHERE ? IS NULL OR o.shop_domain = ?
             GROUP BY o.id
             ORDER BY o.created_at DESC
             LIMIT 12
-            """
+            """,
+            (shop, shop),
         )
     ]
 
@@ -907,21 +3536,25 @@ def dashboard():
         for record in conn.execute(
             """
             SELECT
-              COALESCE(NULLIF(title, ''), 'Untitled product') AS title,
-              MAX(image_url) AS image_url,
-              COALESCE(SUM(quantity), 0) AS units,
-              COALESCE(SUM(quantity * price), 0) AS revenue
-            FROM line_items
-            GROUP BY title
+              COALESCE(NULLIF(li.title, ''), 'Untitled product') AS title,
+              MAX(li.image_url) AS image_url,
+              COALESCE(SUM(li.quantity), 0) AS units,
+              COALESCE(SUM(li.quantity * li.price), 0) AS revenue
+            FROM line_items li
+            JOIN orders o ON o.id = li.order_id
+            WHERE ? IS NULL OR o.shop_domain = ?
+            GROUP BY li.title
             ORDER BY units DESC
             LIMIT 5
-            """
+            """,
+            (shop, shop),
         )
     ]
 
     try:
         sync_row = conn.execute(
-            "SELECT * FROM sync_runs ORDER BY id DESC LIMIT 1"
+            "SELECT * FROM sync_runs WHERE ? IS NULL OR shop_domain=? ORDER BY id DESC LIMIT 1",
+            (shop, shop),
         ).fetchone()
         last_sync = dict(sync_row) if sync_row else {}
     except sqlite3.Error:
@@ -977,10 +3610,12 @@ def dashboard():
             "cleared_processing_tasks": cleared_processing_tasks,
             "worker": worker,
             "last_sync": last_sync,
-            "store_domain": SHOPIFY_STORE_DOMAIN,
+            "store_domain": shop or SHOPIFY_STORE_DOMAIN,
+            "shop": shop,
+            "shops": configured_shops(),
             "shopify_configured": bool(
-                SHOPIFY_STORE_DOMAIN
-                and get_shopify_access_token(SHOPIFY_STORE_DOMAIN)
+                (shop or SHOPIFY_STORE_DOMAIN)
+                and get_shopify_access_token(shop or SHOPIFY_STORE_DOMAIN)
             ),
         }
     )
@@ -1122,10 +3757,46 @@ def restore_dashboard_list(category: str):
 @require_dashboard_auth
 def sync_shopify():
     body = request.get_json(silent=True) or {}
-    try:
-        return jsonify(sync_shopify_orders(str(body.get("query") or "").strip() or None, max(1, min(int(body.get("max_pages") or 25), 50))))
-    except Exception as exc:
-        return jsonify({"error": str(exc)}), 502
+    mode = "full" if body.get("full_resync") or str(body.get("mode") or "").lower() == "full" else "incremental"
+    shop = normalize_shop_domain(body.get("shop")) or request_shop()
+    if shop and shop not in configured_shops():
+        return jsonify({"error": f"Shop {shop} is not connected"}), 404
+    job, joined = start_shopify_sync_job(str(body.get("query") or "").strip() or None, max(1, min(int(body.get("max_pages") or 25), 50)), mode=mode, shop=shop)
+    return jsonify({**job, "joined": joined}), 202
+
+
+@app.get("/api/shopify/sync/<int:job_id>")
+@require_dashboard_auth
+def shopify_sync_job(job_id: int):
+    conn = get_db()
+    job = get_sync_job(conn, job_id)
+    conn.close()
+    if job is None:
+        return jsonify({"error": "Sync job not found"}), 404
+    return jsonify(job)
+
+
+@app.post("/api/shopify/sync/<int:job_id>/cancel")
+@require_dashboard_auth
+def cancel_shopify_sync_job(job_id: int):
+    conn = get_db()
+    cancelled = cancel_sync_job(conn, job_id)
+    job = get_sync_job(conn, job_id)
+    conn.close()
+    if job is None:
+        return jsonify({"error": "Sync job not found"}), 404
+    return jsonify({**job, "ok": cancelled}), 200 if cancelled else 409
+
+
+@app.route("/api/shopify/backfill", methods=["GET", "POST"])
+@require_dashboard_auth
+def shopify_backfill():
+    shop = request_shop() or current_shop()
+    started = start_shopify_bulk_backfill(shop) if request.method == "POST" else False
+    conn = get_db()
+    backfill = latest_bulk_backfill(conn, shop)
+    conn.close()
+    return jsonify({"started": started, "backfill": backfill}), (202 if started else 200)
 
 
 @app.get("/api/orders")
@@ -1136,6 +3807,10 @@ def get_orders():
     search = request.args.get("search", "").strip()
     status = request.args.get("status", "").strip().upper()
     where, params = [], []
+    shop = request_shop()
+    if shop:
+        where.append("o.shop_domain=?")
+        params.append(shop)
     if search:
         where.append("(o.shopify_order_number LIKE ? OR o.customer_name LIKE ? OR o.tracking_number LIKE ?)")
         params += [f"%{search}%"] * 3
@@ -1181,24 +3856,58 @@ def order_detail(order_id: int):
 def status():
     conn = get_db()
     worker = worker_snapshot(conn)
-    counts = {r["state"]: r["count"] for r in conn.execute("SELECT state,COUNT(*) count FROM tasks GROUP BY state")}
+    shop = request_shop()
+    counts = {r["state"]: r["count"] for r in conn.execute("SELECT state,COUNT(*) count FROM tasks WHERE ? IS NULL OR shop_domain=? GROUP BY state", (shop, shop))}
     conn.close()
-    return jsonify({**worker, "queue_size": counts.get("queued", 0), "verification_count": counts.get("verification_required", 0), "mapping_count": counts.get("needs_mapping", 0), "failed_count": counts.get("failed", 0)})
+    return jsonify({**worker, "queue_size": counts.get("queued", 0), "verification_count": counts.get("verification_required", 0), "mapping_count": counts.get("needs_mapping", 0), "failed_count": counts.get("failed", 0), "retry_count": counts.get("retry_scheduled", 0)})
 
 
 @app.get("/api/tasks/<task_state>")
 @require_dashboard_auth
 def tasks_by_state(task_state: str):
-    allowed = {"verification-required": "verification_required", "needs-mapping": "needs_mapping", "failed": "failed", "queued": "queued", "purchased": "purchased"}
+    allowed = {"verification-required": "verification_required", "needs-mapping": "needs_mapping", "failed": "failed", "queued": "queued", "purchased": "purchased", "retry-scheduled": "retry_scheduled"}
     state = allowed.get(task_state)
     if not state:
         return jsonify({"error": "Unknown task state"}), 404
     conn = get_db()
-    rows = [dict(r) for r in conn.execute("""SELECT t.*,o.shopify_order_number,o.customer_name,li.title product_name,li.sku FROM tasks t JOIN orders o ON o.id=t.order_id LEFT JOIN line_items li ON li.id=t.line_item_id WHERE t.state=? ORDER BY t.updated_at DESC""", (state,))]
+    rows = [dict(r) for r in conn.execute("""SELECT t.*,o.shopify_order_number,o.customer_name,li.title product_name,li.sku FROM tasks t JOIN orders o ON o.id=t.order_id LEFT JOIN line_items li ON li.id=t.line_item_id WHERE t.state=? AND (? IS NULL OR t.shop_domain=?) ORDER BY t.updated_at DESC""", (state, request_shop(), request_shop()))]
     conn.close()
     return jsonify({"tasks": rows})
 
 
+@app.post("/api/tasks/retry")
+@require_dashboard_auth
+def retry_failed_tasks():
+    """
+    Bulk retry, {"failure_class": "stock"|"all", "delay": seconds}: reschedule
+    every failed task of that class (for the ?shop= store) with a fresh
+    attempt budget, due after delay.
+    """
+    body = request.get_json(silent=True) or {}
+    failure_class = str(body.get("failure_class") or "").strip().lower()
+    if failure_class != "all" and failure_class not in TASK_RETRY_POLICY:
+        return jsonify({"error": f"failure_class must be all or one of {', '.join(TASK_RETRY_POLICY)}"}), 400
+    try:
+        delay = max(float(body.get("delay") or 0), 0.0)
+    except (TypeError, ValueError):
+        return jsonify({"error": "delay must be a number of seconds"}), 400
+    conn = get_db()
+    scheduled = conn.execute(
+        """
+        UPDATE tasks SET state='retry_scheduled', attempts=0, next_attempt_at=?, error_message=NULL,
+          last_action='Retry requested', updated_at=?
+        WHERE state='failed' AND (? = 'all' OR failure_class = ?) AND (? IS NULL OR shop_domain = ?)
+        """,
+        (time.time() + delay, utcnow(), failure_class, failure_class, request_shop(), request_shop()),
+    ).rowcount
+    promoted = promote_due_retries(conn)
+    conn.commit()
+    conn.close()
+    if promoted:
+        notify_queue_changed()
+    return jsonify({"scheduled": scheduled, "queued": promoted})
+
+
 @app.get("/api/tasks/verification-required")
 @require_dashboard_auth
 def verification_tasks():
@@ -1231,11 +3940,13 @@ def import_catalog():
     for p in products:
         if not p.get("sku") or not p.get("asin") or not p.get("amazon_url"):
             continue
-        conn.execute("""INSERT INTO products(sku,asin,amazon_url,product_name,buy_price,sell_price,category,is_active,stock_status,notes) VALUES(?,?,?,?,?,?,?,?,?,?) ON CONFLICT(sku) DO UPDATE SET asin=excluded.asin,amazon_url=excluded.amazon_url,product_name=excluded.product_name,buy_price=excluded.buy_price,sell_price=excluded.sell_price,category=excluded.category,is_active=excluded.is_active,stock_status=excluded.stock_status,notes=excluded.notes""", (p["sku"], p["asin"], p["amazon_url"], p.get("product_name"), p.get("buy_price"), p.get("sell_price"), p.get("category"), 1 if p.get("is_active", True) else 0, p.get("stock_status", "in_stock"), p.get("notes", "")))
+        conn.execute("""INSERT INTO products(sku,sku_norm,asin,amazon_url,product_name,buy_price,sell_price,category,is_active,stock_status,notes) VALUES(?,?,?,?,?,?,?,?,?,?,?) ON CONFLICT(sku) DO UPDATE SET sku_norm=excluded.sku_norm,asin=excluded.asin,amazon_url=excluded.amazon_url,product_name=excluded.product_name,buy_price=excluded.buy_price,sell_price=excluded.sell_price,category=excluded.category,is_active=excluded.is_active,stock_status=excluded.stock_status,notes=excluded.notes""", (p["sku"], normalize_sku(p["sku"]), p["asin"], p["amazon_url"], p.get("product_name"), p.get("buy_price"), p.get("sell_price"), p.get("category"), 1 if p.get("is_active", True) else 0, p.get("stock_status", "in_stock"), p.get("notes", "")))
         imported += 1
+    reconciliation = reconcile_task_mappings(conn)
+    version = bump_catalog_version(conn, hashlib.sha256(json.dumps(products, sort_keys=True, default=str).encode()).hexdigest())
     conn.commit()
     conn.close()
-    return jsonify({"status": "imported", "count": imported})
+    return jsonify({"status": "imported", "count": imported, "reconciliation": reconciliation, "catalog_version": version})
 
 
 
@@ -1265,37 +3976,132 @@ def disable_dashboard_caching(response):
 @app.route("/webhooks/shopify/orders-create", methods=["POST"])
 @app.route("/webhooks/shopify/orders-updated", methods=["POST"])
 @app.route("/webhooks/shopify/orders-cancelled", methods=["POST"])
+@app.route("/webhooks/shopify/fulfillments-create", methods=["POST"])
+@app.route("/webhooks/shopify/fulfillments-update", methods=["POST"])
+@app.route("/webhooks/shopify/refunds-create", methods=["POST"])
+@app.route("/webhooks/shopify/products-update", methods=["POST"])
 def order_webhook():
+    """Verify and store the webhook, then acknowledge; the inbox consumer applies it."""
     raw = request.get_data()
     if not verify_shopify_webhook(raw, request.headers.get("X-Shopify-Hmac-Sha256", "")):
         return jsonify({"error": "Invalid signature"}), 401
+    shop = normalize_shop_domain(request.headers.get("X-Shopify-Shop-Domain"))
+    if shop and not is_valid_shop_domain(shop):
+        return jsonify({"error": "Invalid shop domain"}), 400
     try:
-        order = normalize_rest_order(request.get_json(force=True))
-        conn = get_db()
-        _, created = upsert_order(conn, order, create_tasks=True)
+        json.loads(raw)
+    except ValueError:
+        return jsonify({"error": "Invalid JSON payload"}), 400
+    topic = request.headers.get("X-Shopify-Topic") or request.path.rsplit("/", 1)[-1].replace("-", "/", 1)
+    conn = get_db()
+    try:
+        inbox_id = enqueue_webhook(conn, topic, raw, shop or current_shop() or None, request.headers.get("X-Shopify-Webhook-Id"))
         conn.commit()
+    finally:
         conn.close()
-        return jsonify({"status": "created" if created else "updated"})
-    except Exception as exc:
-        return jsonify({"error": str(exc)}), 500
+    if inbox_id is None:
+        return jsonify({"status": "duplicate"})
+    _webhook_inbox_wakeup.set()
+    return jsonify({"status": "queued", "inbox_id": inbox_id})
+
+
+@app.get("/api/webhooks/inbox")
+@require_dashboard_auth
+def webhook_inbox_status():
+    conn = get_db()
+    stats = webhook_inbox_stats(conn)
+    dead = [dict(row) for row in conn.execute(
+        "SELECT id,webhook_id,topic,shop_domain,attempts,last_error,received_at FROM webhook_inbox WHERE status='dead' ORDER BY id DESC LIMIT 50"
+    )]
+    conn.close()
+    return jsonify({**stats, "dead_letters": dead})
+
+
+@app.post("/api/webhooks/inbox/<int:inbox_id>/retry")
+@require_dashboard_auth
+def retry_dead_webhook(inbox_id: int):
+    conn = get_db()
+    cursor = conn.execute(
+        "UPDATE webhook_inbox SET status='pending',attempts=0,next_attempt_at=?,last_error=NULL WHERE id=? AND status='dead'",
+        (time.time(), inbox_id),
+    )
+    conn.commit()
+    conn.close()
+    if not cursor.rowcount:
+        return jsonify({"error": "Dead-letter webhook not found"}), 404
+    _webhook_inbox_wakeup.set()
+    return jsonify({"ok": True, "inbox_id": inbox_id})
 
 
 @app.get("/api/queue/next")
 @require_worker_auth
 def next_task():
+    group = request.args.get("group")
+    batch_size = request.args.get("batch", type=int)
+    if group is None and batch_size:
+        group = "order"
+    if group is not None and group not in TASK_BATCH_GROUPS:
+        return jsonify({"error": f"group must be one of {', '.join(TASK_BATCH_GROUPS)}"}), 400
+    batch_size = min(max(batch_size or QUEUE_MAX_BATCH_SIZE, 1), QUEUE_MAX_BATCH_SIZE)
+    wait = min(max(request.args.get("wait", type=float) or 0.0, 0.0), QUEUE_MAX_WAIT)
+    deadline = time.monotonic() + wait
+
+    signal = _queue_signal
     conn = get_db()
-    refresh_catalog_and_task_mappings(conn)
-    task = get_next_queued_task(conn)
+    generation = queue_generation(conn)
+    catalog_version = refresh_catalog_and_task_mappings(conn)["catalog_version"]
+    shop = request_shop()
+    owner = request_worker_id()
+    if sum(reap_expired_task_leases(conn).values()):
+        conn.commit()
+
+    def claim() -> list[sqlite3.Row]:
+        promote_due_retries(conn)
+        maybe_refresh_task_priorities(conn)
+        claimed: list[sqlite3.Row] = []
+        # Try the fairest shop first, then fall back to the whole queue.
+        for claim_shop in dict.fromkeys([shop or fair_claim_shop(conn), shop]):
+            if group is None:
+                single = claim_next_task(conn, owner, claim_shop)
+                claimed = [single] if single else []
+            else:
+                claimed = claim_task_batch(conn, owner, group, batch_size, claim_shop)
+            if claimed:
+                break
+        conn.commit()
+        return claimed
+
+    tasks = claim()
 
     sync_result = None
 
-    if not task:
+    if not tasks:
         conn.close()
         sync_result = maybe_sync_shopify_for_worker()
 
         conn = get_db()
-        refresh_catalog_and_task_mappings(conn)
-        task = get_next_queued_task(conn)
+        tasks = claim()
+
+    # Long poll: sleep until this process queues work or the shared generation moves.
+    while not tasks and time.monotonic() < deadline:
+        conn.close()
+        signal = wait_for_queue_signal(signal, min(QUEUE_WAIT_POLL_INTERVAL, deadline - time.monotonic()))
+        conn = get_db()
+        if promote_due_retries(conn):
+            conn.commit()
+        current = queue_generation(conn)
+        if current != generation:
+            generation = current
+            tasks = claim()
+
+    task = tasks[0] if tasks else None
+    if task:
+        conn.execute(
+            "INSERT INTO workers(worker_id,first_seen_at,tasks_claimed) VALUES(?,?,?) "
+            "ON CONFLICT(worker_id) DO UPDATE SET tasks_claimed=tasks_claimed+excluded.tasks_claimed",
+            (owner, utcnow(), len(tasks)),
+        )
+        conn.commit()
 
     if not task:
         diagnostics = {
@@ -1304,8 +4110,10 @@ def next_task():
                 """
                 SELECT state, COUNT(*) AS count
                 FROM tasks
+                WHERE ? IS NULL OR shop_domain = ?
                 GROUP BY state
-                """
+                """,
+                (shop, shop),
             )
         }
         conn.close()
@@ -1313,31 +4121,24 @@ def next_task():
         return jsonify(
             {
                 "task": None,
+                "batch": None,
                 "queue_counts": diagnostics,
                 "shopify_sync": sync_result,
+                "catalog_version": catalog_version,
             }
         )
 
-    conn.execute(
-        """
-        UPDATE tasks
-        SET
-          state = 'processing_opened_url',
-          updated_at = ?,
-          last_action = 'Worker pulled task'
-        WHERE id = ?
-          AND state = 'queued'
-        """,
-        (utcnow(), task["id"]),
-    )
-    conn.commit()
     result = dict(task)
+    product = get_catalog_snapshot(conn).lookup(sku=task["sku_norm"], asin=task["asin"])
     conn.close()
 
     return jsonify(
         {
             "task": result,
+            "batch": describe_task_batch(tasks, group) if group else None,
+            "catalog_product": dict(product) if product else None,
             "shopify_sync": sync_result,
+            "catalog_version": catalog_version,
         }
     )
 
@@ -1350,27 +4151,118 @@ def update_task(task_id: int):
     if not state:
         return jsonify({"error": "state required"}), 400
     conn = get_db()
-    conn.execute("UPDATE tasks SET state=?,error_message=?,amazon_order_id=?,last_action=?,updated_at=? WHERE id=?", (state, body.get("error_message"), body.get("amazon_order_id"), body.get("last_action"), utcnow(), task_id))
+    outcome = apply_task_update(conn, task_id, request_worker_id(), body)
     conn.commit()
     conn.close()
+    if outcome == "not_found":
+        return jsonify({"error": "Task not found"}), 404
+    if outcome == "conflict":
+        return jsonify({"error": "Task is leased to another worker"}), 409
+    if state == "queued":
+        notify_queue_changed()
     return jsonify({"status": "updated"})
 
 
+@app.post("/api/queue/updates")
+@require_worker_auth
+def update_tasks():
+    """
+    Apply an ordered list of worker transitions, {"updates": [{"task_id", "state", ...}]},
+    across any number of tasks in one transaction. Each item succeeds or fails
+    on its own (a savepoint per item) and reports its status by index; the
+    notifications for applied items are written in the same transaction.
+    """
+    items = (request.get_json(silent=True) or {}).get("updates")
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "updates must be a non-empty list"}), 400
+    if len(items) > QUEUE_MAX_UPDATES:
+        return jsonify({"error": f"at most {QUEUE_MAX_UPDATES} updates per request"}), 400
+    owner = request_worker_id()
+    results = []
+    conn = get_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for index, item in enumerate(items):
+            task_id = item.get("task_id") if isinstance(item, dict) else None
+            if not isinstance(task_id, int) or not str(item.get("state") or "").strip():
+                results.append({"index": index, "task_id": task_id, "status": "invalid", "error": "task_id and state required"})
+                continue
+            conn.execute("SAVEPOINT task_update")
+            try:
+                status = apply_task_update(conn, task_id, owner, item)
+            except sqlite3.Error as exc:
+                conn.execute("ROLLBACK TO task_update")
+                results.append({"index": index, "task_id": task_id, "status": "error", "error": str(exc)})
+            else:
+                results.append({"index": index, "task_id": task_id, "status": status})
+            finally:
+                conn.execute("RELEASE task_update")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if any(result["status"] == "updated" and items[result["index"]].get("state") == "queued" for result in results):
+        notify_queue_changed()
+    counts = {status: sum(1 for result in results if result["status"] == status) for status in ("updated", "conflict", "not_found", "invalid", "error")}
+    return jsonify({"results": results, **counts})
+
+
+@app.post("/api/queue/batches/<batch_id>/result")
+@require_worker_auth
+def record_batch_result(batch_id: str):
+    """
+    Record a batch checkout's outcome. Body: {"results": [{"task_id", "state", ...}]}
+    for per-task outcomes, and/or top-level state/amazon_order_id/error_message
+    applied to every task of the batch without its own entry.
+    """
+    body = request.get_json(silent=True) or {}
+    results = body.get("results") or []
+    if not isinstance(results, list) or any(not isinstance(result, dict) or not isinstance(result.get("task_id"), int) for result in results):
+        return jsonify({"error": "results must be a list of objects with an integer task_id"}), 400
+    owner = request_worker_id()
+    conn = get_db()
+    task_ids = [row["id"] for row in conn.execute("SELECT id FROM tasks WHERE batch_id=? ORDER BY id", (batch_id,))]
+    if not task_ids:
+        conn.close()
+        return jsonify({"error": "Batch not found"}), 404
+    shared = {key: body.get(key) for key in ("state", "amazon_order_id", "error_message", "last_action")}
+    per_task = {result["task_id"]: result for result in results}
+    updates = {task_id: per_task.get(task_id, shared) for task_id in task_ids}
+    if any(not str(update.get("state") or "").strip() for update in updates.values()) or set(per_task) - set(task_ids):
+        conn.close()
+        return jsonify({"error": "every task of the batch needs a state, and results may only name its tasks"}), 400
+    applied, rejected = [], []
+    for task_id, update in updates.items():
+        (applied if apply_task_update(conn, task_id, owner, update) == "updated" else rejected).append(task_id)
+    conn.commit()
+    conn.close()
+    if any(updates[task_id].get("state") == "queued" for task_id in applied):
+        notify_queue_changed()
+    return jsonify({"batch_id": batch_id, "updated": applied, "rejected": rejected}), (200 if applied else 409)
+
+
 @app.post("/api/worker/heartbeat")
 @require_worker_auth
 def heartbeat():
     body = request.get_json(silent=True) or {}
+    worker_id = request_worker_id()
     conn = get_db()
 
     task_id = body.get("task_id")
     clear_current_task = bool(body.get("clear_current_task"))
+    now = utcnow()
 
+    conn.execute(
+        "INSERT OR IGNORE INTO workers(worker_id,first_seen_at) VALUES(?,?)",
+        (worker_id, now),
+    )
     if clear_current_task:
         conn.execute(
             """
-            UPDATE worker_status
+            UPDATE workers
             SET
-              is_online=1,
               last_heartbeat_at=?,
               last_action=?,
               last_error=?,
@@ -1380,20 +4272,20 @@ def heartbeat():
               current_product_name=NULL,
               current_task_state=NULL,
               current_task_started_at=NULL
-            WHERE id=1
+            WHERE worker_id=?
             """,
             (
-                utcnow(),
+                now,
                 body.get("action", "Worker idle"),
                 body.get("error"),
+                worker_id,
             ),
         )
     else:
         conn.execute(
             """
-            UPDATE worker_status
+            UPDATE workers
             SET
-              is_online=1,
               last_heartbeat_at=?,
               last_action=?,
               last_error=?,
@@ -1411,10 +4303,10 @@ def heartbeat():
                 THEN ?
                 ELSE current_task_started_at
               END
-            WHERE id=1
+            WHERE worker_id=?
             """,
             (
-                utcnow(),
+                now,
                 body.get("action", "Heartbeat"),
                 body.get("error"),
                 task_id,
@@ -1424,19 +4316,28 @@ def heartbeat():
                 body.get("task_state"),
                 task_id,
                 task_id,
-                utcnow(),
+                now,
+                worker_id,
             ),
         )
 
+    lease_expires_at = None
+    if body.get("batch_id") and not clear_current_task:
+        lease_expires_at = renew_batch_lease(conn, str(body["batch_id"]), worker_id)
+    elif task_id and not clear_current_task:
+        lease_expires_at = renew_task_lease(conn, int(task_id), worker_id)
+
     conn.commit()
-    worker = worker_snapshot(conn)
+    worker = worker_snapshot(conn, worker_id)
     conn.close()
 
     return jsonify(
         {
             "status": "ok",
+            "worker_id": worker_id,
             "worker_online": worker.get("worker_online"),
             "current_task": worker.get("current_task"),
+            "lease_expires_at": lease_expires_at,
         }
     )
 
@@ -1499,30 +4400,6 @@ def shopify_callback():
 
 
 
-def _load_repository_product_skus() -> tuple[set[str], str | None]:
-    """Load active SKU values from the repository-root products.json."""
-    try:
-        with open(PRODUCTS_JSON_PATH, "r", encoding="utf-8") as handle:
-            payload = json.load(handle)
-
-        products = payload.get("products", payload) if isinstance(payload, dict) else payload
-        if not isinstance(products, list):
-            return set(), "products.json must contain a list of products"
-
-        skus = {
-            str(product.get("sku") or "").strip().upper()
-            for product in products
-            if isinstance(product, dict)
-            and product.get("is_active", True)
-            and str(product.get("sku") or "").strip()
-        }
-        return skus, None
-    except FileNotFoundError:
-        return set(), f"products.json was not found at {PRODUCTS_JSON_PATH}"
-    except (OSError, ValueError, TypeError) as exc:
-        return set(), str(exc)
-
-
 @app.get("/api/operations/queue")
 @require_dashboard_auth
 def bot_queue_orders():
@@ -1535,6 +4412,7 @@ def bot_queue_orders():
     """
     conn = get_db()
     worker = worker_snapshot(conn)
+    priority_policy = queue_priority_policy(conn)
 
     waiting_rows = [
         dict(row)
@@ -1546,6 +4424,7 @@ def bot_queue_orders():
               t.created_at AS queued_at,
               t.updated_at,
               t.quantity,
+              t.priority,
               o.id AS order_id,
               o.shopify_order_number,
               o.customer_name,
@@ -1556,14 +4435,16 @@ def bot_queue_orders():
             JOIN orders o ON o.id=t.order_id
             LEFT JOIN line_items li ON li.id=t.line_item_id
             WHERE lower(t.state)='queued'
+              AND (? IS NULL OR t.shop_domain=?)
               AND NOT EXISTS(
                 SELECT 1
                 FROM dashboard_hidden_orders hidden
                 WHERE hidden.category='queue'
                   AND hidden.order_id=t.order_id
               )
-            ORDER BY t.created_at ASC, t.id ASC
-            """
+            ORDER BY t.priority DESC, t.created_at ASC, t.id ASC
+            """,
+            (request_shop(), request_shop()),
         )
     ]
 
@@ -1592,6 +4473,7 @@ def bot_queue_orders():
                     "product_name": row.get("product_name"),
                     "sku": row.get("sku"),
                     "quantity": row.get("quantity"),
+                    "priority": row.get("priority"),
                     "queued_at": row.get("queued_at"),
                     "updated_at": row.get("updated_at"),
                 }
@@ -1638,6 +4520,8 @@ def bot_queue_orders():
         {
             "worker": worker,
             "worker_online": bool(worker.get("worker_online")),
+            "workers": worker["workers"],
+            "fleet": worker["fleet"],
             "current_order": current_order,
             "active_order": current_order,
             "next_order": next_order,
@@ -1645,17 +4529,44 @@ def bot_queue_orders():
             "waiting_order_count": len(waiting_orders),
             "waiting_task_count": len(waiting_rows),
             "bot_is_processing": bool(current_order),
+            "priority_policy": priority_policy,
         }
     )
 
 
+@app.put("/api/operations/queue/policy")
+@require_dashboard_auth
+def update_queue_priority_policy():
+    """Save queue scoring weights over the defaults and rescore every queued task."""
+    body = request.get_json(silent=True)
+    try:
+        if not isinstance(body, dict):
+            raise ValueError("policy must be a JSON object")
+        changes = validate_queue_priority_policy(body)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    conn = get_db()
+    saved = _saved_queue_priority_policy(conn)
+    saved.update(changes)
+    set_app_state(conn, "queue_priority_policy", json.dumps(saved))
+    rescored = recompute_task_priorities(conn)
+    set_app_state(conn, "queue_priority_refreshed_at", time.time())
+    conn.commit()
+    policy = queue_priority_policy(conn)
+    conn.close()
+    if rescored:
+        notify_queue_changed()
+    return jsonify({"policy": policy, "rescored": rescored})
+
+
 @app.get("/api/operations/mapping")
 @require_dashboard_auth
 def orders_needing_product_mapping():
-    """Return orders containing SKUs absent from repository products.json."""
-    catalog_skus, catalog_error = _load_repository_product_skus()
+    """Return orders containing SKUs absent from the active products catalog."""
+    catalog_error = CATALOG_TRACKER.probe()["error"]
 
     conn = get_db()
+    snapshot = get_catalog_snapshot(conn)
     rows = [
         dict(row)
         for row in conn.execute(
@@ -1694,8 +4605,8 @@ def orders_needing_product_mapping():
     for row in rows:
         if int(row["order_id"]) in hidden_mapping_orders:
             continue
-        normalized_sku = str(row.get("sku") or "").strip().upper()
-        if normalized_sku and normalized_sku in catalog_skus:
+        normalized_sku = normalize_sku(row.get("sku"))
+        if normalized_sku and normalized_sku in snapshot.by_sku:
             continue
 
         missing_item_count += 1
@@ -1733,7 +4644,8 @@ def orders_needing_product_mapping():
             "orders": list(grouped.values()),
             "order_count": len(grouped),
             "missing_item_count": missing_item_count,
-            "catalog_sku_count": len(catalog_skus),
+            "catalog_sku_count": len(snapshot.by_sku),
+            "catalog_version": snapshot.version,
             "catalog_error": catalog_error,
         }
     )
@@ -1745,11 +4657,12 @@ def shopify_status():
     Public, token-safe connection status used only for troubleshooting.
     Never returns the access token.
     """
-    token = get_shopify_access_token(SHOPIFY_STORE_DOMAIN)
+    shop = request_shop() or current_shop()
+    token = get_shopify_access_token(shop)
     return jsonify(
         {
             "connected": bool(token),
-            "shop": SHOPIFY_STORE_DOMAIN,
+            "shop": shop,
             "database_path": DATABASE_PATH,
         }
     )
@@ -1759,10 +4672,21 @@ def shopify_status():
 @app.post("/api/shopify/webhooks/register")
 @require_dashboard_auth
 def register_shopify_webhooks():
+    shop = normalize_shop_domain((request.get_json(silent=True) or {}).get("shop")) or request_shop() or current_shop()
+    with shopify_shop(shop):
+        response, status = _register_shopify_webhooks()
+    return jsonify({**response, "shop": shop}), status
+
+
+def _register_shopify_webhooks() -> tuple[dict[str, Any], int]:
     topics = {
         "ORDERS_CREATE": f"{SHOPIFY_WEBHOOK_BASE_URL}/webhooks/shopify/orders-create",
         "ORDERS_UPDATED": f"{SHOPIFY_WEBHOOK_BASE_URL}/webhooks/shopify/orders-updated",
         "ORDERS_CANCELLED": f"{SHOPIFY_WEBHOOK_BASE_URL}/webhooks/shopify/orders-cancelled",
+        "FULFILLMENTS_CREATE": f"{SHOPIFY_WEBHOOK_BASE_URL}/webhooks/shopify/fulfillments-create",
+        "FULFILLMENTS_UPDATE": f"{SHOPIFY_WEBHOOK_BASE_URL}/webhooks/shopify/fulfillments-update",
+        "REFUNDS_CREATE": f"{SHOPIFY_WEBHOOK_BASE_URL}/webhooks/shopify/refunds-create",
+        "PRODUCTS_UPDATE": f"{SHOPIFY_WEBHOOK_BASE_URL}/webhooks/shopify/products-update",
     }
     query = """query ExistingWebhookSubscriptions($first:Int!){webhookSubscriptions(first:$first){nodes{id topic endpoint{... on WebhookHttpEndpoint{callbackUrl}}}}}"""
     nodes = shopify_graphql(query, {"first": 100}).get("webhookSubscriptions", {}).get("nodes", [])
@@ -1781,20 +4705,20 @@ def register_shopify_webhooks():
                 created.append({"topic": topic, "callback_url": callback_url})
         except Exception as exc:
             errors.append({"topic": topic, "errors": [{"message": str(exc)}]})
-    return jsonify({"ok": not errors, "created": created, "already_registered": already_registered, "errors": errors}), (200 if not errors else 207)
+    return {"ok": not errors, "created": created, "already_registered": already_registered, "errors": errors}, (200 if not errors else 207)
 
 
 @app.get("/api/orders/latest")
 @require_dashboard_auth
 def latest_order():
     conn = get_db()
-    row = conn.execute("""SELECT id,shopify_order_id,shopify_order_number,customer_name,current_total_price,total_price,currency,item_count,created_at,financial_status,fulfillment_status,source_name FROM orders ORDER BY id DESC LIMIT 1""").fetchone()
+    row = conn.execute("""SELECT id,shopify_order_id,shopify_order_number,customer_name,current_total_price,total_price,currency,item_count,created_at,financial_status,fulfillment_status,source_name,shop_domain FROM orders WHERE ? IS NULL OR shop_domain=? ORDER BY id DESC LIMIT 1""", (request_shop(), request_shop())).fetchone()
     order = dict(row) if row else None
     if order:
         items = [dict(item) for item in conn.execute(
             """SELECT li.*, p.buy_price, p.sell_price
                FROM line_items li
-               LEFT JOIN products p ON UPPER(TRIM(p.sku)) = UPPER(TRIM(li.sku))
+               LEFT JOIN products p ON p.sku_norm = li.sku_norm
                WHERE li.order_id=? ORDER BY li.id LIMIT 4""",
             (order["id"],),
         )]
@@ -1883,6 +4807,7 @@ def worker_pipeline_status():
         {
             "products_json_path": PRODUCTS_JSON_PATH,
             "active_catalog_products": product_count,
+            "catalog_version": catalog_result["catalog_version"],
             "catalog_refresh": catalog_result,
             "task_counts": task_counts,
             "latest_order": dict(latest_order) if latest_order else None,
@@ -1895,7 +4820,7 @@ def worker_pipeline_status():
 @require_dashboard_auth
 def repair_catalog_tasks():
     conn = get_db()
-    result = refresh_catalog_and_task_mappings(conn)
+    result = refresh_catalog_and_task_mappings(conn, force=True)
     conn.close()
     return jsonify(
         {
@@ -1914,27 +4839,36 @@ def worker_auth_check():
 @app.post("/api/shopify/live-sync")
 @require_dashboard_auth
 def live_shopify_sync():
-    before_conn = get_db()
-    before_id = int(before_conn.execute("SELECT COALESCE(MAX(id),0) AS latest_id FROM orders").fetchone()["latest_id"] or 0)
-    before_conn.close()
+    """Report orders newer than since_id plus the scheduler's latest sync; never calls Shopify."""
+    body = request.get_json(silent=True) or {}
+    conn = get_db()
+    scheduler = sync_scheduler_state(conn)
+    new_orders = []
+    if body.get("since_id") is not None:
+        new_orders = [dict(row) for row in conn.execute(
+            """SELECT id,shopify_order_id,shopify_order_number,customer_name,current_total_price,total_price,currency,item_count,created_at,financial_status,fulfillment_status
+               FROM orders WHERE id>? AND (? IS NULL OR shop_domain=?) ORDER BY id ASC""",
+            (int(body.get("since_id") or 0), request_shop(), request_shop())
+        )]
+    conn.close()
+    return jsonify({**(scheduler.get("last_result") or {}), "scheduler": scheduler, "new_orders": new_orders, "new_order_count": len(new_orders)})
 
-    result = sync_shopify_orders(max_pages=1)
 
-    after_conn = get_db()
-    new_orders = [dict(row) for row in after_conn.execute(
-        """SELECT id,shopify_order_id,shopify_order_number,customer_name,current_total_price,total_price,currency,item_count,created_at,financial_status,fulfillment_status
-           FROM orders WHERE id>? ORDER BY id ASC""",
-        (before_id,)
-    )]
-    after_conn.close()
-    return jsonify({**result, "new_orders": new_orders, "new_order_count": len(new_orders)})
+@app.get("/api/shopify/scheduler")
+@require_dashboard_auth
+def shopify_scheduler_status():
+    conn = get_db()
+    state = sync_scheduler_state(conn)
+    conn.close()
+    return jsonify(state)
 
 
 @app.get("/api/shopify/connection")
 @require_dashboard_auth
 def shopify_connection_status():
-    connection = get_shopify_connection(SHOPIFY_STORE_DOMAIN)
-    return jsonify({"connected": bool(connection), "shop_domain": SHOPIFY_STORE_DOMAIN, "granted_scopes": connection.get("granted_scopes") if connection else "", "installed_at": connection.get("installed_at") if connection else None})
+    shop = request_shop() or current_shop()
+    connection = get_shopify_connection(shop)
+    return jsonify({"connected": bool(connection), "shop_domain": shop, "granted_scopes": connection.get("granted_scopes") if connection else "", "installed_at": connection.get("installed_at") if connection else None, "shops": configured_shops()})
 
 
 @app.get("/")
@@ -1948,6 +4882,8 @@ def static_file(path: str):
 
 
 if __name__ == "__main__":
+    start_sync_scheduler()
+    start_webhook_consumer()
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", "5000")), debug=False)
 
 
@@ -1,9 +1,13 @@
 """FulfillmentPro production entrypoint with live bridge UI injection."""
 from __future__ import annotations
 
+import backend
 from live_bridge import app
 import notification_extension  # noqa: F401,E402
 
+backend.start_sync_scheduler()
+backend.start_webhook_consumer()
+
 
 @app.after_request
 def inject_live_bridge_script(response):
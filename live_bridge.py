@@ -18,6 +18,7 @@ DROPSHIPPING_PLATFORM_URL = os.getenv(
     "https://dropshipping-management-ten.vercel.app",
 ).rstrip("/")
 BRIDGE_SHARED_SECRET = os.getenv("BRIDGE_SHARED_SECRET", "")
+SYNC_PROGRESS_POLL_INTERVAL = float(os.getenv("SYNC_PROGRESS_POLL_INTERVAL", "0.5"))
 
 
 def _platform_headers() -> dict[str, str]:
@@ -92,7 +93,11 @@ def integration_live_status():
             "id": "worker",
             "label": "Fulfillment Bot",
             "online": bool(worker.get("worker_online")),
-            "detail": worker.get("last_action") or "No recent heartbeat",
+            "detail": (
+                f"{worker['fleet']['online']} of {worker['fleet']['total']} workers online"
+                if worker["fleet"]["total"] > 1
+                else worker.get("last_action") or "No recent heartbeat"
+            ),
         },
     ]
 
@@ -108,6 +113,9 @@ def integration_live_status():
 @app.post("/api/integrations/sync-progress")
 @backend.require_dashboard_auth
 def integration_sync_progress():
+    """Stream a sync job's progress as NDJSON; body job_id follows an existing job."""
+    job_id = (request.get_json(silent=True) or {}).get("job_id")
+
     @stream_with_context
     def generate():
         def event(progress: int, stage: str, message: str, **extra: Any) -> str:
@@ -121,16 +129,53 @@ def integration_sync_progress():
             ) + "\n"
 
         try:
-            yield event(3, "starting", "Checking Shopify and connected systems…")
-            yield event(12, "shopify", "Downloading current Shopify orders…")
+            if job_id:
+                conn = backend.get_db()
+                job = backend.get_sync_job(conn, job_id)
+                conn.close()
+                if job is None:
+                    yield event(100, "failed", "Sync job not found", done=True, error="job_not_found")
+                    return
+                joined = True
+            else:
+                job, joined = backend.start_shopify_sync_job(max_pages=25)
+            yield event(
+                3,
+                "starting",
+                f"Following sync job #{job['job_id']}…" if joined else f"Started sync job #{job['job_id']}…",
+                job_id=job["job_id"],
+            )
 
-            result = backend.sync_shopify_orders(max_pages=25)
+            reported = None
+            while True:
+                snapshot = (job["status"], job["pages"], job["imported"], job["updated"], job["unchanged"])
+                if snapshot != reported:
+                    reported = snapshot
+                    yield event(
+                        min(85, job["progress"] * 85 // 100),
+                        "shopify",
+                        (
+                            f"Page {job['pages']} of up to {job['max_pages']}: "
+                            f"{job['imported']} created, {job['updated']} updated, {job['unchanged']} unchanged"
+                        ),
+                        job=job,
+                    )
+                if job["done"]:
+                    break
+                time.sleep(SYNC_PROGRESS_POLL_INTERVAL)
+                conn = backend.get_db()
+                job = backend.get_sync_job(conn, job["job_id"])
+                conn.close()
+
+            if job["status"] == "failed":
+                raise RuntimeError(job["error_message"] or "Shopify sync failed")
+            result = job["result"] or job
 
             yield event(
-                78,
+                88,
                 "orders-complete",
                 (
-                    f"Orders synced: {result.get('imported', 0)} imported, "
+                    f"Orders synced ({job['status']}): {result.get('imported', 0)} imported, "
                     f"{result.get('updated', 0)} updated"
                 ),
             )
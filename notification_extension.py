@@ -7,7 +7,6 @@ from __future__ import annotations
 
 import hashlib
 import json
-import re
 import sqlite3
 from typing import Any
 
@@ -93,10 +92,10 @@ def _order_context(conn: sqlite3.Connection, order_id: int) -> dict[str, Any]:
 
 
 _original_upsert_order = backend.upsert_order
+_original_upsert_orders = backend.upsert_orders
 
 
-def _upsert_order_with_notifications(conn: sqlite3.Connection, order: dict[str, Any], create_tasks: bool = True):
-    order_id, created = _original_upsert_order(conn, order, create_tasks=create_tasks)
+def _notify_order(conn: sqlite3.Connection, order: dict[str, Any], order_id: int, created: bool) -> None:
     context = _order_context(conn, order_id)
     if created:
         emit("order_placed", event_key=f"order:{order.get('shopify_order_id')}:created", order_id=order_id,
@@ -107,10 +106,33 @@ def _upsert_order_with_notifications(conn: sqlite3.Connection, order: dict[str,
     elif str(order.get("fulfillment_status") or "").upper() in {"FULFILLED", "SUCCESS"}:
         emit("fulfillment_succeeded", event_key=f"order:{order.get('shopify_order_id')}:fulfilled", order_id=order_id,
              message=f"Order #{context.get('shopify_order_number') or order_id} was fulfilled successfully.", metadata=context, resolve_order=True, conn=conn)
+
+
+def _upsert_order_with_notifications(conn: sqlite3.Connection, order: dict[str, Any], create_tasks: bool = True):
+    order_id, created = _original_upsert_order(conn, order, create_tasks=create_tasks)
+    _notify_order(conn, order, order_id, created)
     return order_id, created
 
 
+def _upsert_orders_with_notifications(conn: sqlite3.Connection, orders: list[dict[str, Any]], create_tasks: bool = True):
+    summary = _original_upsert_orders(conn, orders, create_tasks=create_tasks)
+    for order, result in zip(orders, summary["results"]):
+        if result["status"] in {"created", "updated"}:
+            _notify_order(conn, order, result["order_id"], result["status"] == "created")
+    return summary
+
+
 backend.upsert_order = _upsert_order_with_notifications
+backend.upsert_orders = _upsert_orders_with_notifications
+
+
+def _notify_worker_offline(conn: sqlite3.Connection, worker: dict[str, Any]) -> None:
+    emit("worker_offline", event_key=f"worker:{worker['worker_id']}:offline:{worker.get('last_heartbeat_at')}",
+         message=f"Worker {worker['worker_id']} has not sent a heartbeat since {worker.get('last_heartbeat_at')}.",
+         metadata={key: worker.get(key) for key in ("worker_id", "last_heartbeat_at", "last_action", "last_error", "current_task_id")}, conn=conn)
+
+
+backend.on_worker_offline = _notify_worker_offline
 
 
 def _task_event(state: str, body: dict[str, Any]) -> tuple[str, bool] | None:
@@ -128,26 +150,21 @@ def _task_event(state: str, body: dict[str, Any]) -> tuple[str, bool] | None:
     return None
 
 
-@app.after_request
-def capture_worker_notification(response):
-    match = re.fullmatch(r"/api/queue/(\d+)/update", request.path)
-    if match and request.method == "POST" and response.status_code < 400:
-        body = request.get_json(silent=True) or {}
-        state = str(body.get("state") or "")
-        task_id = int(match.group(1))
-        event = _task_event(state, body)
-        if event:
-            conn = backend.get_db()
-            row = conn.execute("SELECT t.order_id,o.shopify_order_number,li.title product_name FROM tasks t LEFT JOIN orders o ON o.id=t.order_id LEFT JOIN line_items li ON li.id=t.line_item_id WHERE t.id=?", (task_id,)).fetchone()
-            context = dict(row) if row else {}
-            event_type, resolve = event
-            emit(event_type, event_key=f"task:{task_id}:{state}:{body.get('amazon_order_id') or body.get('last_action') or ''}",
-                 order_id=context.get("order_id"), task_id=task_id,
-                 message=body.get("error_message") or body.get("last_action") or f"{EVENTS[event_type]['title']} for order #{context.get('shopify_order_number') or context.get('order_id') or ''}.",
-                 metadata={**context, **body}, resolve_order=resolve, conn=conn)
-            conn.commit()
-            conn.close()
-    return response
+def _notify_task_transition(conn: sqlite3.Connection, task_id: int, body: dict[str, Any]) -> None:
+    state = str(body.get("state") or "")
+    event = _task_event(state, body)
+    if not event:
+        return
+    row = conn.execute("SELECT t.order_id,o.shopify_order_number,li.title product_name FROM tasks t LEFT JOIN orders o ON o.id=t.order_id LEFT JOIN line_items li ON li.id=t.line_item_id WHERE t.id=?", (task_id,)).fetchone()
+    context = dict(row) if row else {}
+    event_type, resolve = event
+    emit(event_type, event_key=f"task:{task_id}:{state}:{body.get('amazon_order_id') or body.get('last_action') or ''}",
+         order_id=context.get("order_id"), task_id=task_id,
+         message=body.get("error_message") or body.get("last_action") or f"{EVENTS[event_type]['title']} for order #{context.get('shopify_order_number') or context.get('order_id') or ''}.",
+         metadata={**context, **body}, resolve_order=resolve, conn=conn)
+
+
+backend.TASK_TRANSITION_HOOKS.append(_notify_task_transition)
 
 
 @app.get("/api/notifications/events")
@@ -29,10 +29,31 @@ async function syncShopify() {
       }
     });
 
-    const result = await response.json();
+    let job = await response.json();
 
     if (!response.ok) {
-      alert(result.error || "Shopify sync failed");
+      alert(job.error || "Shopify sync failed");
+      return;
+    }
+
+    const jobId = job.job_id;
+
+    while (!job.done) {
+      button.textContent = `Syncing... ${job.progress}%`;
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+      const poll = await fetch(`/api/shopify/sync/${jobId}`);
+      const update = await poll.json().catch(() => ({}));
+
+      if (!poll.ok) {
+        alert(update.error || `Shopify sync status check failed (${poll.status})`);
+        return;
+      }
+
+      job = update;
+    }
+
+    if (job.status === "failed") {
+      alert(job.error_message || "Shopify sync failed");
     } else {
       alert("Shopify sync completed");
       window.location.reload();
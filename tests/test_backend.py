@@ -10,7 +10,7 @@ def test_health_and_auth(tmp_path):
     app=load_app(tmp_path).app.test_client();assert app.get('/health').status_code==200;assert app.get('/api/dashboard').status_code==401;assert app.post('/api/auth/check',headers=auth()).status_code==200
 
 def test_webhook_persists_order(tmp_path):
-    mod=load_app(tmp_path);app=mod.app.test_client();payload={'id':123,'order_number':1407,'email':'buyer@example.com','total_price':'33.16','current_total_price':'33.16','currency':'USD','financial_status':'paid','fulfillment_status':None,'created_at':'2026-07-15T01:00:00Z','updated_at':'2026-07-15T01:00:00Z','shipping_address':{'first_name':'Marcus','last_name':'Hawkins','city':'Tempe','province_code':'AZ'},'line_items':[{'id':9,'title':'Test Product','sku':'B000TEST','quantity':1,'price':'33.16'}]};raw=json.dumps(payload,separators=(',',':')).encode();sig=base64.b64encode(hmac.new(b'webhook-secret',raw,hashlib.sha256).digest()).decode();r=app.post('/webhooks/shopify/orders-create',data=raw,headers={'Content-Type':'application/json','X-Shopify-Hmac-Sha256':sig});assert r.status_code==200;d=app.get('/api/dashboard',headers=auth()).get_json();assert d['total_orders']==1 and d['revenue']==33.16 and d['needs_mapping']==1
+    mod=load_app(tmp_path);app=mod.app.test_client();payload={'id':123,'order_number':1407,'email':'buyer@example.com','total_price':'33.16','current_total_price':'33.16','currency':'USD','financial_status':'paid','fulfillment_status':None,'created_at':'2026-07-15T01:00:00Z','updated_at':'2026-07-15T01:00:00Z','shipping_address':{'first_name':'Marcus','last_name':'Hawkins','city':'Tempe','province_code':'AZ'},'line_items':[{'id':9,'title':'Test Product','sku':'B000TEST','quantity':1,'price':'33.16'}]};raw=json.dumps(payload,separators=(',',':')).encode();sig=base64.b64encode(hmac.new(b'webhook-secret',raw,hashlib.sha256).digest()).decode();r=app.post('/webhooks/shopify/orders-create',data=raw,headers={'Content-Type':'application/json','X-Shopify-Hmac-Sha256':sig});assert r.status_code==200 and r.get_json()['status']=='queued';assert mod.drain_webhook_inbox()['processed']==1;d=app.get('/api/dashboard',headers=auth()).get_json();assert d['total_orders']==1 and d['revenue']==33.16 and d['needs_mapping']==1
 
 def test_worker_queue_contract(tmp_path):
     mod=load_app(tmp_path);app=mod.app.test_client();conn=mod.get_db();conn.execute("INSERT INTO products(sku,asin,amazon_url,product_name,is_active) VALUES('X','X','https://example.com/p','P',1)");order={'shopify_order_id':'1','shopify_order_number':'1','customer_name':'Test','customer_email':'x','shipping_address':'{}','total_price':10,'subtotal_price':10,'current_total_price':10,'refunds_total':0,'currency':'USD','created_at':mod.utcnow(),'updated_at':mod.utcnow(),'shopify_updated_at':mod.utcnow(),'processed_at':None,'cancelled_at':None,'closed_at':None,'financial_status':'PAID','fulfillment_status':'UNFULFILLED','delivery_status':None,'source_name':'web','shipping_method':'Shipping','tracking_company':None,'tracking_number':None,'tracking_url':None,'tags':'[]','item_count':1,'synced_at':mod.utcnow(),'line_items':[{'id':'li1','title':'P','sku':'X','quantity':1,'price':10}]};mod.upsert_order(conn,order,True);conn.commit();conn.close();assert app.get('/api/queue/next',headers={'Authorization':'Bearer worker-secret'}).get_json()['task'] is not None
@@ -63,3 +63,531 @@ def test_shopify_callback_rejects_bad_state_and_hmac(tmp_path):
     assert app.get('/shopify/callback?'+urlencode(params)).status_code==401
     params['state']=state;params['hmac']='bad'
     assert app.get('/shopify/callback?'+urlencode(params)).status_code==401
+
+def test_db_pool_reuses_connections_and_reports_stats(tmp_path):
+    mod=load_app(tmp_path);app=mod.app.test_client()
+    first=mod.get_db();first.execute("INSERT INTO push_tokens(token,created_at) VALUES('t1','now')");first.close()
+    second=mod.get_db();assert second is first
+    assert second.execute("SELECT COUNT(*) FROM push_tokens").fetchone()[0]==0
+    assert second.execute("PRAGMA synchronous").fetchone()[0]==1
+    nested=mod.get_db();assert nested is not second;nested.close();second.close()
+    stats=app.get('/api/metrics',headers=auth()).get_json()['db_pool']
+    assert stats['hits']>=1 and stats['opens']>=2 and stats['in_use']==0
+    import gc, sqlite3
+    pool=mod.ConnectionPool(str(tmp_path/'pool.db'),1,0.1);broken=pool.acquire();broken.execute("CREATE TABLE t(x)");broken.execute("INSERT INTO t VALUES(1)")
+    def fail(): raise sqlite3.OperationalError('disk I/O error')
+    broken.rollback=fail;broken.close();del broken;gc.collect()
+    assert (pool.stats()['open'],pool.stats()['discarded'])==(0,1)
+
+def make_order(mod, order_id, *skus, **overrides):
+    order={'shopify_order_id':str(order_id),'shopify_order_number':str(order_id),'customer_name':'Test','customer_email':'x','shipping_address':'{}','total_price':10,'subtotal_price':10,'current_total_price':10,'refunds_total':0,'currency':'USD','created_at':mod.utcnow(),'updated_at':mod.utcnow(),'shopify_updated_at':mod.utcnow(),'processed_at':None,'cancelled_at':None,'closed_at':None,'financial_status':'PAID','fulfillment_status':'UNFULFILLED','delivery_status':None,'source_name':'web','shipping_method':'Shipping','tracking_company':None,'tracking_number':None,'tracking_url':None,'tags':'[]','item_count':len(skus),'synced_at':mod.utcnow(),'line_items':[{'id':f'{order_id}-{i}','title':'P','sku':sku,'quantity':1,'price':10} for i,sku in enumerate(skus)]}
+    order.update(overrides);return order
+
+def write_catalog(path, *skus):
+    path.write_text(json.dumps({'products':[{'sku':sku,'asin':sku,'amazon_url':f'https://example.com/{sku}'} for sku in skus]}))
+
+def test_catalog_refresh_only_imports_changed_products_json(tmp_path, monkeypatch):
+    catalog=tmp_path/'products.json';write_catalog(catalog,'A');monkeypatch.setenv('PRODUCTS_JSON_PATH',str(catalog))
+    mod=load_app(tmp_path);app=mod.app.test_client();worker={'Authorization':'Bearer worker-secret'}
+    conn=mod.get_db();mod.upsert_order(conn,make_order(mod,1,'b'));conn.commit();conn.close()
+    first=app.get('/api/queue/next',headers=worker).get_json();assert first['task'] is None and first['catalog_version']
+    status=app.get('/api/worker/pipeline-status',headers=worker).get_json();assert status['catalog_refresh']['changed'] is False and status['catalog_version']==first['catalog_version']
+    write_catalog(catalog,'A','B')
+    second=app.get('/api/queue/next',headers=worker).get_json();assert second['task'] is not None and second['catalog_version']!=first['catalog_version']
+
+def test_reconcile_repairs_needs_mapping_via_normalized_sku(tmp_path):
+    mod=load_app(tmp_path);app=mod.app.test_client()
+    conn=mod.get_db();mod.upsert_order(conn,make_order(mod,1,' sku-1 ','missing'));conn.commit()
+    conn.execute("INSERT INTO products(sku,asin,amazon_url,is_active) VALUES(' Sku-1','ASIN1','https://example.com/1',1)");conn.commit()
+    assert conn.execute("SELECT sku_norm FROM line_items WHERE sku=' sku-1 '").fetchone()[0]=='SKU-1';conn.close()
+    result=app.post('/api/catalog/repair-tasks',headers=auth()).get_json()['reconciliation']
+    assert result=={'repaired':1,'still_unmapped':1}
+    conn=mod.get_db();row=conn.execute("SELECT state,asin FROM tasks WHERE state='queued'").fetchone();conn.close()
+    assert tuple(row)==('queued','ASIN1')
+
+def test_catalog_snapshot_is_shared_and_rebuilt_on_product_writes(tmp_path):
+    mod=load_app(tmp_path);app=mod.app.test_client()
+    conn=mod.get_db();first=mod.get_catalog_snapshot(conn);assert mod.get_catalog_snapshot(conn) is first and 'X' not in first.by_sku
+    conn.execute("INSERT INTO products(sku,asin,amazon_url,product_name,is_active) VALUES('x','B0X','https://example.com/x','Thing',1)");conn.commit()
+    rebuilt=mod.get_catalog_snapshot(conn);assert rebuilt is not first and rebuilt.lookup(sku=' x ')['asin']=='B0X' and rebuilt.lookup(asin='b0x')['sku']=='x'
+    # A snapshot read inside an uncommitted product write is not shared; a rollback hands its generation to the next write.
+    conn.execute("INSERT INTO products(sku,asin,amazon_url,product_name,is_active) VALUES('gone','B0G','https://example.com/g','Gone',1)")
+    assert 'GONE' in mod.get_catalog_snapshot(conn).by_sku and mod.get_catalog_snapshot(conn) is not mod.get_catalog_snapshot(conn);conn.rollback()
+    conn.execute("INSERT INTO products(sku,asin,amazon_url,product_name,is_active) VALUES('kept','B0K','https://example.com/k','Kept',1)");conn.commit()
+    assert set(mod.get_catalog_snapshot(conn).by_sku)=={'X','KEPT'};conn.execute("DELETE FROM products WHERE sku='kept'");conn.commit()
+    mod.upsert_order(conn,make_order(mod,1,'X','Y'));conn.commit();conn.close()
+    mapping=app.get('/api/operations/mapping',headers=auth()).get_json()
+    assert mapping['missing_item_count']==1 and mapping['catalog_sku_count']==1
+    conn=mod.get_db();conn.execute("INSERT INTO products(sku,asin,amazon_url,product_name,is_active) VALUES('B0X','B0Z','https://example.com/z','Other',1)");conn.execute("UPDATE tasks SET asin='B0X' WHERE state='queued'");conn.commit();conn.close()
+    assert app.get('/api/queue/next',headers={'Authorization':'Bearer worker-secret'}).get_json()['catalog_product']['sku']=='x'
+
+def order_node(order_id, updated_at='2026-07-15T02:00:00Z', **overrides):
+    node={'id':f'gid://shopify/Order/{order_id}','legacyResourceId':str(order_id),'name':f'#{order_id}','createdAt':'2026-07-15T02:00:00Z','updatedAt':updated_at,'processedAt':None,'cancelledAt':None,'closedAt':None,'email':'x@example.com','displayFinancialStatus':'PAID','displayFulfillmentStatus':'UNFULFILLED','sourceName':'web','tags':[],'currentTotalPriceSet':{'shopMoney':{'amount':'12.00','currencyCode':'USD'}},'currentSubtotalPriceSet':{'shopMoney':{'amount':'12.00','currencyCode':'USD'}},'totalRefundedSet':{'shopMoney':{'amount':'0','currencyCode':'USD'}},'customer':{'displayName':'Buyer'},'shippingAddress':{'firstName':'Buyer','lastName':'One'},'shippingLine':{'title':'Shipping'},'lineItems':{'nodes':[]},'fulfillments':[]}
+    node.update(overrides);return node
+
+def test_incremental_sync_uses_high_water_mark(tmp_path, monkeypatch):
+    mod=load_app(tmp_path);calls=[]
+    pages=[[order_node(1,'2026-07-15T02:00:00Z'),order_node(2,'2026-07-15T03:00:00Z')],[order_node(2,'2026-07-15T04:00:00Z')],[]]
+    monkeypatch.setattr(mod,'shopify_graphql',lambda q,v:calls.append(v) or {'orders':{'pageInfo':{'hasNextPage':False,'endCursor':None},'nodes':pages[len(calls)-1]}})
+    first=mod.sync_shopify_orders(max_pages=1);assert first['mode']=='full' and first['high_water_mark']=='2026-07-15T03:00:00Z' and calls[0]['sortKey']=='CREATED_AT'
+    second=mod.sync_shopify_orders(max_pages=1);assert second['mode']=='incremental' and second['updated']==1 and second['high_water_mark']=='2026-07-15T04:00:00Z'
+    assert calls[1]['sortKey']=='UPDATED_AT' and calls[1]['reverse'] is False and calls[1]['query']=="updated_at:>='2026-07-15T02:59:00Z'"
+    third=mod.sync_shopify_orders(max_pages=1,mode='full');assert third['mode']=='full' and third['high_water_mark']=='2026-07-15T04:00:00Z' and calls[2]['reverse'] is True
+
+def fake_shopify_server(handler_fn):
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self,*args): pass
+        def respond(self,status,body,content_type='application/json',headers=None):
+            data=body if isinstance(body,bytes) else json.dumps(body).encode()
+            self.send_response(status);self.send_header('Content-Type',content_type);self.send_header('Content-Length',str(len(data)))
+            for key,value in (headers or {}).items(): self.send_header(key,value)
+            self.end_headers();self.wfile.write(data)
+        def do_GET(self): handler_fn(self,None)
+        def do_POST(self): handler_fn(self,json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+    server=ThreadingHTTPServer(('127.0.0.1',0),Handler);threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server,f'http://127.0.0.1:{server.server_address[1]}'
+
+def test_bulk_backfill_streams_jsonl_and_resumes(tmp_path, monkeypatch):
+    mod=load_app(tmp_path);mutations=[]
+    lines=[]
+    for order_id in (1,2,3):
+        node=order_node(order_id,f'2026-07-1{order_id}T00:00:00Z');node.pop('lineItems');lines.append(json.dumps(node))
+        lines.append(json.dumps({'id':f'gid://shopify/LineItem/{order_id}','title':'P','sku':'S','quantity':2,'__parentId':node['id']}))
+    def handle(req,body):
+        if req.command=='GET': return req.respond(200,('\n'.join(lines)+'\n').encode(),'application/jsonl')
+        if 'bulkOperationRunQuery' in body['query']:
+            mutations.append(body);return req.respond(200,{'data':{'bulkOperationRunQuery':{'bulkOperation':{'id':'gid://shopify/BulkOperation/1','status':'CREATED'},'userErrors':[]}}})
+        req.respond(200,{'data':{'node':{'id':body['variables']['id'],'status':'COMPLETED','objectCount':'6','url':base+'/bulk.jsonl'}}})
+    server,base=fake_shopify_server(handle)
+    monkeypatch.setattr(mod,'SHOPIFY_ADMIN_BASE_URL',base);monkeypatch.setattr(mod,'SHOPIFY_ADMIN_ACCESS_TOKEN','token')
+    original=mod.normalize_graphql_order
+    def flaky(node):
+        if node['legacyResourceId']=='3': raise RuntimeError('connection reset')
+        return original(node)
+    monkeypatch.setattr(mod,'normalize_graphql_order',flaky)
+    try: mod.run_shopify_bulk_backfill(batch_size=2,poll_interval=0)
+    except RuntimeError: pass
+    conn=mod.get_db();assert conn.execute("SELECT orders_ingested,status FROM shopify_bulk_operations").fetchone()[:]==(2,'ingesting');conn.close()
+    monkeypatch.setattr(mod,'normalize_graphql_order',original)
+    result=mod.run_shopify_bulk_backfill(batch_size=2,poll_interval=0);server.shutdown()
+    assert result['status']=='ingested' and result['orders_ingested']==3 and result['orders_created']==3 and len(mutations)==1
+    conn=mod.get_db();assert conn.execute("SELECT COUNT(*),SUM(quantity) FROM line_items").fetchone()[:]==(3,6)
+    assert mod.last_sync_high_water_mark(conn)=='2026-07-13T00:00:00Z'
+    # The submit and status calls of the first attempt stay on the run after it resumes.
+    assert conn.execute("SELECT shopify_requests,shopify_retries FROM sync_runs WHERE source='shopify_bulk'").fetchone()[:]==(2,0);conn.close()
+
+def test_pipelined_sync_propagates_failures_and_stops_fetcher(tmp_path, monkeypatch):
+    import threading
+    mod=load_app(tmp_path);calls=[]
+    def fetch(q,v):
+        calls.append(v['cursor'])
+        if len(calls)==2: raise RuntimeError('Shopify 502')
+        return {'orders':{'pageInfo':{'hasNextPage':True,'endCursor':f'c{len(calls)}'},'nodes':[order_node(len(calls))]}}
+    monkeypatch.setattr(mod,'shopify_graphql',fetch)
+    try: mod.sync_shopify_orders(max_pages=5);assert False
+    except RuntimeError as exc: assert 'Shopify 502' in str(exc)
+    conn=mod.get_db();run=conn.execute("SELECT status,pages FROM sync_runs ORDER BY id DESC").fetchone();assert tuple(run)==('failed',1)
+    assert conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]==1;conn.close()
+    monkeypatch.setattr(mod,'shopify_graphql',lambda q,v:{'orders':{'pageInfo':{'hasNextPage':True,'endCursor':'next'},'nodes':[order_node(9)]}})
+    monkeypatch.setattr(mod,'upsert_orders',lambda *a,**k:(_ for _ in ()).throw(ValueError('disk full')))
+    try: mod.sync_shopify_orders(max_pages=1000,mode='full');assert False
+    except ValueError: pass
+    for thread in [t for t in threading.enumerate() if t.name=='shopify-page-fetcher']: thread.join(timeout=2);assert not thread.is_alive()
+
+def test_batch_upsert_skips_unchanged_orders(tmp_path):
+    mod=load_app(tmp_path);conn=mod.get_db()
+    page=[make_order(mod,1,'A'),make_order(mod,2,'B',shopify_updated_at='2026-07-15T01:00:00Z')]
+    first=mod.upsert_orders(conn,page);assert (first['created'],first['updated'],first['unchanged'])==(2,0,0)
+    changes=conn.total_changes;again=mod.upsert_orders(conn,[dict(o,synced_at='later') for o in page])
+    assert again['unchanged']==2 and conn.total_changes==changes
+    bumped=make_order(mod,2,'B',shopify_updated_at='2026-07-15T02:00:00Z',financial_status='REFUNDED')
+    third=mod.upsert_orders(conn,[bumped]);assert third['updated']==1 and third['results'][0]['order_id']==first['results'][1]['order_id']
+    assert conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]==2 and conn.execute("SELECT financial_status FROM orders WHERE shopify_order_id='2'").fetchone()[0]=='REFUNDED';conn.close()
+
+def test_shopify_client_retries_throttles_and_opens_circuit(tmp_path, monkeypatch):
+    mod=load_app(tmp_path);responses=[]
+    cost={'requestedQueryCost':100,'actualQueryCost':40,'throttleStatus':{'maximumAvailable':1000,'currentlyAvailable':20,'restoreRate':50}}
+    def handle(req,body):
+        status,payload,headers=responses.pop(0);req.respond(status,payload,headers=headers)
+    server,base=fake_shopify_server(handle)
+    monkeypatch.setattr(mod,'SHOPIFY_ADMIN_BASE_URL',base);monkeypatch.setattr(mod,'SHOPIFY_ADMIN_ACCESS_TOKEN','token');monkeypatch.setattr(mod,'SHOPIFY_BREAKER_THRESHOLD',1)
+    client=mod.get_shopify_client();sleeps=[];client.sleep=sleeps.append
+    responses+=[(429,{},{'Retry-After':'0.5'}),(200,{'errors':[{'message':'Throttled','extensions':{'code':'THROTTLED'}}],'extensions':{'cost':dict(cost,actualQueryCost=None)}},None),(200,{'data':{'ok':True},'extensions':{'cost':cost}},None)]
+    meter=mod.new_cost_meter()
+    with mod.shopify_metering(meter): assert mod.shopify_graphql('{shop{name}}',{})=={'ok':True}
+    assert meter['requests']==3 and meter['retries']==2 and meter['throttled']==2 and meter['actual_cost']==40
+    assert sleeps[0]==0.5 and 1.5<sleeps[1]<=1.6
+    responses+=[(503,{},None)]*(mod.SHOPIFY_MAX_RETRIES+1)
+    try: mod.shopify_graphql('{shop{name}}',{});assert False
+    except mod.ShopifyAPIError as exc: assert exc.status==503
+    try: mod.shopify_graphql('{shop{name}}',{});assert False
+    except mod.ShopifyCircuitOpenError: pass
+    server.shutdown();assert client.state()['circuit_open'] and not responses
+
+def test_sync_lease_is_shared_and_concurrent_callers_join(tmp_path, monkeypatch):
+    import threading
+    mod=load_app(tmp_path);mod.SYNC_JOIN_POLL_INTERVAL=0.01;calls=[];release=threading.Event()
+    def fetch(q,v):
+        calls.append(v);release.wait(5)
+        return {'orders':{'pageInfo':{'hasNextPage':False,'endCursor':None},'nodes':[order_node(1)]}}
+    monkeypatch.setattr(mod,'shopify_graphql',fetch)
+    assert mod.acquire_lease('other','a') and not mod.acquire_lease('other','b') and mod.acquire_lease('other','a',ttl=-1) and mod.acquire_lease('other','b')
+    waiting=set();outcome=mod._sync_run_outcome
+    monkeypatch.setattr(mod,'_sync_run_outcome',lambda run_id:waiting.add(threading.get_ident()) or outcome(run_id))
+    results=[];runners=[threading.Thread(target=lambda:results.append(mod.coordinated_shopify_sync(max_pages=1))) for _ in range(3)]
+    for runner in runners: runner.start()
+    while not calls or len(waiting)<2: threading.Event().wait(0.01)
+    full=[];other=threading.Thread(target=lambda:full.append(mod.coordinated_shopify_sync(max_pages=1,mode='full')));other.start();threading.Event().wait(0.05)
+    lease=mod.current_lease(mod.sync_lease_name());assert lease and lease['run_id']
+    assert mod.app.test_client().get('/api/metrics',headers=auth()).get_json()['sync_leases']['shop.myshopify.com']['run_id']==lease['run_id']
+    release.set()
+    for runner in runners: runner.join(5)
+    assert sorted(r['joined'] for r in results)==[False,True,True]
+    assert {r['run_id'] for r in results}=={lease['run_id']} and all(r['imported']==1 for r in results)
+    other.join(5);assert len(calls)==2 and not full[0]['joined'] and full[0]['mode']=='full' and full[0]['run_id']!=lease['run_id']
+    assert mod.current_lease(mod.sync_lease_name()) is None
+    def paged(q,v):
+        calls.append(v);threading.Event().wait(0.05)
+        return {'orders':{'pageInfo':{'hasNextPage':True,'endCursor':f'c{len(calls)}'},'nodes':[order_node(len(calls))]}}
+    monkeypatch.setattr(mod,'shopify_graphql',paged);mod.SYNC_LEASE_TTL=0.3
+    stolen=[];thief=threading.Thread(target=lambda:stolen.append(mod.coordinated_shopify_sync(max_pages=100)));thief.start()
+    while not mod.current_lease(mod.sync_lease_name()): threading.Event().wait(0.01)
+    conn=mod.get_db();conn.execute("UPDATE sync_leases SET owner='other-process'");conn.commit();conn.close();thief.join(5)
+    assert stolen[0]['lease_lost'] and stolen[0]['status']=='cancelled' and stolen[0]['pages']<100
+
+def test_sync_scheduler_adapts_interval_and_replaces_polling_triggers(tmp_path, monkeypatch):
+    mod=load_app(tmp_path);app=mod.app.test_client();calls=[]
+    mod.SYNC_SCHEDULER_MIN_INTERVAL,mod.SYNC_SCHEDULER_MAX_INTERVAL=15,300
+    assert mod.compute_sync_interval(0,'failing',0)==15 and mod.compute_sync_interval(0,'healthy',0)==300
+    assert mod.compute_sync_interval(0,'unknown',0)==300 and mod.compute_sync_interval(59,'unknown',0)==15 and mod.compute_sync_interval(0,'healthy',0,failures=2)==60
+    def fetch(q,v):
+        calls.append(v);return {'orders':{'pageInfo':{'hasNextPage':False,'endCursor':None},'nodes':[order_node(len(calls),updated_at=f'2026-07-15T0{len(calls)}:00:00Z')]}}
+    monkeypatch.setattr(mod,'shopify_graphql',fetch)
+    scheduler=mod.ShopifySyncScheduler();assert scheduler.tick()>0
+    conn=mod.get_db();mod.record_webhook_outcome(conn,ok=True);conn.commit();conn.close()
+    assert scheduler.tick()==15
+    state=app.get('/api/shopify/scheduler',headers=auth()).get_json()
+    assert state['webhook_health']=='healthy' and state['missed_changes']==1 and state['last_result']['shops']['shop.myshopify.com']['mode']=='incremental' and len(calls)==2
+    live=app.post('/api/shopify/live-sync',json={'since_id':1},headers=auth()).get_json()
+    assert live['new_order_count']==1 and live['scheduler']['interval_seconds']==15 and len(calls)==2
+    assert mod.maybe_sync_shopify_for_worker()['reason']=='scheduled' and len(calls)==2
+    monkeypatch.setattr(mod,'shopify_graphql',lambda q,v:{'orders':{'pageInfo':{'hasNextPage':False,'endCursor':None},'nodes':[order_node(2,updated_at='2026-07-15T02:00:00Z')]}})
+    assert scheduler.tick()==300
+    import time
+    mod.SYNC_SCHEDULER_LEASE_TTL=0.3;assert mod.acquire_lease(mod.SHOPIFY_SCHEDULER_LEASE,'dead-process',ttl=0.3)
+    conn=mod.get_db();mod.set_app_state(conn,mod.SYNC_SCHEDULER_STATE_KEY,'{}');conn.commit();conn.close()
+    ticks=[];standby=mod.ShopifySyncScheduler();standby.tick=lambda:ticks.append(time.monotonic()) or 60;started=time.monotonic();standby.start()
+    while not ticks and time.monotonic()-started<3: time.sleep(0.01)
+    assert ticks and ticks[0]-started<1;time.sleep(0.6)
+    assert mod.current_lease(mod.SHOPIFY_SCHEDULER_LEASE)['owner']==standby.owner and len(ticks)==1
+    standby.stop();standby.join(2);assert mod.current_lease(mod.SHOPIFY_SCHEDULER_LEASE) is None
+
+def test_sync_jobs_report_page_progress_and_cancel(tmp_path, monkeypatch):
+    import sys, threading, time
+    mod=load_app(tmp_path);sys.modules.pop('live_bridge',None);import live_bridge;app=mod.app.test_client();gate=threading.Semaphore(0);calls=[]
+    def fetch(q,v):
+        gate.acquire(timeout=5);calls.append(v['cursor'])
+        return {'orders':{'pageInfo':{'hasNextPage':True,'endCursor':f'c{len(calls)}'},'nodes':[order_node(len(calls),updated_at=f'2026-07-15T0{len(calls)}:00:00Z')]}}
+    monkeypatch.setattr(mod,'shopify_graphql',fetch)
+    def wait_for(job_id,check):
+        for _ in range(500):
+            job=app.get(f'/api/shopify/sync/{job_id}',headers=auth()).get_json()
+            if check(job): return job
+            time.sleep(0.01)
+        raise AssertionError(job)
+    started=app.post('/api/shopify/sync',json={'max_pages':10},headers=auth());job=started.get_json()
+    assert started.status_code==202 and job['status'] in ('queued','running') and not job['joined']
+    gate.release();gate.release()
+    progress=wait_for(job['job_id'],lambda j:j['pages']>=2);assert progress['imported']>=2 and 5<progress['progress']<100
+    joined=app.post('/api/shopify/sync',json={'max_pages':10},headers=auth()).get_json();assert joined['joined'] and joined['job_id']==job['job_id']
+    assert app.post(f"/api/shopify/sync/{job['job_id']}/cancel",headers=auth()).status_code==200
+    for _ in range(4): gate.release()
+    done=wait_for(job['job_id'],lambda j:j['done']);assert done['status']=='cancelled' and done['progress']==100 and done['pages']<10
+    assert done['mode']=='full' and done['result']['high_water_mark'] is None
+    assert app.post(f"/api/shopify/sync/{job['job_id']}/cancel",headers=auth()).status_code==409
+    while mod.current_lease(mod.sync_lease_name()): time.sleep(0.01)
+    mod.SYNC_JOIN_POLL_INTERVAL=0.01;live_bridge.SYNC_PROGRESS_POLL_INTERVAL=0.01
+    monkeypatch.setattr(mod,'shopify_graphql',lambda q,v:{'orders':{'pageInfo':{'hasNextPage':False,'endCursor':None},'nodes':[order_node(20)]}})
+    monkeypatch.setattr(live_bridge,'_platform_status',lambda:{'online':True})
+    events=[json.loads(line) for line in live_bridge.app.test_client().post('/api/integrations/sync-progress',headers=auth()).get_data(as_text=True).splitlines()]
+    assert events[0]['job_id']>job['job_id'] and any(e['stage']=='shopify' and e['job']['pages']==1 for e in events)
+    assert events[-1]['stage']=='complete' and events[-1]['result']['imported']==1
+
+def test_multi_store_sync_tags_and_filters_by_shop(tmp_path, monkeypatch):
+    import threading
+    mod=load_app(tmp_path);app=mod.app.test_client();seen=[]
+    mod.save_shopify_connection('second.myshopify.com','token-2')
+    conn=mod.get_db();conn.execute("INSERT INTO products(sku,asin,amazon_url,product_name,is_active) VALUES('X','X','https://example.com/p','P',1)");conn.commit();conn.close()
+    def fetch(q,v):
+        shop=mod.current_shop();seen.append((shop,threading.current_thread().name));number=1 if shop=='shop.myshopify.com' else 2
+        item={'id':f'gid://shopify/LineItem/{number}','title':'P','sku':'X','quantity':1,'originalUnitPriceSet':{'shopMoney':{'amount':'5','currencyCode':'USD'}}}
+        return {'orders':{'pageInfo':{'hasNextPage':False,'endCursor':None},'nodes':[order_node(number,updated_at=f'2026-07-15T0{number}:00:00Z',lineItems={'nodes':[item]})]}}
+    monkeypatch.setattr(mod,'shopify_graphql',fetch)
+    assert mod.configured_shops()==['shop.myshopify.com','second.myshopify.com']
+    result=mod.sync_all_shops(max_pages=1);assert result['imported']==2 and not result['errors'] and set(result['shops'])=={'shop.myshopify.com','second.myshopify.com'}
+    assert {shop for shop,_ in seen}=={'shop.myshopify.com','second.myshopify.com'}
+    assert mod.get_shopify_client('second.myshopify.com') is not mod.get_shopify_client('shop.myshopify.com') and mod.get_shopify_access_token('other.myshopify.com')==''
+    conn=mod.get_db()
+    assert dict(conn.execute("SELECT o.shop_domain,t.shop_domain FROM orders o JOIN tasks t ON t.order_id=o.id").fetchall())=={'shop.myshopify.com':'shop.myshopify.com','second.myshopify.com':'second.myshopify.com'}
+    assert mod.last_sync_high_water_mark(conn,'second.myshopify.com')=='2026-07-15T02:00:00Z' and mod.last_sync_high_water_mark(conn)=='2026-07-15T01:00:00Z';conn.close()
+    assert app.get('/api/dashboard?shop=second.myshopify.com',headers=auth()).get_json()['total_orders']==1
+    assert [o['shop_domain'] for o in app.get('/api/orders?shop=second.myshopify.com',headers=auth()).get_json()['orders']]==['second.myshopify.com']
+    task=app.get('/api/queue/next?shop=second.myshopify.com',headers={'Authorization':'Bearer worker-secret'}).get_json()['task'];assert task['shop_domain']=='second.myshopify.com'
+    raw=json.dumps({'id':3,'order_number':3,'total_price':'1','created_at':'2026-07-15T03:00:00Z','updated_at':'2026-07-15T03:00:00Z','line_items':[]}).encode();sig=base64.b64encode(hmac.new(b'webhook-secret',raw,hashlib.sha256).digest()).decode()
+    headers={'Content-Type':'application/json','X-Shopify-Hmac-Sha256':sig}
+    assert app.post('/webhooks/shopify/orders-create',data=raw,headers={**headers,'X-Shopify-Shop-Domain':'second.myshopify.com'}).status_code==200
+    assert app.post('/webhooks/shopify/orders-create',data=raw,headers={**headers,'X-Shopify-Shop-Domain':'evil.example.com'}).status_code==400
+    assert mod.drain_webhook_inbox()['processed']==1
+    assert app.get('/api/dashboard?shop=second.myshopify.com',headers=auth()).get_json()['total_orders']==2
+
+def test_shopify_credentials_are_cached_and_invalidated(tmp_path):
+    mod=load_app(tmp_path);app=mod.app.test_client();mod.SHOPIFY_CREDENTIALS.recheck_seconds=3600
+    mod.save_shopify_connection('shop.myshopify.com','token-1')
+    assert mod.get_shopify_access_token()=='token-1';before=mod.SHOPIFY_CREDENTIALS.stats()
+    for _ in range(3): assert app.get('/health').get_json()['shopify_configured'] and app.get('/api/dashboard',headers=auth()).status_code==200
+    after=mod.SHOPIFY_CREDENTIALS.stats();assert (after['loads'],after['version_checks'])==(before['loads'],before['version_checks']) and after['hits']>before['hits']
+    mod.save_shopify_connection('shop.myshopify.com','token-2');assert mod.get_shopify_access_token()=='token-2'
+    conn=mod.get_db();conn.execute("UPDATE shopify_connections SET access_token='token-3'");conn.commit();conn.close()
+    assert mod.get_shopify_access_token()=='token-2'
+    mod.SHOPIFY_CREDENTIALS.recheck_seconds=0;assert mod.get_shopify_access_token()=='token-3'
+    checks=mod.SHOPIFY_CREDENTIALS.stats()['version_checks'];mod.get_shopify_access_token()
+    assert mod.SHOPIFY_CREDENTIALS.stats()['version_checks']==checks+1 and mod.SHOPIFY_CREDENTIALS.stats()['loads']==after['loads']+2
+
+def test_webhook_inbox_acknowledges_then_batches_retries_and_dead_letters(tmp_path, monkeypatch):
+    mod=load_app(tmp_path);app=mod.app.test_client();mod.WEBHOOK_INBOX_MAX_ATTEMPTS=2;mod.WEBHOOK_INBOX_RETRY_BASE=0
+    def send(payload):
+        raw=json.dumps(payload).encode();sig=base64.b64encode(hmac.new(b'webhook-secret',raw,hashlib.sha256).digest()).decode()
+        return app.post('/webhooks/shopify/orders-updated',data=raw,headers={'Content-Type':'application/json','X-Shopify-Hmac-Sha256':sig,'X-Shopify-Webhook-Id':f"wh-{payload['id']}"})
+    for i in (1,2,3): assert send({'id':i,'order_number':i,'total_price':'1','created_at':'2026-07-15T01:00:00Z','updated_at':'2026-07-15T01:00:00Z','line_items':[]}).get_json()['status']=='queued'
+    assert app.get('/api/dashboard',headers=auth()).get_json()['total_orders']==0
+    stats=app.get('/api/webhooks/inbox',headers=auth()).get_json();assert stats['counts']=={'pending':3} and stats['lag_seconds']>=0
+    conn=mod.get_db();assert mod.webhook_health(conn)=='unknown';conn.close()
+    original=mod.normalize_rest_order
+    monkeypatch.setattr(mod,'normalize_rest_order',lambda p:(_ for _ in ()).throw(ValueError('poison')) if p['id']==2 else original(p))
+    assert mod.drain_webhook_inbox()=={'claimed':3,'processed':2,'retrying':1,'dead':0}
+    assert mod.drain_webhook_inbox()=={'claimed':1,'processed':0,'retrying':0,'dead':1}
+    conn=mod.get_db();assert mod.webhook_health(conn)=='failing';conn.close()
+    stats=app.get('/api/webhooks/inbox',headers=auth()).get_json();assert stats['counts']=={'processed':2,'dead':1} and stats['dead_letters'][0]['last_error']=='poison' and stats['dead_letters'][0]['webhook_id']=='wh-2'
+    monkeypatch.setattr(mod,'normalize_rest_order',original);dead_id=stats['dead_letters'][0]['id']
+    assert app.post(f'/api/webhooks/inbox/{dead_id}/retry',headers=auth()).status_code==200 and mod.drain_webhook_inbox()['processed']==1
+    assert app.get('/api/dashboard',headers=auth()).get_json()['total_orders']==3 and app.get('/api/metrics',headers=auth()).get_json()['webhook_inbox']['counts']=={'processed':3}
+    conn=mod.get_db();changes=conn.total_changes;assert mod._claim_webhook_batch(conn,'idle',10)==[] and conn.total_changes==changes and not conn.in_transaction;conn.close()
+
+def test_webhooks_are_deduplicated_and_stale_payloads_dropped(tmp_path, monkeypatch):
+    mod=load_app(tmp_path);app=mod.app.test_client()
+    def send(payload,webhook_id):
+        raw=json.dumps(payload).encode();sig=base64.b64encode(hmac.new(b'webhook-secret',raw,hashlib.sha256).digest()).decode()
+        return app.post('/webhooks/shopify/orders-updated',data=raw,headers={'Content-Type':'application/json','X-Shopify-Hmac-Sha256':sig,'X-Shopify-Webhook-Id':webhook_id}).get_json()['status']
+    newer={'id':7,'order_number':7,'total_price':'20','created_at':'2026-07-15T01:00:00Z','updated_at':'2026-07-15T03:00:00Z','line_items':[]};older={**newer,'total_price':'10','updated_at':'2026-07-15T02:00:00Z'}
+    assert send(newer,'a')=='queued' and send(newer,'a')=='duplicate' and send(older,'b')=='queued'
+    assert mod.drain_webhook_inbox()['processed']==2
+    assert app.get('/api/dashboard',headers=auth()).get_json()['revenue']==20
+    monkeypatch.setattr(mod,'shopify_graphql',lambda q,v:{'orders':{'pageInfo':{'hasNextPage':False,'endCursor':None},'nodes':[order_node(7,updated_at='2026-07-15T02:30:00Z')]}})
+    assert mod.sync_shopify_orders(max_pages=1)['unchanged']==1 and app.get('/api/dashboard',headers=auth()).get_json()['revenue']==20
+    assert app.get('/api/webhooks/inbox',headers=auth()).get_json()['dropped']=={'duplicates':1,'stale':2}
+    processed=lambda:mod.get_db().execute("SELECT COUNT(*) FROM webhook_inbox WHERE status='processed'").fetchone()[0]
+    mod.WEBHOOK_DEDUP_WINDOW=0;assert mod.drain_webhook_inbox()['claimed']==0 and processed()==0 and send(newer,'a')=='queued'
+    assert mod.drain_webhook_inbox()['processed']==1 and mod.drain_webhook_inbox()['claimed']==0 and processed()==1
+    conn=mod.get_db();assert mod.prune_webhook_inbox(conn) is None;conn.close()
+
+def test_fulfillment_refund_and_product_webhooks_apply_partial_updates(tmp_path, monkeypatch):
+    mod=load_app(tmp_path);app=mod.app.test_client()
+    def send(route,payload):
+        raw=json.dumps(payload).encode();sig=base64.b64encode(hmac.new(b'webhook-secret',raw,hashlib.sha256).digest()).decode()
+        return app.post(f'/webhooks/shopify/{route}',data=raw,headers={'Content-Type':'application/json','X-Shopify-Hmac-Sha256':sig}).get_json()['status']
+    send('fulfillments-create',{'id':50,'order_id':9,'tracking_company':'UPS','tracking_number':'1Z1','updated_at':'2026-07-15T05:00:00-04:00'})
+    assert mod.drain_webhook_inbox()['retrying']==1
+    send('orders-create',{'id':9,'order_number':9,'total_price':'40','created_at':'2026-07-15T01:00:00Z','updated_at':'2026-07-15T01:00:00Z','line_items':[{'id':1,'title':'Lamp','sku':'B0LAMP','quantity':1,'price':'40','product_id':77,'variant_id':770}]})
+    send('refunds-create',{'id':60,'order_id':9,'transactions':[{'kind':'refund','status':'success','amount':'15.00'},{'kind':'refund','status':'failure','amount':'99'}]})
+    send('products-update',{'id':77,'vendor':'Acme','updated_at':'2026-07-15T06:00:00Z','image':{'src':'https://img/p.png'},'images':[{'id':5,'src':'https://img/v.png'}],'variants':[{'id':770,'image_id':5}]})
+    send('fulfillments-update',{'id':50,'order_id':9,'tracking_company':'UPS','tracking_number':'1Z0','shipment_status':'delivered','updated_at':'2026-07-15T08:00:00Z'})
+    conn=mod.get_db();conn.execute("UPDATE webhook_inbox SET next_attempt_at=0");conn.commit();conn.close()
+    assert mod.drain_webhook_inbox()=={'claimed':5,'processed':5,'retrying':0,'dead':0}
+    send('refunds-create',{'id':60,'order_id':9,'transactions':[{'kind':'refund','status':'success','amount':'15.00'}]});mod.drain_webhook_inbox()
+    conn=mod.get_db();order=conn.execute("SELECT * FROM orders").fetchone();item=conn.execute("SELECT * FROM line_items").fetchone();conn.close()
+    # 08:00Z is older than 05:00-04:00, so that fulfillment update is dropped as stale.
+    assert (order['tracking_number'],order['delivery_status'],order['refunds_total'],order['total_price'])==('1Z1',None,15.0,40.0)
+    assert app.get('/api/webhooks/inbox',headers=auth()).get_json()['dropped']['stale']==1
+    assert (item['vendor'],item['image_url'])==('Acme','https://img/v.png')
+    # A later order payload (REST line items carry no image) must not undo the product update.
+    send('orders-updated',{'id':9,'order_number':9,'total_price':'40','note':'gift','created_at':'2026-07-15T01:00:00Z','updated_at':'2026-07-15T09:00:00Z','line_items':[{'id':1,'title':'Lamp','sku':'B0LAMP','quantity':1,'price':'40','product_id':77,'variant_id':770,'vendor':'Old'}]})
+    assert mod.drain_webhook_inbox()['processed']==1
+    conn=mod.get_db();item=conn.execute("SELECT * FROM line_items").fetchone()
+    plan=' '.join(r[3] for r in conn.execute("EXPLAIN QUERY PLAN UPDATE line_items SET vendor=? WHERE shopify_variant_id IN (?,?)",('a','1','2')));conn.close()
+    assert (item['vendor'],item['image_url'])==('Acme','https://img/v.png') and 'idx_line_items_variant' in plan
+    topics=[]
+    monkeypatch.setattr(mod,'shopify_graphql',lambda q,v:topics.append(v['topic']) or {'webhookSubscriptionCreate':{}} if 'topic' in v else {'webhookSubscriptions':{'nodes':[]}})
+    assert mod._register_shopify_webhooks()[1]==200 and {'FULFILLMENTS_CREATE','FULFILLMENTS_UPDATE','REFUNDS_CREATE','PRODUCTS_UPDATE'}<=set(topics)
+
+def test_tasks_are_claimed_atomically_with_renewable_leases_and_reaped(tmp_path, monkeypatch):
+    import threading, time
+    catalog=tmp_path/'products.json';write_catalog(catalog,'A');monkeypatch.setenv('PRODUCTS_JSON_PATH',str(catalog))
+    mod=load_app(tmp_path);app=mod.app.test_client();mod.TASK_RETRY_POLICY['transient']['max_attempts']=2
+    conn=mod.get_db();mod.upsert_orders(conn,[make_order(mod,i,'A') for i in range(1,9)]);conn.commit();conn.close()
+    barrier=threading.Barrier(8);claimed=[]
+    def claim(n):
+        conn=mod.get_db();barrier.wait();task=mod.claim_next_task(conn,f'bot-{n}');conn.commit();conn.close();claimed.append(task['id'])
+    threads=[threading.Thread(target=claim,args=(n,)) for n in range(8)];[t.start() for t in threads];[t.join() for t in threads]
+    assert sorted(claimed)==list(range(1,9))
+    conn=mod.get_db();conn.execute("UPDATE tasks SET state='queued',lease_owner=NULL,lease_expires_at=NULL,attempts=0");conn.commit();conn.close()
+    bot=lambda name:{'Authorization':'Bearer worker-secret','X-Worker-Id':name}
+    task=app.get('/api/queue/next',headers=bot('a')).get_json()['task'];assert task['lease_owner']=='a' and task['attempts']==1
+    assert app.post(f"/api/queue/{task['id']}/update",json={'state':'purchased'},headers=bot('b')).status_code==409
+    beat=app.post('/api/worker/heartbeat',json={'task_id':task['id']},headers=bot('a')).get_json();assert beat['lease_expires_at']>time.time()
+    assert app.post('/api/worker/heartbeat',json={'task_id':task['id']},headers=bot('b')).get_json()['lease_expires_at'] is None
+    conn=mod.get_db();conn.execute("UPDATE tasks SET lease_expires_at=0 WHERE id=?",(task['id'],));conn.commit()
+    assert mod.reap_expired_task_leases(conn)=={'retrying':1,'failed':0};conn.commit()
+    state,owner,failure_class,due=conn.execute("SELECT state,lease_owner,failure_class,next_attempt_at FROM tasks WHERE id=?",(task['id'],)).fetchone()
+    assert (state,owner,failure_class)==('retry_scheduled',None,'transient') and due>time.time()+20
+    conn.execute("UPDATE tasks SET next_attempt_at=0 WHERE id=?",(task['id'],));conn.commit();conn.close()
+    again=app.get('/api/queue/next',headers=bot('b')).get_json()['task'];assert again['id']==task['id'] and again['attempts']==2
+    conn=mod.get_db();conn.execute("UPDATE tasks SET lease_expires_at=0 WHERE id=?",(task['id'],));conn.commit()
+    assert mod.reap_expired_task_leases(conn)=={'retrying':0,'failed':1};conn.commit();conn.close()
+    done=app.get('/api/queue/next',headers=bot('b')).get_json()['task']
+    assert app.post(f"/api/queue/{done['id']}/update",json={'state':'purchased'},headers=bot('b')).status_code==200
+    conn=mod.get_db();assert conn.execute("SELECT lease_owner,lease_expires_at FROM tasks WHERE id=?",(done['id'],)).fetchone()[:]==(None,None);conn.close()
+    conn=mod.get_db();conn.execute("UPDATE tasks SET state='processing_cart',lease_owner=NULL,lease_expires_at=NULL WHERE id=?",(done['id'],));conn.commit();conn.close()
+    mod.TASK_LEASE_TTL=-1;mod.init_db();conn=mod.get_db();assert conn.execute("SELECT lease_expires_at FROM tasks WHERE id=?",(done['id'],)).fetchone()[0]<time.time()
+    assert mod.reap_expired_task_leases(conn)['retrying']==1;conn.commit();conn.close()
+    assert app.post('/api/tasks/retry',json={'failure_class':'transient'},headers=auth()).get_json()['scheduled']==1
+
+def test_worker_registry_tracks_each_bot_and_reports_offline_once(tmp_path, monkeypatch):
+    catalog=tmp_path/'products.json';write_catalog(catalog,'A');monkeypatch.setenv('PRODUCTS_JSON_PATH',str(catalog))
+    mod=load_app(tmp_path);app=mod.app.test_client();offline=[];monkeypatch.setattr(mod,'on_worker_offline',lambda conn,worker:offline.append(worker['worker_id']))
+    conn=mod.get_db();mod.upsert_orders(conn,[make_order(mod,i,'A') for i in (1,2)]);conn.commit();conn.close()
+    bot=lambda name:{'Authorization':'Bearer worker-secret','X-Worker-Id':name}
+    for name in ('east','west'):
+        task=app.get('/api/queue/next',headers=bot(name)).get_json()['task']
+        assert app.post('/api/worker/heartbeat',json={'task_id':task['id'],'action':f'{name} buying'},headers=bot(name)).get_json()['worker_id']==name
+    assert app.post(f"/api/queue/{task['id']}/update",json={'state':'purchased'},headers=bot('west')).status_code==200
+    status=app.get('/api/status',headers=auth()).get_json()
+    assert status['worker_online'] and status['fleet']=={'total':2,'online':2,'offline':0,'busy':1,'tasks_claimed':2,'tasks_purchased':1,'tasks_failed':0}
+    assert {w['worker_id']:(w['current_task'] or {}).get('worker_id') for w in status['workers']}=={'east':'east','west':None}
+    conn=mod.get_db();conn.execute("UPDATE workers SET last_heartbeat_at='2020-01-01T00:00:00+00:00' WHERE worker_id='east'");conn.commit();conn.close()
+    queue=app.get('/api/operations/queue',headers=auth()).get_json();app.get('/api/status',headers=auth())
+    assert queue['fleet']['online']==1 and queue['worker_online'] and offline==['east']
+    # A reader in another process that still saw east as unreported loses the conditional stamp and stays quiet.
+    view=mod._worker_view;monkeypatch.setattr(mod,'_worker_view',lambda conn,row:{**view(conn,row),'last_offline_notification_at':None})
+    app.get('/api/status',headers=auth());monkeypatch.setattr(mod,'_worker_view',view);assert offline==['east']
+    conn=mod.get_db();conn.execute("UPDATE tasks SET attempts=99,lease_expires_at=0 WHERE lease_owner='east'");assert mod.reap_expired_task_leases(conn)['failed']==1;conn.commit();conn.close()
+    assert app.get('/api/status',headers=auth()).get_json()['fleet']['tasks_failed']==1
+
+def test_batch_claims_group_by_order_or_asin_and_record_results(tmp_path, monkeypatch):
+    catalog=tmp_path/'products.json';write_catalog(catalog,'A','B');monkeypatch.setenv('PRODUCTS_JSON_PATH',str(catalog))
+    mod=load_app(tmp_path);app=mod.app.test_client();bot=lambda name:{'Authorization':'Bearer worker-secret','X-Worker-Id':name}
+    conn=mod.get_db();mod.upsert_orders(conn,[make_order(mod,1,'A','B'),make_order(mod,2,'A',shipping_address='{"city":"Tempe"}'),make_order(mod,3,'A'),make_order(mod,4,'B')]);conn.commit();conn.close()
+    assert app.get('/api/queue/next?group=sku',headers=bot('a')).status_code==400
+    by_order=app.get('/api/queue/next?batch=5&group=order',headers=bot('a')).get_json()['batch']
+    assert [o['order_id'] for o in by_order['orders']]==[1] and {a['asin'] for a in by_order['asins']}=={'A','B'} and by_order['total_quantity']==2
+    by_asin=app.get('/api/queue/next?batch=5&group=asin',headers=bot('b')).get_json()['batch']
+    assert by_asin['group_key']=='A' and by_asin['asins']==[{'asin':'A','amazon_url':'https://example.com/A','quantity':2,'task_ids':[t['id'] for t in by_asin['tasks']]}]
+    assert [o['shipping_address'] for o in by_asin['orders']]==[{'city':'Tempe'},{}]
+    assert app.post('/api/worker/heartbeat',json={'batch_id':by_asin['batch_id']},headers=bot('b')).get_json()['lease_expires_at']
+    assert app.post(f"/api/queue/batches/{by_asin['batch_id']}/result",json={'state':'purchased'},headers=bot('a')).status_code==409
+    for bad in (['x'],[{'task_id':'abc','state':'failed'}],[{'state':'failed'}],{'task_id':1}):
+        assert app.post(f"/api/queue/batches/{by_asin['batch_id']}/result",json={'state':'purchased','results':bad},headers=bot('b')).status_code==400
+    first,second=[t['id'] for t in by_asin['tasks']]
+    r=app.post(f"/api/queue/batches/{by_asin['batch_id']}/result",json={'state':'purchased','amazon_order_id':'AMZ-1','results':[{'task_id':second,'state':'failed','error_message':'Out of stock'}]},headers=bot('b'))
+    assert r.status_code==200 and r.get_json()=={'batch_id':by_asin['batch_id'],'updated':[first,second],'rejected':[]}
+    conn=mod.get_db();rows={row['id']:(row['state'],row['amazon_order_id'],row['lease_owner']) for row in conn.execute("SELECT * FROM tasks WHERE batch_id=?",(by_asin['batch_id'],))};conn.close()
+    assert rows=={first:('purchased','AMZ-1',None),second:('failed',None,None)}
+    assert app.post('/api/queue/batches/nope/result',json={'state':'purchased'},headers=bot('b')).status_code==404
+    assert app.get('/api/queue/next',headers=bot('c')).get_json()['batch'] is None
+
+def test_queue_long_poll_wakes_when_a_task_is_queued(tmp_path, monkeypatch):
+    import threading, time
+    catalog=tmp_path/'products.json';write_catalog(catalog,'A');monkeypatch.setenv('PRODUCTS_JSON_PATH',str(catalog))
+    mod=load_app(tmp_path);worker={'Authorization':'Bearer worker-secret'};mod.QUEUE_WAIT_POLL_INTERVAL=5
+    started=time.monotonic();assert mod.app.test_client().get('/api/queue/next?wait=0.2',headers=worker).get_json()['task'] is None and time.monotonic()-started>=0.2
+    results=[];poll=threading.Thread(target=lambda:results.append(mod.app.test_client().get('/api/queue/next?wait=10',headers=worker).get_json()));poll.start()
+    time.sleep(0.2);conn=mod.get_db();generation=mod.queue_generation(conn);mod.upsert_orders(conn,[make_order(mod,1,'A')]);conn.commit()
+    assert mod.queue_generation(conn)!=generation;conn.close();started=time.monotonic();mod.notify_queue_changed();poll.join(5)
+    assert results[0]['task']['shopify_order_id']=='1' and time.monotonic()-started<1
+    mod.QUEUE_WAIT_POLL_INTERVAL=0.05;results.clear();poll=threading.Thread(target=lambda:results.append(mod.app.test_client().get('/api/queue/next?wait=10',headers=worker).get_json()));poll.start()
+    time.sleep(0.2);conn=mod.get_db();mod.upsert_orders(conn,[make_order(mod,2,'A')]);conn.commit();conn.close();poll.join(5)
+    assert results[0]['task']['shopify_order_id']=='2'
+
+def test_queue_updates_apply_ordered_transitions_in_one_transaction(tmp_path, monkeypatch):
+    import sys
+    catalog=tmp_path/'products.json';write_catalog(catalog,'A');monkeypatch.setenv('PRODUCTS_JSON_PATH',str(catalog))
+    mod=load_app(tmp_path);sys.modules.pop('notification_extension',None);import notification_extension;app=mod.app.test_client()
+    bot=lambda name:{'Authorization':'Bearer worker-secret','X-Worker-Id':name}
+    conn=mod.get_db();mod.upsert_orders(conn,[make_order(mod,1,'A'),make_order(mod,2,'A')]);conn.commit();conn.close()
+    mine=app.get('/api/queue/next',headers=bot('a')).get_json()['task']['id'];theirs=app.get('/api/queue/next',headers=bot('b')).get_json()['task']['id']
+    assert app.post('/api/queue/updates',json={'updates':[]},headers=bot('a')).status_code==400
+    steps=[{'task_id':mine,'state':state,'last_action':state} for state in ('processing_cart','processing_checkout','processing_payment')]
+    r=app.post('/api/queue/updates',json={'updates':steps+[{'task_id':theirs,'state':'failed'},{'task_id':999,'state':'failed'},{'state':'failed'},{'task_id':mine,'state':'purchased','amazon_order_id':'AMZ-9'}]},headers=bot('a')).get_json()
+    assert [x['status'] for x in r['results']]==['updated']*3+['conflict','not_found','invalid','updated'] and r['updated']==4 and r['conflict']==1
+    conn=mod.get_db();task=conn.execute("SELECT state,amazon_order_id,lease_owner FROM tasks WHERE id=?",(mine,)).fetchone()[:]
+    events=[row[0] for row in conn.execute("SELECT event_type FROM notification_events WHERE task_id=? ORDER BY id",(mine,))];conn.close()
+    assert task==('purchased','AMZ-9',None) and events==['fulfillment_started']*3+['fulfillment_succeeded']
+    assert app.post(f'/api/queue/{theirs}/update',json={'state':'processing_cart'},headers=bot('b')).status_code==200 and app.post('/api/queue/999/update',json={'state':'failed'},headers=bot('b')).status_code==404
+
+def test_queue_claims_by_priority_policy_and_shares_across_shops(tmp_path, monkeypatch):
+    from datetime import datetime, timedelta, timezone
+    import pytest
+    catalog=tmp_path/'products.json';write_catalog(catalog,'A','B');monkeypatch.setenv('PRODUCTS_JSON_PATH',str(catalog))
+    monkeypatch.setenv('QUEUE_PRIORITY_POLICY','{"sku_rules":{"A":"x"}}')
+    with pytest.raises(ValueError): load_app(tmp_path)
+    monkeypatch.delenv('QUEUE_PRIORITY_POLICY')
+    mod=load_app(tmp_path);app=mod.app.test_client();bot={'Authorization':'Bearer worker-secret'}
+    old=(datetime.now(timezone.utc)-timedelta(days=2)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    conn=mod.get_db();mod.upsert_orders(conn,[make_order(mod,1,'A'),make_order(mod,2,'A',shipping_method='Express'),make_order(mod,3,'A',created_at=old),make_order(mod,4,'B')]);conn.commit()
+    assert conn.execute("SELECT COUNT(*) FROM tasks WHERE priority IS NULL").fetchone()[0]==0;conn.close()
+    assert [o['items'][0]['priority']>0 for o in app.get('/api/operations/queue',headers=auth()).get_json()['waiting_orders']][:2]==[True,True]
+    assert app.put('/api/operations/queue/policy',json={'bogus':1},headers=auth()).status_code==400 and app.put('/api/operations/queue/policy',json={'sku_rules':[]},headers=auth()).status_code==400
+    assert all(app.put('/api/operations/queue/policy',json=bad,headers=auth()).status_code==400 for bad in ({'shipping_rules':{'s':'abc'}},{'sku_rules':{'A':'x'}},{'age_cap':True}))
+    r=app.put('/api/operations/queue/policy',json={'sku_rules':{' b ':1000}},headers=auth()).get_json();assert r['rescored']>=1 and r['policy']['sku_rules']=={'B':1000}
+    assert [app.get('/api/queue/next',headers=bot).get_json()['task']['shopify_order_number'] for _ in range(4)]==['4','3','2','1']
+    mod.save_shopify_connection('second.myshopify.com','token-2')
+    conn=mod.get_db();mod.upsert_orders(conn,[make_order(mod,5,'A',shipping_method='Overnight'),make_order(mod,6,'A',shipping_method='Overnight'),make_order(mod,7,'A',shop_domain='second.myshopify.com')]);conn.commit();conn.close()
+    assert [app.get('/api/queue/next',headers=bot).get_json()['task']['shopify_order_number'] for _ in range(3)]==['7','5','6']
+
+def test_failed_tasks_back_off_by_failure_class_and_retry_in_bulk(tmp_path, monkeypatch):
+    import time
+    import pytest
+    catalog=tmp_path/'products.json';write_catalog(catalog,'A');monkeypatch.setenv('PRODUCTS_JSON_PATH',str(catalog))
+    for bad in ('{"stock":5}','{"stock":{"base_seconds":"1h"}}','{"stock":{"max_attempts":NaN}}','{"stock":{"retries":3}}','[]'):
+        monkeypatch.setenv('TASK_RETRY_POLICY',bad)
+        with pytest.raises(ValueError): load_app(tmp_path)
+    monkeypatch.setenv('TASK_RETRY_POLICY','{"Fraud":{"max_attempts":1}}')
+    mod=load_app(tmp_path);app=mod.app.test_client();assert mod.TASK_RETRY_POLICY['fraud']=={**mod.TASK_RETRY_POLICY['transient'],'max_attempts':1};bot={'Authorization':'Bearer worker-secret'}
+    conn=mod.get_db();mod.upsert_orders(conn,[make_order(mod,1,'A')]);conn.commit();conn.close()
+    task_id=app.get('/api/queue/next',headers=bot).get_json()['task']['id']
+    row=lambda:mod.get_db().execute("SELECT state,failure_class,next_attempt_at,attempts,error_message FROM tasks WHERE id=?",(task_id,)).fetchone()
+    assert app.post(f'/api/queue/{task_id}/update',json={'state':'retry','error_message':'Item out of stock'},headers=bot).status_code==200
+    state,failure_class,due,attempts,_=row();assert (state,failure_class,attempts)==('retry_scheduled','stock',1) and 3240<=due-time.time()<=3960
+    assert app.get('/api/queue/next',headers=bot).get_json()['task'] is None
+    conn=mod.get_db();conn.execute("UPDATE tasks SET next_attempt_at=? WHERE id=?",(time.time()-1,task_id));conn.commit();conn.close()
+    assert app.get('/api/queue/next',headers=bot).get_json()['task']['id']==task_id
+    app.post(f'/api/queue/{task_id}/update',json={'state':'queued','error_message':'Timed out'},headers=bot);assert row()[:2]==('retry_scheduled','transient') and row()[2]-time.time()<=66
+    mod.TASK_RETRY_POLICY['transient']['max_attempts']=3
+    conn=mod.get_db();conn.execute("UPDATE tasks SET next_attempt_at=? WHERE id=?",(time.time()-1,task_id));conn.commit();conn.close()
+    assert app.get('/api/queue/next',headers=bot).get_json()['task']['id']==task_id and app.get('/api/status',headers=auth()).get_json()['retry_count']==0
+    app.post(f'/api/queue/{task_id}/update',json={'state':'retry','error_message':'Timed out'},headers=bot);assert row()[0]=='failed' and row()[4]=='Timed out (gave up after 3 attempts)'
+    assert app.post('/api/tasks/retry',json={'failure_class':'bogus'},headers=auth()).status_code==400
+    assert app.post('/api/tasks/retry',json={'failure_class':'stock'},headers=auth()).get_json()=={'scheduled':0,'queued':0}
+    assert app.post('/api/tasks/retry',json={'failure_class':'transient'},headers=auth()).get_json()=={'scheduled':1,'queued':1}
+    task=app.get('/api/queue/next',headers=bot).get_json()['task'];assert task['id']==task_id and row()[3]==1
+
+def test_task_transitions_are_logged_and_summarized_as_latency_percentiles(tmp_path, monkeypatch):
+    from datetime import datetime, timedelta, timezone
+    catalog=tmp_path/'products.json';write_catalog(catalog,'A');monkeypatch.setenv('PRODUCTS_JSON_PATH',str(catalog))
+    mod=load_app(tmp_path);app=mod.app.test_client();bot={'Authorization':'Bearer worker-secret','X-Worker-Id':'a'}
+    placed=(datetime.now(timezone.utc)-timedelta(hours=1)).isoformat()
+    conn=mod.get_db();mod.upsert_orders(conn,[make_order(mod,1,'A',created_at=placed)]);conn.commit();conn.close()
+    task_id=app.get('/api/queue/next',headers=bot).get_json()['task']['id']
+    for state in ('processing_cart','processing_checkout','purchased'): app.post(f'/api/queue/{task_id}/update',json={'state':state},headers=bot)
+    conn=mod.get_db();log=[tuple(r) for r in conn.execute("SELECT from_state,to_state,worker_id FROM task_transitions WHERE task_id=? ORDER BY id",(task_id,))]
+    fulfilled=datetime.now(timezone.utc).isoformat();mod.upsert_orders(conn,[make_order(mod,1,'A',created_at=placed,fulfillment_status='FULFILLED',shopify_updated_at=fulfilled)])
+    mod.upsert_orders(conn,[make_order(mod,1,'A',created_at=placed,fulfillment_status='FULFILLED',tags='["late"]',shopify_updated_at=(datetime.now(timezone.utc)+timedelta(hours=1)).isoformat())])
+    assert conn.execute("SELECT fulfilled_at,fulfillment_updated_at FROM orders").fetchone()[:]==(mod._utc_timestamp(fulfilled),None);conn.commit();conn.close()
+    assert log==[(None,'queued',None),('queued','processing_opened_url','a'),('processing_opened_url','processing_cart','a'),('processing_cart','processing_checkout','a'),('processing_checkout','purchased','a')]
+    r=app.get('/api/analytics/tasks?days=1',headers=auth()).get_json()
+    assert set(r['stages'])=={'queued','processing_opened_url','processing_cart','processing_checkout'} and r['stages']['processing_cart']['count']==1
+    assert r['purchased']==1 and r['tasks_per_hour']==round(1/24,3) and 3590<=r['end_to_end']['order_to_queued']['p99']<=3610 and r['end_to_end']['purchased_to_fulfilled']['count']==1
+    assert list(r['by_worker'])==['a'] and r['by_worker']['a']['purchased']==1 and len(r['by_day'])>=1
+    assert app.get('/api/analytics/tasks?worker=b',headers=auth()).get_json()['purchased']==0
+    assert mod.latency_percentiles([float(i) for i in range(1,101)])=={'count':100,'p50':50.0,'p95':95.0,'p99':99.0}